@@ -0,0 +1,61 @@
+"""
+Benchmark of the GRIB decoders.
+
+Decodes the given GRIB files with every installed decoder and reports the decoding
+time and the largest difference of decoded values against the first decoder.
+
+Usage:
+    python benchmark_grib.py nov2017.grib [dec2017.grib ...]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+
+from weather.grib import decode_file
+
+
+def installed_decoders():
+    decoders = []
+    try:
+        import eccodes
+        decoders.append('codes')
+        # GribFile interface, or FileReader in newer versions
+        if hasattr(eccodes, 'GribFile') or hasattr(eccodes, 'FileReader'):
+            decoders.append('eccodes')
+    except ImportError:
+        pass
+    try:
+        import pygrib
+        decoders.append('pygrib')
+    except ImportError:
+        pass
+    return decoders
+
+
+def benchmark(filepaths, decoders, repeat=3):
+    reference = None
+    for decoder in decoders:
+        best, blocks = None, None
+        for _ in range(repeat):
+            start = time.time()
+            blocks = [decode_file(filepath, decoder) for filepath in filepaths]
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        n_msgs = sum(len(block) for block in blocks)
+        values = np.vstack([block.values for block in blocks])
+        if reference is None:
+            reference = values
+        diff = np.abs(values.astype(np.float64) - reference).max() if len(values) > 0 else 0.0
+        print("%-8s %8.3f s %10.0f msgs/s  values %s  max diff %g" % (
+            decoder, best, n_msgs / best, values.dtype, diff))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    benchmark(sys.argv[1:], installed_decoders())
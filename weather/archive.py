@@ -0,0 +1,386 @@
+"""
+Memory-mappable on-disk archive of weather messages.
+
+An archive is a directory holding:
+    values.npy: float32 matrix of message values, one message per row
+    lats.npy, lons.npy: grid shared by all messages
+    messages.npz: compact metadata table with the parameter, base datetime, validity
+        datetime and mars type of each message (row of values.npy)
+
+Opening an archive memory-maps the values, so nothing is copied into memory until a
+message is used and processes opening the same archive share the page cache. Files are
+written to temporary files replacing the old ones at once, so readers still mapping the
+old values keep seeing them.
+Messages are stored ordered by base datetime, validity datetime and parameter.
+
+A partitioned archive is a directory of archives, one for each period (e.g. month) of
+base dates, and a manifest.json with the time range, parameters and grid of each
+partition. Queries open only the partitions overlapping the requested base dates.
+
+Example:
+    $ write_archive('nov2017', grib_msgs)
+    $ grib_msgs = read_archive('nov2017')
+
+    $ write_partitioned_archive('ecmwf', grib_msgs, freq='M')
+    $ grib_msgs = PartitionedArchive('ecmwf').select((np.datetime64('2017-11-01'), np.datetime64('2017-11-08')))
+"""
+from collections import OrderedDict
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .cube import FRAME_COLUMNS, object_array, to_datetime64
+from .spatial import grid_fingerprint
+
+VALUES_FILE = 'values.npy'
+LATS_FILE = 'lats.npy'
+LONS_FILE = 'lons.npy'
+MESSAGES_FILE = 'messages.npz'
+MANIFEST_FILE = 'manifest.json'
+
+# number of opened partitions kept by PartitionedArchive
+_OPEN_PARTITIONS = 12
+
+
+def _write_replacing(filepath, write):
+    """
+    Write a file through a temporary file in the same directory that replaces it at once.
+
+    Args:
+        filepath (str): target file
+        write (function): writes the content to the given temporary path
+    """
+    directory, name = os.path.split(filepath)
+    tmp_path = os.path.join(directory, '.tmp-%d-%d-%s' % (os.getpid(), threading.get_ident(), name))
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_npy(filepath, array):
+    """ Store an array to a .npy file replacing it at once. """
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+    _write_replacing(filepath, write)
+
+
+def is_archive(path):
+    """ Check if path is a directory holding a weather archive. """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MESSAGES_FILE))
+
+
+def write_archive(path, grib_msgs):
+    """
+    Store weather messages to an archive directory, existing archive files are replaced
+    (the message table last).
+
+    Args:
+        path (str): archive directory, created if it does not exist
+        grib_msgs (pandas.DataFrame): weather messages sharing the same grid
+    """
+    short_names = np.asarray(grib_msgs['shortName'], dtype=str)
+    base_times = to_datetime64(grib_msgs['validDateTime'])
+    validity_times = to_datetime64(grib_msgs['validityDateTime'])
+    order = np.lexsort((short_names, validity_times, base_times))
+
+    params, param_codes = np.unique(short_names[order], return_inverse=True)
+    types, type_codes = np.unique(np.asarray(grib_msgs['type'], dtype=str)[order], return_inverse=True)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    lats, lons = np.zeros(0), np.zeros(0)
+    if len(grib_msgs) > 0:
+        lats, lons = np.asarray(grib_msgs['lats'].iloc[0]), np.asarray(grib_msgs['lons'].iloc[0])
+    _save_npy(os.path.join(path, LATS_FILE), lats)
+    _save_npy(os.path.join(path, LONS_FILE), lons)
+
+    def write_values(tmp_path):
+        # write values row by row to avoid stacking all messages in memory
+        values = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(grib_msgs), len(lats)))
+        msg_values = grib_msgs['values'].values
+        for row, i in enumerate(order):
+            values[row] = msg_values[i]
+        values.flush()
+        del values
+    _write_replacing(os.path.join(path, VALUES_FILE), write_values)
+
+    def write_messages(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, params=params, param_codes=param_codes.astype(np.int16), types=types,
+                     type_codes=type_codes.astype(np.int8), base_times=base_times[order],
+                     validity_times=validity_times[order])
+    _write_replacing(os.path.join(path, MESSAGES_FILE), write_messages)
+
+
+def _read_messages_table(path):
+    """ Short names, mars types, base and validity datetimes of messages of an archive, values are not opened. """
+    with np.load(os.path.join(path, MESSAGES_FILE), allow_pickle=False) as data:
+        short_names = data['params'].astype(object)[data['param_codes']]
+        types = data['types'].astype(object)[data['type_codes']]
+        return short_names, types, data['base_times'], data['validity_times']
+
+
+def read_archive(path, mmap=True):
+    """
+    Open an archive as a frame of weather messages.
+
+    Args:
+        path (str): archive directory
+        mmap (bool): memory-map the values, otherwise they are read into memory
+
+    Returns:
+        pandas.DataFrame: weather messages with values as (memory-mapped) float32 rows
+    """
+    short_names, types, base_times, validity_times = _read_messages_table(path)
+    values = np.load(os.path.join(path, VALUES_FILE), mmap_mode='r' if mmap else None)
+    lats = np.load(os.path.join(path, LATS_FILE))
+    lons = np.load(os.path.join(path, LONS_FILE))
+
+    n = len(short_names)
+    return pd.DataFrame({
+        'shortName': short_names,
+        'values': object_array(values),
+        'validDateTime': pd.to_datetime(base_times),
+        'validityDateTime': pd.to_datetime(validity_times),
+        'lats': object_array([lats] * n),
+        'lons': object_array([lons] * n),
+        'type': types
+    }, columns=FRAME_COLUMNS)
+
+
+def is_partitioned_archive(path):
+    """ Check if path is a directory holding a partitioned weather archive. """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def _read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_partitioned_archive(path, grib_msgs, freq='M'):
+    """
+    Store weather messages to a partitioned archive. Messages are added to the existing
+    partitions, replacing stored messages with the same base datetime, validity datetime
+    and parameter; partitions without new messages are not touched.
+
+    Args:
+        path (str): partitioned archive directory, created if it does not exist
+        grib_msgs (pandas.DataFrame): weather messages sharing the same grid
+        freq (str): period of base dates in one partition as numpy datetime unit; 'Y', 'M', 'W' or 'D',
+            ignored when adding to an existing archive
+    """
+    assert freq in ['Y', 'M', 'W', 'D']
+    manifest = {'freq': freq, 'grid': None, 'partitions': {}}
+    if is_partitioned_archive(path):
+        manifest = _read_manifest(path)
+        freq = manifest['freq']
+    elif not os.path.exists(path):
+        os.makedirs(path)
+    if len(grib_msgs) == 0:
+        return
+
+    lats, lons = np.asarray(grib_msgs['lats'].iloc[0]), np.asarray(grib_msgs['lons'].iloc[0])
+    grid = {'fingerprint': grid_fingerprint(lats, lons), 'n_points': len(lats)}
+    if manifest['grid'] is not None and manifest['grid'] != grid:
+        raise ValueError("Messages have a different grid than the archive %s" % path)
+    manifest['grid'] = grid
+
+    periods = to_datetime64(grib_msgs['validDateTime']).astype('datetime64[%s]' % freq)
+    for period in np.unique(periods):
+        name = str(period)
+        msgs = grib_msgs[periods == period]
+        partition_path = os.path.join(path, name)
+        if is_archive(partition_path):
+            # merge with stored messages, new messages replace the stored ones
+            stored = read_archive(partition_path, mmap=False)
+            msgs = pd.concat([stored, msgs], ignore_index=True)
+            msgs = msgs.drop_duplicates(['validDateTime', 'validityDateTime', 'shortName'], keep='last')
+        write_archive(partition_path, msgs)
+
+        base_times = to_datetime64(msgs['validDateTime'])
+        manifest['partitions'][name] = {
+            'start': str(period.astype('datetime64[s]')),
+            'stop': str((period + 1).astype('datetime64[s]')),
+            'min_base': str(base_times.min()),
+            'max_base': str(base_times.max()),
+            'params': sorted(set(msgs['shortName'])),
+            'n_messages': len(msgs)
+        }
+
+    # the manifest is replaced after all partitions are written
+    def write_manifest(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    _write_replacing(os.path.join(path, MANIFEST_FILE), write_manifest)
+
+
+class PartitionedArchive:
+    """
+    Partitioned weather archive opened for queries. Only the manifest is read on opening,
+    partitions are memory-mapped when a query first overlaps them.
+
+    Args:
+        path (str): partitioned archive directory
+        msg_filter (grib.MessageFilter): selection applied to messages read from partitions, all if None
+
+    Attributes:
+        manifest (dict): freq, grid and partitions (by name) of the archive
+        lats, lons (np.array(dtype=float)): grid shared by all messages
+    """
+
+    def __init__(self, path, msg_filter=None):
+        self.path = path
+        self.msg_filter = msg_filter
+        self.manifest = _read_manifest(path)
+        self._opened = OrderedDict()
+        self._lock = threading.Lock()
+
+        names = self.partition_names()
+        self.lats, self.lons = None, None
+        if len(names) > 0:
+            self.lats = np.load(os.path.join(path, names[0], LATS_FILE))
+            self.lons = np.load(os.path.join(path, names[0], LONS_FILE))
+            if msg_filter is not None and msg_filter.bbox is not None:
+                mask = msg_filter.crop_mask(self.lats, self.lons)
+                self.lats, self.lons = self.lats[mask], self.lons[mask]
+
+        # base datetime range of partitions for pruning
+        partitions = self.manifest['partitions']
+        self._min_base = np.array([partitions[name]['min_base'] for name in names], dtype='datetime64[s]')
+        self._max_base = np.array([partitions[name]['max_base'] for name in names], dtype='datetime64[s]')
+
+    def __len__(self):
+        return sum(partition['n_messages'] for partition in self.manifest['partitions'].values())
+
+    def partition_names(self, base_range=None):
+        """
+        Names of partitions in chronological order.
+
+        Args:
+            base_range (tuple): half-open interval [start, stop) of base datetimes, all partitions if None
+
+        Returns:
+            list: names of partitions holding messages with base datetimes in the range
+        """
+        names = sorted(self.manifest['partitions'])
+        if base_range is None:
+            return names
+        start, stop = np.asarray(base_range, dtype='datetime64[s]')
+        return [name for name, min_base, max_base in zip(names, self._min_base, self._max_base)
+                if min_base < stop and max_base >= start]
+
+    def _open(self, name):
+        """ Memory-map a partition, keeping the recently used ones open. """
+        with self._lock:
+            grib_msgs = self._opened.pop(name, None)
+        if grib_msgs is None:
+            grib_msgs = read_archive(os.path.join(self.path, name))
+        with self._lock:
+            self._opened[name] = grib_msgs
+            while len(self._opened) > _OPEN_PARTITIONS:
+                self._opened.popitem(last=False)
+        return grib_msgs
+
+    def select(self, base_range, validity_range=None, same_day=False):
+        """
+        Select messages from overlapping partitions, see WeatherCube.select for arguments.
+
+        Returns:
+            pandas.DataFrame: selected messages ordered by base datetime, validity datetime and parameter
+        """
+        start, stop = np.asarray(base_range, dtype='datetime64[s]')
+        selected = []
+        for name in self.partition_names((start, stop)):
+            grib_msgs = self._open(name)
+            base = grib_msgs['validDateTime'].values.astype('datetime64[s]')
+            validity = grib_msgs['validityDateTime'].values.astype('datetime64[s]')
+            keep = (base >= start) & (base < stop)
+            if validity_range is not None:
+                v_start, v_stop = np.asarray(validity_range, dtype='datetime64[s]')
+                keep &= (validity >= v_start) & (validity < v_stop)
+            if same_day:
+                keep &= validity.astype('datetime64[D]') == base.astype('datetime64[D]')
+            selected.append(grib_msgs[keep])
+
+        if len(selected) == 0:
+            return pd.DataFrame(columns=FRAME_COLUMNS)
+        grib_msgs = pd.concat(selected, ignore_index=True)
+        if self.msg_filter is not None:
+            grib_msgs = self.msg_filter.filter_frame(grib_msgs)
+        return grib_msgs
+
+    def _filter_range(self):
+        """ Base datetime range of all partitions within the base dates of the filter. """
+        start, stop = self._min_base.min(), self._max_base.max() + 1
+        if self.msg_filter is not None and self.msg_filter.base_dates is not None:
+            start = max(start, np.datetime64(self.msg_filter.base_dates[0], 's'))
+            stop = min(stop, np.datetime64(self.msg_filter.base_dates[1], 's') + np.timedelta64(1, 'D'))
+        return start, stop
+
+    def to_frame(self):
+        """ All messages of the archive, only the partitions within the base dates of the filter are opened. """
+        if len(self._min_base) == 0:
+            return pd.DataFrame(columns=FRAME_COLUMNS)
+        return self.select(self._filter_range())
+
+    def headers(self):
+        """
+        Header keys of all messages selected by the filter, read from the metadata tables of
+        partitions without opening their values.
+
+        Returns:
+            tuple: base datetimes, validity datetimes, short names, partition names and rows in the
+                partitions of the messages; positions are taken by .take(...)
+        """
+        base, validity, short_names, partitions, rows = [], [], [], [], []
+        names = self.partition_names(self._filter_range()) if len(self._min_base) > 0 else []
+        for name in names:
+            names_, _, base_times, validity_times = _read_messages_table(os.path.join(self.path, name))
+            names_ = np.asarray(names_, dtype=str)
+            keep = np.ones(len(names_), dtype=bool)
+            if self.msg_filter is not None:
+                keep = self.msg_filter.keep_mask(names_, base_times, validity_times)
+            base.append(base_times[keep])
+            validity.append(validity_times[keep])
+            short_names.append(names_[keep])
+            partitions.append(np.full(keep.sum(), name))
+            rows.append(np.flatnonzero(keep))
+        if len(names) == 0:
+            return (np.zeros(0, dtype='datetime64[s]'), np.zeros(0, dtype='datetime64[s]'), np.zeros(0, dtype=str),
+                    np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64))
+        return (np.concatenate(base).astype('datetime64[s]'), np.concatenate(validity).astype('datetime64[s]'),
+                np.concatenate(short_names), np.concatenate(partitions), np.concatenate(rows))
+
+    def take(self, partitions, rows):
+        """
+        Messages at given positions (see .headers()), only their partitions are opened.
+
+        Args:
+            partitions (np.array(dtype=str)): partition name of each message
+            rows (np.array(dtype=int)): row of each message in its partition
+
+        Returns:
+            pandas.DataFrame: messages in the given order
+        """
+        if len(rows) == 0:
+            return pd.DataFrame(columns=FRAME_COLUMNS)
+        taken, positions = [], []
+        for name in np.unique(partitions):
+            at = np.flatnonzero(partitions == name)
+            taken.append(self._open(name).iloc[rows[at]])
+            positions.append(at)
+        grib_msgs = pd.concat(taken, ignore_index=True)
+        grib_msgs = grib_msgs.iloc[np.argsort(np.concatenate(positions))].reset_index(drop=True)
+        if self.msg_filter is not None:
+            grib_msgs = self.msg_filter.filter_frame(grib_msgs)
+        return grib_msgs
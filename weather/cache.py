@@ -0,0 +1,125 @@
+"""
+Cache of query results.
+
+Results of WeatherExtractor queries are cached under their normalized arguments and the
+version of loaded data, within a memory budget; the least recently used results are
+dropped when the budget is exceeded. Cached value arrays are read-only and every hit
+returns a new frame referencing them, so callers cannot change cached results.
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+
+import numpy as np
+
+from .cube import object_array
+
+ARRAY_COLUMNS = ['values', 'lats', 'lons']
+
+
+def plan_key(plan):
+    """ Hash identifying the aggregation of a QueryPlan. """
+    h = hashlib.sha1()
+    h.update(('%s|%s|%s' % (plan.fingerprint, plan.aggloc, plan.aggtype)).encode('ascii'))
+    for arr in [plan.target_lats, plan.target_lons, plan.index, plan.counts]:
+        if arr is not None:
+            h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def query_key(*args):
+    """ Hashable key of query arguments; dicts, lists and arrays are converted to tuples. """
+    def _normalize(arg):
+        if isinstance(arg, dict):
+            return tuple(sorted((key, _normalize(value)) for key, value in arg.items()))
+        if isinstance(arg, (list, tuple, np.ndarray)):
+            return tuple(_normalize(item) for item in arg)
+        if isinstance(arg, np.generic):
+            return arg.item()
+        return arg
+    return tuple(_normalize(arg) for arg in args)
+
+
+def _read_only(column):
+    """ Read-only views of the arrays of an object column, arrays shared by rows stay shared. """
+    views = {}
+    for arr in column:
+        if id(arr) not in views:
+            view = np.asarray(arr).view()
+            view.flags.writeable = False
+            views[id(arr)] = view
+    return object_array(views[id(arr)] for arr in column)
+
+
+def result_nbytes(result):
+    """ Memory used by a result frame, counting arrays shared by rows once. """
+    arrays = {}
+    for column in ARRAY_COLUMNS:
+        if column in result:
+            arrays.update((id(arr), arr) for arr in result[column])
+    return int(result.memory_usage(index=True).sum()) + sum(np.asarray(arr).nbytes for arr in arrays.values())
+
+
+class ResultCache:
+    """
+    Least recently used cache of query results within a memory budget, can be shared by threads.
+
+    Args:
+        max_bytes (int): memory budget of cached results
+
+    Attributes:
+        hits, misses (int): number of found and missing results
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key):
+        """ Get a copy of a cached result or None. """
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results[key] = entry
+        return entry[0].copy()
+
+    def put(self, key, result):
+        """ Cache a result and return a copy of it, results larger than the budget are not cached. """
+        cached = result.copy()
+        for column in ARRAY_COLUMNS:
+            if column in cached:
+                cached[column] = _read_only(cached[column])
+        nbytes = result_nbytes(cached)
+        if nbytes > self.max_bytes:
+            return cached
+
+        with self._lock:
+            old = self._results.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._results[key] = (cached, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, dropped) = self._results.popitem(last=False)
+                self.nbytes -= dropped
+        return cached.copy()
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Cache statistics: hits, misses, number of results, used and maximal bytes. """
+        return {'hits': self.hits, 'misses': self.misses, 'results': len(self._results),
+                'bytes': self.nbytes, 'max_bytes': self.max_bytes}
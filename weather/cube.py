@@ -0,0 +1,210 @@
+"""
+Dense array storage for weather messages.
+
+A WeatherCube holds the values of all loaded messages in one contiguous float32 array
+indexed by (base datetime, validity step, parameter, grid point). Small sorted index
+arrays describe each axis, so queries are answered by slicing the cube instead of
+looping over per-message objects.
+
+Example:
+    $ cube = WeatherCube.from_frame(grib_msgs)
+    $ msgs = cube.select((np.datetime64('2017-11-01'), np.datetime64('2017-11-02')))
+"""
+import numpy as np
+import pandas as pd
+
+# columns of the message frame in the order produced by the loaders
+FRAME_COLUMNS = ['shortName', 'values', 'validDateTime', 'validityDateTime', 'lats', 'lons', 'type']
+
+
+def object_array(items):
+    """ Wrap a sequence of arrays into a 1d object array without stacking them. """
+    items = list(items)
+    res = np.empty(len(items), dtype=object)
+    for i, item in enumerate(items):
+        res[i] = item
+    return res
+
+
+def _repeat_object(item, n):
+    """ Object array referencing the same item n times. """
+    res = np.empty(n, dtype=object)
+    for i in range(n):
+        res[i] = item
+    return res
+
+
+def to_datetime64(column):
+    """ Convert a column of datetimes to a numpy datetime64[s] array. """
+    return pd.to_datetime(pd.Series(column)).values.astype('datetime64[s]')
+
+
+class WeatherCube:
+    """
+    Weather messages packed into a dense cube of shape (n_base, n_step, n_param, n_points).
+
+    All messages share the same grid. Messages missing from the source data are marked
+    in the 'present' mask and hold NaN values.
+
+    Attributes:
+        base_times (np.array(dtype=datetime64[s])): sorted base datetimes (forecast made)
+        steps (np.array(dtype=timedelta64[s])): sorted offsets of the validity datetime from the base datetime
+        params (np.array(dtype=object)): sorted parameter short names
+        lats, lons (np.array(dtype=float)): latitudes and longtitudes of the grid points
+        types (np.array(dtype=object)): mars type of the messages for each base datetime
+        values (np.array(dtype=float32)): message values
+        present (np.array(dtype=bool)): mask of shape (n_base, n_step, n_param) of existing messages
+    """
+
+    def __init__(self, base_times, steps, params, lats, lons, values, present, types=None):
+        self.base_times = np.asarray(base_times, dtype='datetime64[s]')
+        self.steps = np.asarray(steps, dtype='timedelta64[s]')
+        self.params = np.asarray(params, dtype=object)
+        self.lats = np.asarray(lats)
+        self.lons = np.asarray(lons)
+        self.values = values
+        self.present = present
+        if types is None:
+            types = _repeat_object('fc', len(self.base_times))
+        self.types = np.asarray(types, dtype=object)
+
+        assert self.values.shape == (len(self.base_times), len(self.steps), len(self.params), len(self.lats))
+        assert self.present.shape == self.values.shape[:3]
+
+    @classmethod
+    def from_frame(cls, grib_msgs):
+        """
+        Pack a frame of weather messages (as produced by WeatherExtractor loaders) into a cube.
+        If several messages share the same base datetime, validity datetime and parameter
+        the last one is kept.
+
+        Args:
+            grib_msgs (pandas.DataFrame): weather messages
+
+        Returns:
+            WeatherCube: cube holding all messages
+        """
+        assert len(grib_msgs) > 0, "no weather messages to pack"
+
+        lats = np.asarray(grib_msgs['lats'].iloc[0])
+        lons = np.asarray(grib_msgs['lons'].iloc[0])
+
+        base = to_datetime64(grib_msgs['validDateTime'])
+        validity = to_datetime64(grib_msgs['validityDateTime'])
+        names = np.asarray(grib_msgs['shortName'], dtype=str)
+
+        base_times, b_idx = np.unique(base, return_inverse=True)
+        steps, s_idx = np.unique(validity - base, return_inverse=True)
+        params, p_idx = np.unique(names, return_inverse=True)
+        b_idx, s_idx, p_idx = b_idx.ravel(), s_idx.ravel(), p_idx.ravel()
+
+        values = np.full((len(base_times), len(steps), len(params), len(lats)), np.nan, dtype=np.float32)
+        present = np.zeros(values.shape[:3], dtype=bool)
+        for k, msg_values in enumerate(grib_msgs['values']):
+            assert len(msg_values) == len(lats), "all messages should be defined on the same grid"
+            values[b_idx[k], s_idx[k], p_idx[k]] = msg_values
+        present[b_idx, s_idx, p_idx] = True
+
+        # the first message of each base datetime determines its type
+        types = None
+        if 'type' in grib_msgs:
+            types = np.asarray(grib_msgs['type'], dtype=object)[np.unique(b_idx, return_index=True)[1]]
+
+        return cls(base_times, steps, params.astype(object), lats, lons, values, present, types)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the cube arrays in bytes. """
+        return sum(arr.nbytes for arr in [self.values, self.present, self.base_times, self.steps,
+                                          self.lats, self.lons])
+
+    def __len__(self):
+        """ Number of messages held in the cube. """
+        return int(self.present.sum())
+
+    def merge(self, other):
+        """
+        Merge two cubes defined on the same grid. Messages of 'other' take precedence.
+
+        Args:
+            other (WeatherCube): cube to merge with
+
+        Returns:
+            WeatherCube: new cube containing messages from both cubes
+        """
+        assert np.array_equal(self.lats, other.lats) and np.array_equal(self.lons, other.lons), \
+            "only cubes on the same grid can be merged"
+
+        base_times = np.union1d(self.base_times, other.base_times)
+        steps = np.union1d(self.steps, other.steps)
+        params = np.union1d(self.params.astype(str), other.params.astype(str)).astype(object)
+
+        values = np.full((len(base_times), len(steps), len(params), len(self.lats)), np.nan, dtype=np.float32)
+        present = np.zeros(values.shape[:3], dtype=bool)
+        types = np.empty(len(base_times), dtype=object)
+
+        for cube in [self, other]:
+            b_idx = np.searchsorted(base_times, cube.base_times)
+            s_idx = np.searchsorted(steps, cube.steps)
+            p_idx = np.searchsorted(params.astype(str), cube.params.astype(str))
+            block = np.ix_(b_idx, s_idx, p_idx)
+
+            sub_values, sub_present = values[block], present[block]
+            sub_values[cube.present] = cube.values[cube.present]
+            sub_present |= cube.present
+            values[block], present[block] = sub_values, sub_present
+            types[b_idx] = cube.types
+
+        return WeatherCube(base_times, steps, params, self.lats, self.lons, values, present, types)
+
+    def select(self, base_range, validity_range=None, same_day=False):
+        """
+        Select messages from the cube as a frame of weather messages.
+
+        Args:
+            base_range (tuple): half-open interval [start, stop) of base datetimes (np.datetime64)
+            validity_range (tuple): half-open interval [start, stop) of validity datetimes, all if None
+            same_day (bool): keep only messages valid on the same day as their base datetime
+
+        Returns:
+            pandas.DataFrame: selected messages ordered by base datetime, validity datetime and parameter
+        """
+        lo, hi = np.searchsorted(self.base_times, np.asarray(base_range, dtype='datetime64[s]'))
+        base = self.base_times[lo:hi]
+
+        validity = base[:, None] + self.steps[None, :]
+        keep = self.present[lo:hi].copy()
+        if validity_range is not None:
+            v_start, v_stop = np.asarray(validity_range, dtype='datetime64[s]')
+            keep &= ((validity >= v_start) & (validity < v_stop))[:, :, None]
+        if same_day:
+            keep &= (validity.astype('datetime64[D]') == base.astype('datetime64[D]')[:, None])[:, :, None]
+
+        b_idx, s_idx, p_idx = np.nonzero(keep)
+        return self.to_frame(b_idx + lo, s_idx, p_idx)
+
+    def to_frame(self, b_idx=None, s_idx=None, p_idx=None):
+        """
+        Unpack messages into a frame of weather messages. Unpacks all present messages
+        if no indices are given.
+
+        Args:
+            b_idx, s_idx, p_idx (np.array(dtype=int)): base, step and parameter index of each message
+
+        Returns:
+            pandas.DataFrame: weather messages with values as float32 arrays
+        """
+        if b_idx is None:
+            b_idx, s_idx, p_idx = np.nonzero(self.present)
+
+        n = len(b_idx)
+        base = self.base_times[b_idx]
+        return pd.DataFrame({
+            'shortName': self.params[p_idx],
+            'values': object_array(self.values[b_idx, s_idx, p_idx]),
+            'validDateTime': pd.to_datetime(base),
+            'validityDateTime': pd.to_datetime(base + self.steps[s_idx]),
+            'lats': _repeat_object(self.lats, n),
+            'lons': _repeat_object(self.lons, n),
+            'type': self.types[b_idx]
+        }, columns=FRAME_COLUMNS)
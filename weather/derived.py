@@ -0,0 +1,176 @@
+"""
+Registry of derived weather parameters.
+
+A derived parameter is calculated from messages of its input parameters (stored or
+derived themselves) with the same base and validity datetime, by a vectorized formula
+taking one value matrix per input with one time slice per row. Derived parameters are
+calculated only when a query asks for them and can be cached per time slice.
+
+Built-in parameters:
+    ws: wind speed [m/s] from 10u, 10v
+    rh: relative humidity [%] from 2t, 2d
+    dpd: dewpoint depression [K] from 2t, 2d
+    wdir: meteorological wind direction (where the wind blows from) [deg] from 10u, 10v
+    at: apparent temperature [K] from 2t, rh, ws
+
+Example:
+    $ register('tcc_pct', ['tcc'], lambda tcc: 100 * tcc, 'total cloud cover [%]')
+    $ grib_msgs = derive(grib_msgs, ['ws', 'tcc_pct'])
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .cube import object_array
+
+T0 = 273.15
+
+
+class DerivedParam:
+    """
+    Derived weather parameter.
+
+    Args:
+        short_name (str): short name of the derived parameter
+        inputs (list): short names of the input parameters
+        formula (callable): function of one value matrix per input returning the value matrix
+        description (str): name and units of the parameter
+        default (bool): derived for queries that do not name the parameters they need
+    """
+
+    def __init__(self, short_name, inputs, formula, description='', default=False):
+        self.short_name = short_name
+        self.inputs = list(inputs)
+        self.formula = formula
+        self.description = description
+        self.default = default
+
+
+# registered derived parameters by short name
+DERIVED_PARAMS = OrderedDict()
+
+
+def register(short_name, inputs, formula, description='', default=False):
+    """ Register a derived parameter, see DerivedParam for arguments. """
+    DERIVED_PARAMS[short_name] = DerivedParam(short_name, inputs, formula, description=description, default=default)
+
+
+def default_params():
+    """ Short names of derived parameters added to queries that do not name their parameters. """
+    return [name for name, param in DERIVED_PARAMS.items() if param.default]
+
+
+def required_inputs(short_names):
+    """ Short names of non-derived parameters needed for calculating the given parameters. """
+    required, stack = set(), list(short_names)
+    while stack:
+        name = stack.pop()
+        if name in DERIVED_PARAMS:
+            stack.extend(DERIVED_PARAMS[name].inputs)
+        else:
+            required.add(name)
+    return required
+
+
+def _relative_humidity(t, d):
+    # https://journals.ametsoc.org/doi/pdf/10.1175/BAMS-86-2-225
+    T_surface, T_dew = t - T0, d - T0
+    return 100*(np.exp((17.625*T_dew)/(243.04+T_dew))/np.exp((17.625*T_surface)/(243.04+T_surface)))
+
+
+def _apparent_temperature(t, rh, ws):
+    # Australian Bureau of Meteorology apparent temperature (without radiation)
+    T_air = t - T0
+    vapour_pressure = rh / 100 * 6.105 * np.exp(17.27 * T_air / (237.7 + T_air))
+    return T_air + 0.33 * vapour_pressure - 0.70 * ws - 4.00 + T0
+
+
+register('ws', ['10u', '10v'], lambda u, v: np.sqrt(u * u + v * v), 'wind speed [m/s]', default=True)
+register('rh', ['2t', '2d'], _relative_humidity, 'relative humidity [%]', default=True)
+register('dpd', ['2t', '2d'], lambda t, d: t - d, 'dewpoint depression [K]')
+register('wdir', ['10u', '10v'], lambda u, v: np.mod(180 + np.degrees(np.arctan2(u, v)), 360),
+         'wind direction [deg]')
+register('at', ['2t', 'rh', 'ws'], _apparent_temperature, 'apparent temperature [K]')
+
+
+def _aligned_positions(grib_msgs, inputs):
+    """
+    Positions of messages of the input parameters aligned on base and validity datetime.
+
+    Returns:
+        np.array(dtype=int): matrix with one time slice per row and one input per column
+    """
+    keys = ['validDateTime', 'validityDateTime']
+    short_names = grib_msgs['shortName'].values
+    frame = pd.DataFrame({
+        'validDateTime': grib_msgs['validDateTime'].values,
+        'validityDateTime': grib_msgs['validityDateTime'].values,
+        'pos': np.arange(len(grib_msgs))
+    })
+    pairs = None
+    for i, name in enumerate(inputs):
+        positions = frame[short_names == name].drop_duplicates(keys).rename(columns={'pos': i})
+        pairs = positions if pairs is None else pairs.merge(positions, on=keys)
+    return pairs[list(range(len(inputs)))].values.astype(np.int64)
+
+
+def derive(grib_msgs, short_names, cache=None):
+    """
+    Add messages of derived parameters, calculated for each time slice with all inputs present.
+
+    Args:
+        grib_msgs (pandas.DataFrame): weather messages
+        short_names (list): parameters to derive, parameters already present or not registered are skipped
+        cache (lazy.FieldCache): cache of derived values by (short name, base datetime, validity datetime)
+
+    Returns:
+        pandas.DataFrame: weather messages with messages of the derived parameters appended
+    """
+    stored = set(grib_msgs['shortName'])
+    derived_msgs = OrderedDict()
+
+    def _derive(name, visiting):
+        if name in stored or name in derived_msgs:
+            return True
+        if name not in DERIVED_PARAMS or name in visiting:
+            return False
+        param = DERIVED_PARAMS[name]
+        if not all([_derive(input_name, visiting | {name}) for input_name in param.inputs]):
+            return False
+
+        # messages of the inputs only
+        msgs = [grib_msgs[grib_msgs['shortName'].isin(param.inputs).values]]
+        msgs += [derived_msgs[input_name] for input_name in param.inputs if input_name in derived_msgs]
+        msgs = pd.concat(msgs, ignore_index=True) if len(msgs) > 1 else msgs[0]
+        positions = _aligned_positions(msgs, param.inputs)
+        pos = positions[:, 0]
+        base = msgs['validDateTime'].values[pos]
+        validity = msgs['validityDateTime'].values[pos]
+
+        values = [None] * len(pos)
+        if cache is not None:
+            values = [cache.get((name, b, v)) for b, v in zip(base, validity)]
+        missing = np.array([i for i, v in enumerate(values) if v is None], dtype=np.int64)
+        if len(missing) > 0:
+            msg_values = msgs['values'].values
+            derived = param.formula(*[np.vstack(msg_values[positions[missing, i]]) for i in range(len(param.inputs))])
+            for i, msg_values in zip(missing, derived):
+                values[i] = msg_values
+                if cache is not None:
+                    cache.put((name, base[i], validity[i]), msg_values)
+
+        new_msgs = msgs.iloc[pos].reset_index(drop=True)
+        new_msgs['shortName'] = name
+        new_msgs['values'] = object_array(values)
+        derived_msgs[name] = new_msgs
+        return True
+
+    for name in short_names:
+        _derive(name, set())
+
+    # only the requested parameters are added, not their derived inputs
+    added = [derived_msgs[name] for name in OrderedDict.fromkeys(short_names) if name in derived_msgs]
+    if len(added) == 0:
+        return grib_msgs
+    return pd.concat([grib_msgs] + added, ignore_index=True)
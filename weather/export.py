@@ -0,0 +1,328 @@
+"""
+Chunked export of weather tables.
+
+Exported date ranges are split into chunks of days. The table of each chunk is calculated
+from the messages of the chunk only, optionally in worker processes, and appended to the
+output file in chunk order, so memory use is bounded by the chunk size and the number of
+chunks in flight. Chunk tables are calculated by module-level functions taking the chunk
+messages, which are pickled to the workers. Results of other chunk functions, like the
+feature tensors of tensor_chunk, are collected in chunk order with map_chunks.
+
+Example:
+    $ chunks = day_chunks(np.datetime64('2017-01-01'), np.datetime64('2018-01-01'), 31)
+    $ write_chunks('features.tsv', ((features_chunk, (messages(chunk), ...)) for chunk in chunks), processes=4)
+
+Tables can also be written to Parquet files (requires pyarrow) with typed columns, dictionary
+encoded names and one row group per date, so columnar readers can prune dates and parameters
+without parsing text:
+    $ write_chunks('features.parquet', jobs, format='parquet', date_column='validDate',
+    $              dictionary_columns=['shortName', 'featureName', 'aggFunc'])
+"""
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from .cube import object_array, to_datetime64
+from .derived import default_params, derive
+from .features import feature_table, feature_tensor
+
+# chunks in flight per worker process
+_CHUNKS_PER_PROCESS = 2
+
+
+def day_chunks(start, stop, chunk_days):
+    """
+    Split a range of days into chunks.
+
+    Args:
+        start, stop (np.datetime64): half-open interval [start, stop) of days
+        chunk_days (int): days in one chunk, one chunk if None
+
+    Returns:
+        list: (start, stop) days of each chunk as np.datetime64[D]
+    """
+    start, stop = np.datetime64(start, 'D'), np.datetime64(stop, 'D')
+    if chunk_days is None:
+        return [(start, stop)] if start < stop else []
+    starts = np.arange(start, stop, np.timedelta64(chunk_days, 'D'))
+    return [(chunk_start, min(chunk_start + chunk_days, stop)) for chunk_start in starts]
+
+
+def at_points(grib_msgs, points):
+    """ Messages with values reduced to the given grid points. """
+    grib_msgs = grib_msgs.copy()
+    grib_msgs['values'] = object_array(np.asarray(values)[points] for values in grib_msgs['values'].values)
+    return grib_msgs
+
+
+def arrow_table(table, dictionary_columns=()):
+    """ Typed Arrow table of an exported table with dictionary encoded string columns. """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(table, preserve_index=False)
+    for name in dictionary_columns:
+        table = table.set_column(table.schema.get_field_index(name), name, table.column(name).dictionary_encode())
+    return table
+
+
+def _chunk_outputs(table_func, args, header, format, dictionary_columns):
+    """
+    Calculate the table of a chunk as tab separated values or as Arrow tables, one per block
+    if the table function yields blocks of the table.
+    """
+    tables = table_func(*args)
+    if isinstance(tables, pd.DataFrame):
+        tables = [tables]
+    for i, table in enumerate(tables):
+        if format == 'tsv':
+            yield table.to_csv(sep='\t', index=False, header=header and i == 0)
+        else:
+            yield arrow_table(table, dictionary_columns)
+
+
+def _chunk_output_list(table_func, args, header, format, dictionary_columns):
+    """ Outputs of all blocks of a chunk calculated in a worker process. """
+    return list(_chunk_outputs(table_func, args, header, format, dictionary_columns))
+
+
+class _TsvWriter:
+    """ Tab separated file the chunk tables are appended to. """
+
+    def __init__(self, filename, date_column):
+        self.file = open(filename, 'w')
+
+    def write(self, output):
+        self.file.write(output)
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    """
+    Parquet file with one row group per date of the chunk tables, so readers can skip dates by
+    the statistics of row groups. Tables are ordered by date, the ones of the current date are
+    kept until the next date starts. The schema of the file is the one of the first non-empty table,
+    empty tables (e.g. of chunks without messages) have untyped columns and are skipped.
+    """
+
+    def __init__(self, filename, date_column):
+        self.filename = filename
+        self.date_column = date_column
+        self.writer = None
+        self.day = None
+        self.pending = []
+        self.empty_schema = None
+
+    def write(self, table):
+        import pyarrow.parquet as pq
+
+        if table.num_rows == 0:
+            if self.empty_schema is None:
+                self.empty_schema = table.schema
+            return
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        days = np.asarray(table.column(self.date_column).to_numpy()).astype('datetime64[D]')
+        bounds = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1, [len(days)]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if days[start] != self.day:
+                self._flush()
+                self.day = days[start]
+            self.pending.append(table.slice(start, stop - start))
+
+    def _flush(self):
+        """ Write the tables of the current date as one row group. """
+        import pyarrow as pa
+
+        if self.pending:
+            table = pa.concat_tables(self.pending)
+            self.writer.write_table(table, row_group_size=len(table))
+            self.pending = []
+
+    def close(self):
+        import pyarrow.parquet as pq
+
+        if self.writer is None and self.empty_schema is not None:
+            # only empty tables, the file has their columns without rows
+            self.writer = pq.ParquetWriter(self.filename, self.empty_schema)
+        if self.writer is not None:
+            self._flush()
+            self.writer.close()
+
+
+_WRITERS = {'tsv': _TsvWriter, 'parquet': _ParquetWriter}
+
+
+def map_chunks(jobs, processes=None):
+    """
+    Results of chunk functions in the order of chunks.
+
+    Args:
+        jobs (iterable): (function, arguments) of each chunk, consumed while earlier results are used
+        processes (int): number of worker processes, chunks are calculated in the current process if None or 1
+
+    Yields:
+        result of the function of each chunk
+    """
+    if processes is None or processes <= 1:
+        for func, args in jobs:
+            yield func(*args)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for func, args in jobs:
+            pending.append(executor.submit(func, *args))
+            # bounded number of chunks in flight, used as soon as they are done in order
+            while len(pending) >= _CHUNKS_PER_PROCESS * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_chunks(filename, jobs, processes=None, format='tsv', date_column=None, dictionary_columns=()):
+    """
+    Write tables of chunks to a file in the order of chunks.
+
+    Tab separated files have the header of the first chunk. Parquet files have typed columns, one
+    row group per date and dictionary encoded string columns, and are only created if there are chunks.
+    Table functions return the table of a chunk or yield its blocks in order, which are written one
+    by one when the chunk is calculated in the current process.
+
+    Args:
+        filename (str): name of target file
+        jobs (iterable): (table function, arguments) of each chunk, consumed while earlier chunks are written
+        processes (int): number of worker processes, chunks are calculated in the current process if None or 1
+        format (str): 'tsv' or 'parquet'
+        date_column (str): column of dates of parquet row groups, chunk tables are ordered by it
+        dictionary_columns (list): string columns dictionary encoded in parquet files
+    """
+    if format not in _WRITERS:
+        raise ValueError("Unknown export format %s, expected one of %s" % (format, sorted(_WRITERS)))
+
+    # blocks are written as they are calculated in the current process, worker processes return all of them
+    chunk_func = _chunk_outputs if processes is None or processes <= 1 else _chunk_output_list
+    writer = _WRITERS[format](filename, date_column)
+    try:
+        for outputs in map_chunks(((chunk_func, (table_func, args, i == 0, format, dictionary_columns))
+                                   for i, (table_func, args) in enumerate(jobs)), processes):
+            for output in outputs:
+                writer.write(output)
+    finally:
+        writer.close()
+
+
+def features_chunk(grib_msgs, closest, regions, days, weather_params, forecast_offsets):
+    """
+    Weather features of validity dates in a chunk, see features.feature_table.
+
+    Args:
+        grib_msgs (pandas.DataFrame): stored messages of base dates needed by the chunk
+        days (tuple): half-open interval [start, stop) of validity dates of the chunk, only the base dates
+            of grib_msgs are exported
+    """
+    grib_msgs = derive(grib_msgs, default_params())
+    dates = np.unique(to_datetime64(grib_msgs['validDateTime']).astype('datetime64[D]'))
+    dates = dates[(dates >= days[0]) & (dates < days[1])]
+    return feature_table(grib_msgs, closest, regions, dates, weather_params, forecast_offsets)
+
+
+def tensor_chunk(grib_msgs, closest, regions, days, weather_params, forecast_offsets):
+    """
+    Dense weather features of all validity dates in a chunk, see features.feature_tensor and features_chunk.
+
+    Returns:
+        tuple: first date of the chunk and features of its dates
+    """
+    grib_msgs = derive(grib_msgs, default_params())
+    dates = np.arange(days[0], days[1], dtype='datetime64[D]')
+    return days[0], feature_tensor(grib_msgs, closest, regions, dates, weather_params, forecast_offsets)
+
+
+def qminer_chunk(grib_msgs, closest):
+    """
+    One row per message and region in QMiner format.
+
+    Args:
+        grib_msgs (pandas.DataFrame): stored messages of the chunk
+        closest (np.array(dtype=int)): grid point of each region
+    """
+    # weather features frame
+    tf = derive(grib_msgs, default_params())
+    # index on the predicted date, messages of the same time stay in the loaded order
+    tf = tf.set_index('validityDateTime', drop=False)
+    tf = tf.sort_index(kind='stable')
+    # WARNING: there is something wrong with ptype parameter
+    tf = tf[tf.shortName != 'ptype']
+    # interpolate all values
+    tf['values'] = tf['values'].apply(lambda x: x[closest])
+
+    # generate new dataframe
+    rf = pd.DataFrame()
+    rf['param'] = tf['shortName']
+    rf['timestamp'] = tf['validityDateTime']
+    rf['dayOffset'] = (tf['validityDateTime'] - tf['validDateTime']).apply(lambda x: x.days)
+
+    # generate region values
+    for i in range(len(closest)):
+        rf[str(i)] = tf['values'].apply(lambda x: x[i])
+    # transform region values from columns to rows
+    rf = pd.melt(rf, id_vars=['param', 'timestamp', 'dayOffset'], var_name='region', value_name='value')
+    rf['region'] = pd.to_numeric(rf['region'])
+
+    rf.sort_values(by=['timestamp', 'region'], kind='stable', inplace=True)
+    return rf
+
+
+def db_chunk(grib_msgs, params):
+    """
+    Blocks of rows in MariaDB format, one per base datetime and validity datetime in (date, offset) order,
+    with a row per grid point and a column per parameter.
+
+    Args:
+        grib_msgs (pandas.DataFrame): stored messages of the chunk
+        params (list): parameter columns, the same in all chunks
+
+    Yields:
+        pandas.DataFrame: block of a base datetime and validity datetime, missing parameters are nan
+    """
+    columns = ['date', 'offset', 'latitude', 'longitude'] + list(params)
+    df = derive(grib_msgs, default_params())
+    short_names = np.asarray(df['shortName'], dtype=str)
+    base = df['validDateTime'].values
+    validity = df['validityDateTime'].values
+    values, lats, lons = df['values'].values, df['lats'].values, df['lons'].values
+
+    rows = np.lexsort((validity, base))
+    rows = rows[np.isin(short_names[rows], params)]
+    if len(rows) == 0:
+        return
+    changes = np.ones(len(rows), dtype=bool)
+    changes[1:] = (base[rows[1:]] != base[rows[:-1]]) | (validity[rows[1:]] != validity[rows[:-1]])
+    bounds = np.concatenate([np.flatnonzero(changes), [len(rows)]])
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        group = rows[start:stop]
+        first = group[0]
+        n = len(lats[first])
+        offset = int((validity[first] - base[first]) // np.timedelta64(1, 'h'))
+        block = {
+            'date': np.full(n, base[first]),
+            'offset': np.full(n, offset, dtype=np.int64),
+            'latitude': np.asarray(lats[first]),
+            'longitude': np.asarray(lons[first])
+        }
+        # values of the first message of each parameter
+        names, positions = np.unique(short_names[group], return_index=True)
+        for name, row in zip(names, group[positions]):
+            block[name] = np.asarray(values[row])
+        for name in params:
+            if name not in block:
+                block[name] = np.full(n, np.nan)
+        yield pd.DataFrame(block, columns=columns)
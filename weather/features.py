@@ -0,0 +1,210 @@
+"""
+Weather features of WeatherExtractor.export.
+
+Forecasts of each validity date are described by features of every base run within the
+exported day offsets, parameter, hour window and region:
+    accumulated parameters (CUM_PARAMS): amount accumulated in the window ('cum'),
+        the difference of values at its last and first hour
+    instant parameters (INSTANT_PARAMS): minimum, mean and maximum of values in the window,
+        both window hours included
+
+Features are calculated from a stacked value matrix of the selected messages ordered by
+validity date, base datetime and parameter, with one segmented reduction per window and
+statistic instead of per-message lookups. The same features are also available as a dense
+tensor (date, day offset, parameter, region, window) for model training.
+
+Example:
+    $ features = feature_table(grib_msgs, closest, [0, 1], dates, ['2t', 'tp'], list(range(-11, 1)))
+"""
+import numpy as np
+import pandas as pd
+
+from .cube import to_datetime64
+
+FEATURE_WINDOWS = [(0, 6), (6, 12), (12, 18), (6, 18)]
+CUM_PARAMS = ['sund', 'tp', 'sf']
+INSTANT_PARAMS = ['2t', 'ws', 'rh', 'sd', 'tcc']
+INSTANT_FUNCS = ['min', 'mean', 'max']
+FEATURE_COLUMNS = ['validDate', 'dayOffset', 'region', 'shortName', 'fromHour', 'toHour', 'value', 'featureName',
+                   'aggFunc']
+
+
+def _first_at(hours, group_of, n_groups, hour):
+    """ Position of the first message at an hour of the day in each group, -1 if missing. """
+    positions = np.full(n_groups, -1, dtype=np.int64)
+    hits = np.flatnonzero(hours == hour * 3600)[::-1]
+    positions[group_of[hits]] = hits
+    return positions
+
+
+def _window_features(grib_msgs, closest, regions, dates, weather_params, forecast_offsets):
+    """
+    Statistics in each window and region of groups of messages of one validity date, base run and parameter,
+    see feature_table for arguments.
+
+    Returns:
+        tuple: parameter, validity date and day offset of each group, accumulated parameter groups,
+            available accumulated windows, accumulated values (group, window, region) and minimum,
+            mean and maximum of instant values (group, statistic, window, region), None without messages
+    """
+    short_names = np.asarray(grib_msgs['shortName'], dtype=str)
+    base = to_datetime64(grib_msgs['validDateTime'])
+    validity = to_datetime64(grib_msgs['validityDateTime'])
+    valid_day = validity.astype('datetime64[D]')
+    offsets = (base.astype('datetime64[D]') - valid_day).astype(np.int64)
+
+    params = [name for name in weather_params if name in CUM_PARAMS + INSTANT_PARAMS]
+    rows = np.flatnonzero(np.isin(short_names, params) & np.isin(valid_day, np.asarray(dates, dtype='datetime64[D]')) &
+                          np.isin(offsets, list(forecast_offsets)))
+    if len(rows) == 0:
+        return None
+    rows = rows[np.lexsort((validity[rows], short_names[rows], base[rows], valid_day[rows]))]
+    short_names, base, valid_day, offsets = short_names[rows], base[rows], valid_day[rows], offsets[rows]
+    hours = (validity[rows] - valid_day.astype('datetime64[s]')).astype(np.int64)
+    points = closest[regions]
+    values = np.array([msg_values[points] for msg_values in grib_msgs['values'].values[rows]])
+
+    # groups of messages of one validity date, base run and parameter
+    changes = np.ones(len(rows), dtype=bool)
+    changes[1:] = (valid_day[1:] != valid_day[:-1]) | (base[1:] != base[:-1]) | (short_names[1:] != short_names[:-1])
+    starts = np.flatnonzero(changes)
+    group_of = np.cumsum(changes) - 1
+    n_groups, n_windows, n_regions = len(starts), len(FEATURE_WINDOWS), len(regions)
+    group_names, group_days, group_offsets = short_names[starts], valid_day[starts], offsets[starts]
+    cum = np.isin(group_names, CUM_PARAMS)
+
+    # accumulated parameters: difference of values at the last and first hour of each window
+    cum_values = np.zeros((n_groups, n_windows, n_regions), dtype=values.dtype)
+    available = np.zeros((n_groups, n_windows), dtype=bool)
+    for w, (from_hour, to_hour) in enumerate(FEATURE_WINDOWS):
+        at_from = _first_at(hours, group_of, n_groups, from_hour)
+        at_to = _first_at(hours, group_of, n_groups, to_hour)
+        available[:, w] = cum & (at_from >= 0) & (at_to >= 0)
+        for g in np.flatnonzero(cum & ~available[:, w]):
+            print("base_date: ", base[starts[g]].astype('datetime64[D]'), " curr_date: ", group_days[g],
+                  " param_name: ", group_names[g], " at: ", from_hour if at_from[g] < 0 else to_hour, " missing!")
+        cum_values[available[:, w], w] = values[at_to[available[:, w]]] - values[at_from[available[:, w]]]
+
+    # instant parameters: minimum, mean and maximum of values in each window, nan if it is empty
+    stats = np.full((n_groups, len(INSTANT_FUNCS), n_windows, n_regions), np.nan)
+    for w, (from_hour, to_hour) in enumerate(FEATURE_WINDOWS):
+        inside = ((hours >= from_hour * 3600) & (hours <= to_hour * 3600))[:, None]
+        counts = np.add.reduceat(inside[:, 0].astype(np.int64), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.add.reduceat(np.where(inside, values, 0).astype(np.float64), starts) / counts[:, None]
+        stats[:, 0, w] = np.minimum.reduceat(np.where(inside, values, np.inf), starts)
+        stats[:, 1, w] = means.astype(values.dtype)
+        stats[:, 2, w] = np.maximum.reduceat(np.where(inside, values, -np.inf), starts)
+        stats[counts == 0, :, w] = np.nan
+    return group_names, group_days, group_offsets, cum, available, cum_values, stats
+
+
+def feature_table(grib_msgs, closest, regions, dates, weather_params, forecast_offsets):
+    """
+    Calculate weather features of forecasts made for given dates.
+
+    Args:
+        grib_msgs (pandas.DataFrame): weather messages
+        closest (np.array(dtype=int)): grid point of each region
+        regions (list): exported regions (positions in closest)
+        dates (np.array(dtype='datetime64[D]')): exported validity dates
+        weather_params (list): exported parameters, the ones without features are skipped
+        forecast_offsets (list): exported offsets of base dates from validity dates in days
+
+    Returns:
+        pandas.DataFrame: one row per feature (FEATURE_COLUMNS) ordered by validity date, base
+            datetime, parameter, statistic, window and region
+    """
+    regions = np.asarray(regions, dtype=np.int64)
+    features = _window_features(grib_msgs, closest, regions, dates, weather_params, forecast_offsets)
+    if features is None:
+        return pd.DataFrame(columns=FEATURE_COLUMNS)
+    group_names, group_days, group_offsets, cum, available, cum_values, stats = features
+    n_groups, n_windows, n_regions = len(group_names), len(FEATURE_WINDOWS), len(regions)
+
+    # feature rows of both kinds, merged in group order
+    cum_groups, cum_w, cum_r = np.nonzero(available[:, :, None].repeat(n_regions, axis=2))
+    block = len(INSTANT_FUNCS) * n_windows * n_regions
+    inst_groups = np.flatnonzero(~cum).repeat(block)
+    local = np.tile(np.arange(block), (~cum).sum())
+    inst_f, inst_w, inst_r = local // (n_windows * n_regions), local // n_regions % n_windows, local % n_regions
+
+    groups = np.concatenate([cum_groups, inst_groups])
+    windows = np.concatenate([cum_w, inst_w])
+    region_idx = np.concatenate([cum_r, inst_r])
+    value = np.concatenate([cum_values[cum_groups, cum_w, cum_r], stats[inst_groups, inst_f, inst_w, inst_r]])
+    agg_funcs = np.concatenate([np.full(len(cum_groups), 'cum', dtype=object),
+                                np.asarray(INSTANT_FUNCS, dtype=object)[inst_f]])
+
+    # feature names: prefix of each group and suffix of each statistic, window and region
+    prefixes = np.array(['WEATHERFC%s%03d%s' % ('+' if offset >= 0 else '-', abs(offset), name)
+                         for offset, name in zip(group_offsets, group_names)], dtype=object)
+    cum_suffixes = np.array(['%03dCUM%02d-%02d' % (reg, from_hour, to_hour) for from_hour, to_hour in FEATURE_WINDOWS
+                             for reg in regions], dtype=object)
+    inst_suffixes = np.array(['%03d%s%02d-%02d' % (reg, func.upper(), from_hour, to_hour) for func in INSTANT_FUNCS
+                              for from_hour, to_hour in FEATURE_WINDOWS for reg in regions], dtype=object)
+    suffixes = np.concatenate([cum_suffixes[cum_w * n_regions + cum_r],
+                               inst_suffixes[(inst_f * n_windows + inst_w) * n_regions + inst_r]])
+
+    order = np.argsort(groups, kind='stable')
+    groups = groups[order]
+    windows = windows[order]
+    return pd.DataFrame({
+        'validDate': group_days[groups].astype(object),
+        'dayOffset': group_offsets[groups],
+        'region': regions[region_idx[order]],
+        'shortName': group_names[groups].astype(object),
+        'fromHour': np.asarray(FEATURE_WINDOWS)[windows, 0],
+        'toHour': np.asarray(FEATURE_WINDOWS)[windows, 1],
+        'value': value[order],
+        'featureName': prefixes[groups] + suffixes[order],
+        'aggFunc': agg_funcs[order]
+    }, columns=FEATURE_COLUMNS)
+
+
+def tensor_features(weather_params):
+    """ (parameter, statistic) of each position on the parameter axis of feature tensors. """
+    features = []
+    for name in weather_params:
+        if name in CUM_PARAMS:
+            features.append((name, 'cum'))
+        elif name in INSTANT_PARAMS:
+            features.extend((name, func) for func in INSTANT_FUNCS)
+    return features
+
+
+def feature_tensor(grib_msgs, closest, regions, dates, weather_params, forecast_offsets):
+    """
+    Calculate weather features of forecasts made for given dates as a dense tensor, see feature_table
+    for arguments. Features of a day offset are the ones of the latest base run of the day.
+
+    Returns:
+        np.array(dtype=float): features (date, day offset, parameter, region, window) with
+            parameters of tensor_features, nan if missing
+    """
+    features = tensor_features(weather_params)
+    tensor = np.full((len(dates), len(forecast_offsets), len(features), len(regions), len(FEATURE_WINDOWS)), np.nan)
+    groups = _window_features(grib_msgs, closest, np.asarray(regions, dtype=np.int64), dates, weather_params,
+                              forecast_offsets)
+    if groups is None:
+        return tensor
+    group_names, group_days, group_offsets, cum, available, cum_values, stats = groups
+
+    position = dict((feature, i) for i, feature in enumerate(features))
+    offset_position = dict((offset, i) for i, offset in enumerate(forecast_offsets))
+    at_date = np.searchsorted(np.asarray(dates, dtype='datetime64[D]'), group_days)
+    at_offset = np.array([offset_position[offset] for offset in group_offsets], dtype=np.int64)
+
+    # groups are ordered by base datetime within each date, keep the last group of each date, offset and parameter
+    names, at_name = np.unique(group_names, return_inverse=True)
+    keys = (at_date * len(forecast_offsets) + at_offset) * len(names) + at_name
+    latest = np.zeros(len(keys), dtype=bool)
+    latest[len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]] = True
+    cum_groups, inst_groups = np.flatnonzero(cum & latest), np.flatnonzero(~cum & latest)
+    cum_values = np.where(available[:, :, None], cum_values, np.nan)
+    at_param = [position[(name, 'cum')] for name in group_names[cum_groups]]
+    tensor[at_date[cum_groups], at_offset[cum_groups], at_param] = cum_values[cum_groups].swapaxes(1, 2)
+    for f, func in enumerate(INSTANT_FUNCS):
+        at_param = [position[(name, func)] for name in group_names[inst_groups]]
+        tensor[at_date[inst_groups], at_offset[inst_groups], at_param] = stats[inst_groups, f].swapaxes(1, 2)
+    return tensor
@@ -0,0 +1,691 @@
+"""
+Decoding of GRIB files into blocks of weather messages.
+
+Each file is decoded into a MessageBlock holding message metadata as parallel arrays,
+the values of all messages as one matrix and the grid shared by the messages.
+Several files can be decoded in parallel worker processes, in which case the decoded
+values are handed back to the calling process through shared memory.
+
+A GribIndex records the byte offset and header keys of each message of a file. It is
+stored in a sidecar file next to the GRIB file and allows decoding single messages on demand.
+
+Supported decoders:
+    * 'codes': low-level ecCodes API reading only the needed keys and decoding values of kept
+      messages straight into a preallocated float32 matrix
+    * 'eccodes': ecCodes high-level interface (GribFile, or FileReader in newer versions)
+    * 'pygrib': pygrib interface
+"""
+from __future__ import print_function
+import datetime
+import mmap
+import os
+
+import numpy as np
+import pandas as pd
+
+from .cube import FRAME_COLUMNS, object_array
+from .spatial import bbox_borders
+
+# suffix of the sidecar index file stored next to the GRIB file
+INDEX_SUFFIX = '.index.npz'
+
+# grid geometry (lats, lons) by hash of the GRIB grid section
+_GRIDS = {}
+_GRIDS_SIZE = 16
+
+
+def default_decoder():
+    """ Name of the preferred installed GRIB decoder. """
+    try:
+        import eccodes
+        return 'codes'
+    except ImportError:
+        import pygrib
+        return 'pygrib'
+
+
+def _str_to_datetime(val):
+    """ Convert datetime string 'YYYYMMDDHHMM' to datetime object. """
+    tmp_date = datetime.date(int(val[:4]), int(val[4:6]), int(val[6:8]))
+
+    time_str = val[8:]
+    assert len(time_str) in [1, 3, 4]
+    if len(time_str) == 1:
+        # midnight - only one number
+        return datetime.datetime.combine(tmp_date, datetime.time(int(time_str)))
+    elif len(time_str) == 3:
+        # hmm format
+        return datetime.datetime.combine(tmp_date, datetime.time(int(time_str[:1]), int(time_str[1:])))
+    elif len(time_str) == 4:
+        # hhmm format
+        return datetime.datetime.combine(tmp_date, datetime.time(int(time_str[:2]), int(time_str[2:])))
+
+
+def _int_to_datetime(date, time):
+    """ Convert integer date YYYYMMDD and time HHMM keys to datetime object. """
+    return datetime.datetime(date // 10000, date // 100 % 100, date % 100, time // 100, time % 100)
+
+
+class MessageFilter:
+    """
+    Selection of weather messages applied while decoding GRIB files.
+
+    Messages are accepted or skipped from their header keys alone, before their values are
+    decoded, and the values of accepted messages are cropped to the bounding box.
+
+    Args:
+        params (list): parameter short names to keep, all if None
+        base_dates (tuple): (from_date, to_date) window of base dates to keep (both inclusive), all if None
+        steps (list): forecast steps in hours (validity - base datetime) to keep, all if None
+        bbox ([[lat1,lon1], [lat2,lon2]]): corner points of the area the values are cropped to, whole grid if None
+    """
+
+    def __init__(self, params=None, base_dates=None, steps=None, bbox=None):
+        self.params = None if params is None else set(params)
+        self.base_dates = None
+        if base_dates is not None:
+            assert len(base_dates) == 2 and base_dates[0] <= base_dates[1], "expecting a (from_date, to_date) window"
+            self.base_dates = tuple(base_dates)
+        self.steps = None if steps is None else set(steps)
+        self.bbox = None if bbox is None else bbox_borders(bbox)
+
+    def keep_mask(self, short_names, base_times, validity_times):
+        """ Vectorized .keep(...) over arrays of header keys (validity and base times as datetime64[s]). """
+        keep = np.ones(len(short_names), dtype=bool)
+        if self.params is not None:
+            keep &= np.isin(short_names, list(self.params))
+        if self.base_dates is not None:
+            base_days = base_times.astype('datetime64[D]')
+            keep &= (base_days >= np.datetime64(self.base_dates[0])) & (base_days <= np.datetime64(self.base_dates[1]))
+        if self.steps is not None:
+            steps = (validity_times - base_times) / np.timedelta64(1, 'h')
+            keep &= np.isin(steps, list(self.steps))
+        return keep
+
+    def keep(self, short_name, base_time, validity_time):
+        """ Check if a message with given header keys is selected. """
+        if self.params is not None and short_name not in self.params:
+            return False
+        if self.base_dates is not None and not self.base_dates[0] <= base_time.date() <= self.base_dates[1]:
+            return False
+        if self.steps is not None and (validity_time - base_time).total_seconds() / 3600. not in self.steps:
+            return False
+        return True
+
+    def crop_mask(self, lats, lons):
+        """ Mask of grid points inside the bounding box, None if values are not cropped. """
+        if self.bbox is None:
+            return None
+        min_lat, max_lat, min_lon, max_lon = self.bbox
+        mask = (min_lat <= lats) & (lats <= max_lat) & (min_lon <= lons) & (lons <= max_lon)
+        assert mask.any(), "bounding box contains no points"
+        return mask
+
+    def filter_frame(self, grib_msgs):
+        """ Apply the selection to already decoded messages. """
+        if self.params is None and self.base_dates is None and self.steps is None and self.bbox is None:
+            return grib_msgs
+
+        keep = np.ones(len(grib_msgs), dtype=bool)
+        base = pd.to_datetime(grib_msgs['validDateTime'])
+        if self.params is not None:
+            keep &= grib_msgs['shortName'].isin(self.params).values
+        if self.base_dates is not None:
+            keep &= ((base.dt.date >= self.base_dates[0]) & (base.dt.date <= self.base_dates[1])).values
+        if self.steps is not None:
+            steps = (pd.to_datetime(grib_msgs['validityDateTime']) - base).dt.total_seconds() / 3600.
+            keep &= steps.isin(self.steps).values
+        grib_msgs = grib_msgs[keep].reset_index(drop=True)
+
+        if self.bbox is not None and len(grib_msgs) > 0:
+            lats, lons = np.asarray(grib_msgs['lats'].iloc[0]), np.asarray(grib_msgs['lons'].iloc[0])
+            mask = self.crop_mask(lats, lons)
+            n = len(grib_msgs)
+            grib_msgs['values'] = object_array(np.asarray(values)[mask] for values in grib_msgs['values'])
+            grib_msgs['lats'] = object_array([lats[mask]] * n)
+            grib_msgs['lons'] = object_array([lons[mask]] * n)
+        return grib_msgs
+
+
+class MessageBlock:
+    """
+    Weather messages decoded from one GRIB file.
+
+    Attributes:
+        short_names (np.array(dtype=object)): parameter short name of each message
+        base_times (np.array(dtype=datetime64[s])): base datetime of each message (forecast made)
+        validity_times (np.array(dtype=datetime64[s])): validity datetime of each message
+        types (np.array(dtype=object)): mars type of each message (forecast or actual)
+        values (np.array(dtype=float)): message values, one message per row
+        lats, lons (np.array(dtype=float)): grid shared by all messages
+    """
+
+    def __init__(self, short_names, base_times, validity_times, types, values, lats, lons):
+        self.short_names = np.asarray(short_names, dtype=object)
+        self.base_times = np.asarray(base_times, dtype='datetime64[s]')
+        self.validity_times = np.asarray(validity_times, dtype='datetime64[s]')
+        self.types = np.asarray(types, dtype=object)
+        self.values = values
+        self.lats = lats
+        self.lons = lons
+
+    def __len__(self):
+        return len(self.short_names)
+
+    def to_frame(self):
+        """ Weather messages as pandas.DataFrame with one row per message. """
+        n = len(self)
+        return pd.DataFrame({
+            'shortName': self.short_names,
+            'values': object_array(self.values),
+            'validDateTime': pd.to_datetime(self.base_times),
+            'validityDateTime': pd.to_datetime(self.validity_times),
+            'lats': object_array([self.lats] * n),
+            'lons': object_array([self.lons] * n),
+            'type': self.types
+        }, columns=FRAME_COLUMNS)
+
+
+def _stack(values, n_points):
+    """ Stack message values into a matrix, also for files without messages. """
+    return np.vstack(values) if len(values) > 0 else np.zeros((0, n_points))
+
+
+def _codes_grid(gid):
+    """ Grid geometry of a message, computed once per distinct grid. """
+    import eccodes
+
+    key = eccodes.codes_get_string(gid, 'md5GridSection')
+    grid = _GRIDS.get(key)
+    if grid is None:
+        if len(_GRIDS) >= _GRIDS_SIZE:
+            _GRIDS.clear()
+        grid = (eccodes.codes_get_array(gid, 'latitudes'), eccodes.codes_get_array(gid, 'longitudes'))
+        _GRIDS[key] = grid
+    return grid
+
+
+def _decode_codes(filepath, msg_filter=None):
+    """
+    Decode a GRIB file with the low-level ecCodes API. Header keys of all messages are read first,
+    then the values of kept messages are decoded straight into one preallocated float32 matrix.
+    """
+    import eccodes
+
+    headers, grid_section = [], None
+    with open(filepath, 'rb') as f:
+        while True:
+            # header keys are read without the data section
+            gid = eccodes.codes_grib_new_from_file(f, headers_only=True)
+            if gid is None:
+                break
+            try:
+                short_name = eccodes.codes_get_string(gid, 'shortName')
+                base_time = _int_to_datetime(eccodes.codes_get_long(gid, 'dataDate'),
+                                             eccodes.codes_get_long(gid, 'dataTime'))
+                validity_time = _int_to_datetime(eccodes.codes_get_long(gid, 'validityDate'),
+                                                 eccodes.codes_get_long(gid, 'validityTime'))
+                if msg_filter is not None and not msg_filter.keep(short_name, base_time, validity_time):
+                    continue
+
+                # messages of a file share the grid of the first kept message
+                section = eccodes.codes_get_string(gid, 'md5GridSection')
+                if grid_section is None:
+                    grid_section = section
+                elif section != grid_section:
+                    raise ValueError("GRIB file %s contains messages on different grids" % filepath)
+                headers.append((short_name, base_time, validity_time,
+                                eccodes.codes_get_string(gid, 'marsType'),  # forecast or actual
+                                eccodes.codes_get_long(gid, 'offset'), eccodes.codes_get_long(gid, 'totalLength')))
+            finally:
+                eccodes.codes_release(gid)
+
+        lats, lons, mask = np.zeros(0), np.zeros(0), None
+        values = np.zeros((0, 0), dtype=np.float32)
+        for row, header in enumerate(headers):
+            f.seek(header[4])
+            gid = eccodes.codes_new_from_message(f.read(header[5]))
+            try:
+                if row == 0:
+                    lats, lons = _codes_grid(gid)
+                    if msg_filter is not None:
+                        mask = msg_filter.crop_mask(lats, lons)
+                    if mask is not None:
+                        lats, lons = lats[mask], lons[mask]
+                    values = np.empty((len(headers), len(lats)), dtype=np.float32)
+                msg_values = eccodes.codes_get_float_array(gid, 'values')
+                values[row] = msg_values if mask is None else msg_values[mask]
+            finally:
+                eccodes.codes_release(gid)
+
+    short_names, base_times, validity_times, types = ([header[i] for header in headers] for i in range(4))
+    return MessageBlock(short_names, base_times, validity_times, types, values, lats, lons)
+
+
+def _eccodes_messages(filepath):
+    """ Messages of a GRIB file read with the ecCodes GribFile interface, or FileReader in newer versions. """
+    import eccodes
+
+    if hasattr(eccodes, 'GribFile'):
+        grbs = eccodes.GribFile(filepath)
+        try:
+            for i in range(len(grbs)):
+                yield grbs.next()
+        finally:
+            grbs.close()
+    else:
+        with eccodes.FileReader(filepath) as reader:
+            for grib_msg in reader:
+                yield grib_msg
+
+
+def _decode_eccodes(filepath, msg_filter=None):
+    """ Decode a GRIB file with the ecCodes high-level interface. """
+    short_names, base_times, validity_times, types, values = [], [], [], [], []
+    lats, lons, mask = None, None, None
+
+    for grib_msg in _eccodes_messages(filepath):
+        # header keys are read without decoding the data section
+        short_name = grib_msg['shortName']
+        base_time = _str_to_datetime(str(grib_msg['date']) + str(grib_msg['time']))
+        validity_time = _str_to_datetime(str(grib_msg['validityDate']) + str(grib_msg['validityTime']))
+        if msg_filter is not None and not msg_filter.keep(short_name, base_time, validity_time):
+            continue
+
+        if lats is None:
+            lats = grib_msg['latitudes'].flatten()
+            lons = grib_msg['longitudes'].flatten()
+            if msg_filter is not None:
+                mask = msg_filter.crop_mask(lats, lons)
+            if mask is not None:
+                lats, lons = lats[mask], lons[mask]
+
+        msg_values = grib_msg['values'].flatten()
+        short_names.append(short_name)
+        values.append(msg_values if mask is None else msg_values[mask])
+        base_times.append(base_time)
+        validity_times.append(validity_time)
+        types.append(grib_msg['marsType'])  # forecast or actual
+
+    if lats is None:
+        lats, lons = np.zeros(0), np.zeros(0)
+    return MessageBlock(short_names, base_times, validity_times, types, _stack(values, len(lats)), lats, lons)
+
+
+def _decode_pygrib(filepath, msg_filter=None):
+    """ Decode a GRIB file with pygrib. """
+    import pygrib
+
+    short_names, base_times, validity_times, types, values = [], [], [], [], []
+
+    grbs = pygrib.open(filepath)
+    if grbs.messages == 0:
+        grbs.close()
+        return MessageBlock([], [], [], [], np.zeros((0, 0)), np.zeros(0), np.zeros(0))
+
+    lats, lons = grbs.message(1).latlons()
+    lats, lons = lats.flatten(), lons.flatten()
+    mask = None if msg_filter is None else msg_filter.crop_mask(lats, lons)
+    if mask is not None:
+        lats, lons = lats[mask], lons[mask]
+
+    grbs.rewind()
+    for grib_msg in grbs:
+        # header keys are read without decoding the data section
+        short_name = grib_msg.shortName
+        base_time = grib_msg.analDate
+        validity_time = _str_to_datetime(str(grib_msg.validityDate) + str(grib_msg.validityTime))
+        if msg_filter is not None and not msg_filter.keep(short_name, base_time, validity_time):
+            continue
+
+        msg_values = grib_msg.values.flatten()
+        short_names.append(short_name)
+        values.append(msg_values if mask is None else msg_values[mask])
+        base_times.append(base_time)
+        validity_times.append(validity_time)
+        types.append(grib_msg.marsType)  # forecast or actual
+    grbs.close()
+
+    return MessageBlock(short_names, base_times, validity_times, types, _stack(values, len(lats)), lats, lons)
+
+
+def decode_file(filepath, decoder, msg_filter=None):
+    """
+    Decode messages of a GRIB file.
+
+    Args:
+        filepath (str): path to the GRIB file
+        decoder (str): 'codes', 'eccodes' or 'pygrib'
+        msg_filter (MessageFilter): selection of decoded messages, all messages if None
+
+    Returns:
+        MessageBlock: decoded messages
+    """
+    if decoder == 'codes':
+        return _decode_codes(filepath, msg_filter)
+    elif decoder == 'eccodes':
+        return _decode_eccodes(filepath, msg_filter)
+    elif decoder == 'pygrib':
+        return _decode_pygrib(filepath, msg_filter)
+    raise ValueError("GRIB decoder %s not recognized" % decoder)
+
+
+def _decode_to_shared_memory(filepath, decoder, msg_filter):
+    """
+    Decode a GRIB file in a worker process. Values are written to a new shared memory
+    segment, the rest of the block (small metadata arrays) is returned by pickling.
+    The calling process owns the segment and unlinks it.
+    """
+    from multiprocessing import resource_tracker, shared_memory
+
+    block = decode_file(filepath, decoder, msg_filter)
+    values, block.values = block.values, None
+
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[...] = values
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    # the resource tracker of the worker would unlink the segment again (or warn about it) at exit
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return block, (shm.name, values.shape, values.dtype.str)
+
+
+def _take_from_shared_memory(name, shape, dtype):
+    """ Copy values out of a shared memory segment and release the segment. """
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _discard_shared_memory(future):
+    """ Release the shared memory segment of a file decoded by a worker whose values are not taken. """
+    from multiprocessing import shared_memory
+
+    if future.cancel():
+        return
+    try:
+        _, (name, _, _) = future.result()
+        shm = shared_memory.SharedMemory(name=name)
+    except Exception:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def decode_files(filepaths, decoder, processes=None, msg_filter=None):
+    """
+    Decode GRIB files, optionally in parallel worker processes.
+
+    Args:
+        filepaths (list): paths to GRIB files
+        decoder (str): 'codes', 'eccodes' or 'pygrib'
+        processes (int): number of worker processes, files are decoded in the current process if None or 1
+        msg_filter (MessageFilter): selection of decoded messages, all messages if None
+
+    Returns:
+        list: decoded MessageBlock for each file in the given order
+    """
+    if processes is None or processes <= 1 or len(filepaths) <= 1:
+        return [decode_file(filepath, decoder, msg_filter) for filepath in filepaths]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    blocks, error, taken = [], None, 0
+    with ProcessPoolExecutor(max_workers=min(processes, len(filepaths))) as executor:
+        futures = [executor.submit(_decode_to_shared_memory, filepath, decoder, msg_filter) for filepath in filepaths]
+        try:
+            # collect all results so that no shared memory segment is leaked if one of the files fails
+            for future in futures:
+                taken += 1
+                try:
+                    block, shared = future.result()
+                    block.values = _take_from_shared_memory(*shared)
+                    blocks.append(block)
+                except Exception as err:
+                    error = error or err
+        finally:
+            # segments of files not taken when collecting is interrupted
+            for future in futures[taken:]:
+                _discard_shared_memory(future)
+    if error is not None:
+        raise error
+    return blocks
+
+
+def _scan_codes(filepath):
+    """ Header keys and total length of each message and the grid of a GRIB file, read with low-level ecCodes. """
+    import eccodes
+
+    headers, lats, lons = [], np.zeros(0), np.zeros(0)
+    with open(filepath, 'rb') as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                if len(headers) == 0:
+                    lats, lons = _codes_grid(gid)
+                headers.append((eccodes.codes_get_string(gid, 'shortName'),
+                                _int_to_datetime(eccodes.codes_get_long(gid, 'dataDate'),
+                                                 eccodes.codes_get_long(gid, 'dataTime')),
+                                _int_to_datetime(eccodes.codes_get_long(gid, 'validityDate'),
+                                                 eccodes.codes_get_long(gid, 'validityTime')),
+                                eccodes.codes_get_string(gid, 'marsType'),
+                                eccodes.codes_get_long(gid, 'totalLength')))
+            finally:
+                eccodes.codes_release(gid)
+    return headers, lats, lons
+
+
+def _scan_eccodes(filepath):
+    """ Header keys and total length of each message and the grid of a GRIB file, read with ecCodes. """
+    headers, lats, lons = [], np.zeros(0), np.zeros(0)
+    for i, grib_msg in enumerate(_eccodes_messages(filepath)):
+        if i == 0:
+            lats = grib_msg['latitudes'].flatten()
+            lons = grib_msg['longitudes'].flatten()
+        headers.append((grib_msg['shortName'],
+                        _str_to_datetime(str(grib_msg['date']) + str(grib_msg['time'])),
+                        _str_to_datetime(str(grib_msg['validityDate']) + str(grib_msg['validityTime'])),
+                        grib_msg['marsType'],
+                        grib_msg['totalLength']))
+    return headers, lats, lons
+
+
+def _scan_pygrib(filepath):
+    """ Header keys and total length of each message and the grid of a GRIB file, read with pygrib. """
+    import pygrib
+
+    headers, lats, lons = [], np.zeros(0), np.zeros(0)
+    grbs = pygrib.open(filepath)
+    if grbs.messages > 0:
+        lats, lons = grbs.message(1).latlons()
+        lats, lons = lats.flatten(), lons.flatten()
+        grbs.rewind()
+    for grib_msg in grbs:
+        headers.append((grib_msg.shortName,
+                        grib_msg.analDate,
+                        _str_to_datetime(str(grib_msg.validityDate) + str(grib_msg.validityTime)),
+                        grib_msg.marsType,
+                        grib_msg['totalLength']))
+    grbs.close()
+    return headers, lats, lons
+
+
+def _decode_message(data, decoder):
+    """ Decode values of a single GRIB message given as bytes. """
+    if decoder in ['codes', 'eccodes']:
+        import eccodes
+        gid = eccodes.codes_new_from_message(data)
+        try:
+            return eccodes.codes_get_float_array(gid, 'values') if decoder == 'codes' else eccodes.codes_get_values(gid)
+        finally:
+            eccodes.codes_release(gid)
+    elif decoder == 'pygrib':
+        import pygrib
+        return pygrib.fromstring(data).values.flatten()
+    raise ValueError("GRIB decoder %s not recognized" % decoder)
+
+
+class GribIndex:
+    """
+    Byte offsets and header keys of all messages of a GRIB file.
+
+    Attributes:
+        filepath (str): path to the GRIB file
+        file_size (int): size of the indexed GRIB file in bytes, used to detect stale indices
+        file_mtime (int): modification time of the indexed GRIB file in nanoseconds, used to detect
+            stale indices of rewritten files of the same size, None if unknown
+        offsets, lengths (np.array(dtype=int64)): byte offset and length of each message
+        short_names (np.array(dtype=str)): parameter short name of each message
+        base_times (np.array(dtype=datetime64[s])): base datetime of each message (forecast made)
+        validity_times (np.array(dtype=datetime64[s])): validity datetime of each message
+        types (np.array(dtype=str)): mars type of each message (forecast or actual)
+        lats, lons (np.array(dtype=float)): grid shared by all messages
+    """
+
+    def __init__(self, filepath, file_size, offsets, lengths, short_names, base_times, validity_times, types,
+                 lats, lons, file_mtime=None):
+        self.filepath = filepath
+        self.file_size = int(file_size)
+        self.file_mtime = None if file_mtime is None else int(file_mtime)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.short_names = np.asarray(short_names, dtype=str)
+        self.base_times = np.asarray(base_times, dtype='datetime64[s]')
+        self.validity_times = np.asarray(validity_times, dtype='datetime64[s]')
+        self.types = np.asarray(types, dtype=str)
+        self.lats = lats
+        self.lons = lons
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def index_path(filepath):
+        """ Path of the sidecar index file of a GRIB file. """
+        return filepath + INDEX_SUFFIX
+
+    @classmethod
+    def build(cls, filepath, decoder):
+        """
+        Index a GRIB file by reading the message headers, values are not decoded.
+
+        Args:
+            filepath (str): path to the GRIB file
+            decoder (str): 'codes', 'eccodes' or 'pygrib'
+
+        Returns:
+            GribIndex: index of the file
+        """
+        if decoder == 'codes':
+            headers, lats, lons = _scan_codes(filepath)
+        elif decoder == 'eccodes':
+            headers, lats, lons = _scan_eccodes(filepath)
+        elif decoder == 'pygrib':
+            headers, lats, lons = _scan_pygrib(filepath)
+        else:
+            raise ValueError("GRIB decoder %s not recognized" % decoder)
+
+        # messages follow each other, possibly with padding in between
+        offsets, pos = [], 0
+        stat = os.stat(filepath)
+        file_size = stat.st_size
+        if file_size > 0:
+            with open(filepath, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for header in headers:
+                        pos = data.find(b'GRIB', pos)
+                        assert pos >= 0, "message not found in %s" % filepath
+                        offsets.append(pos)
+                        pos += header[4]
+                finally:
+                    data.close()
+
+        short_names, base_times, validity_times, types, lengths = zip(*headers) if headers else ([],) * 5
+        return cls(filepath, file_size, offsets, lengths, short_names, base_times, validity_times, types, lats, lons,
+                   file_mtime=stat.st_mtime_ns)
+
+    def save(self, index_path=None):
+        """ Store the index to a .npz file, by default to the sidecar file next to the GRIB file. """
+        if index_path is None:
+            index_path = GribIndex.index_path(self.filepath)
+        with open(index_path, 'wb') as f:
+            np.savez(f, file_size=np.array(self.file_size),
+                     file_mtime=np.array(-1 if self.file_mtime is None else self.file_mtime, dtype=np.int64),
+                     offsets=self.offsets, lengths=self.lengths,
+                     short_names=self.short_names, base_times=self.base_times,
+                     validity_times=self.validity_times, types=self.types, lats=self.lats, lons=self.lons)
+
+    @classmethod
+    def load(cls, filepath, index_path=None):
+        """ Load the index of a GRIB file stored with GribIndex.save. """
+        if index_path is None:
+            index_path = GribIndex.index_path(filepath)
+        with np.load(index_path, allow_pickle=False) as data:
+            # indices stored without the modification time are never current
+            file_mtime = data['file_mtime'][()] if 'file_mtime' in data.files else -1
+            return cls(filepath, data['file_size'][()], data['offsets'], data['lengths'], data['short_names'],
+                       data['base_times'], data['validity_times'], data['types'], data['lats'], data['lons'],
+                       file_mtime=None if file_mtime < 0 else file_mtime)
+
+    def is_current(self):
+        """ Check if the indexed GRIB file was not changed since it was indexed (same size and modification time). """
+        stat = os.stat(self.filepath)
+        return self.file_size == stat.st_size and self.file_mtime == stat.st_mtime_ns
+
+    @classmethod
+    def open(cls, filepath, decoder=None):
+        """
+        Load the sidecar index of a GRIB file, or build it and try to store it if it is
+        missing or does not match the size and modification time of the file.
+
+        Args:
+            filepath (str): path to the GRIB file
+            decoder (str): 'codes', 'eccodes' or 'pygrib', preferred installed decoder if None
+
+        Returns:
+            GribIndex: index of the file
+        """
+        index_path = GribIndex.index_path(filepath)
+        if os.path.exists(index_path):
+            index = cls.load(filepath, index_path)
+            if index.is_current():
+                return index
+
+        index = cls.build(filepath, decoder or default_decoder())
+        try:
+            index.save(index_path)
+        except (IOError, OSError):
+            print("Could not store GRIB index to %s" % index_path)
+        return index
+
+    def read_values(self, indices, decoder=None):
+        """
+        Decode values of the given messages.
+
+        Args:
+            indices (np.array(dtype=int)): positions of the messages in the index
+            decoder (str): 'codes', 'eccodes' or 'pygrib', preferred installed decoder if None
+
+        Returns:
+            list: values of each message as 1D array
+        """
+        decoder = decoder or default_decoder()
+        values = [None] * len(indices)
+        with open(self.filepath, 'rb') as f:
+            # read the messages in file order
+            for i in np.argsort(self.offsets[indices], kind='stable'):
+                f.seek(self.offsets[indices[i]])
+                values[i] = _decode_message(f.read(self.lengths[indices[i]]), decoder)
+        return values
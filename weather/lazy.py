@@ -0,0 +1,191 @@
+"""
+Lazy storage of weather messages backed by GRIB sidecar indices.
+
+Only message header keys are kept in memory. Values are decoded from the GRIB files the
+first time a query touches a message and kept in a bounded least recently used cache,
+so memory tracks the queried working set instead of the size of the files.
+"""
+from collections import OrderedDict
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .cube import FRAME_COLUMNS, object_array
+
+# default number of decoded messages kept in memory
+_FIELD_CACHE_SIZE = 4096
+
+
+class FieldCache:
+    """
+    Cache of decoded message values keyed by (file, message) position.
+    The least recently used values are dropped when the cache is full.
+    The cache can be shared by threads.
+    """
+
+    def __init__(self, max_size=_FIELD_CACHE_SIZE):
+        self.max_size = max_size
+        self._fields = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, key):
+        """ Get cached values or None. """
+        with self._lock:
+            values = self._fields.pop(key, None)
+            if values is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._fields[key] = values
+            return values
+
+    def put(self, key, values):
+        with self._lock:
+            self._fields[key] = values
+            while len(self._fields) > self.max_size:
+                self._fields.popitem(last=False)
+
+    def discard(self, match):
+        """ Drop cached values with keys matching a predicate. """
+        with self._lock:
+            for key in [key for key in self._fields if match(key)]:
+                del self._fields[key]
+
+    def clear(self):
+        with self._lock:
+            self._fields.clear()
+
+
+class LazyMessages:
+    """
+    Weather messages of indexed GRIB files with values decoded on demand.
+
+    Args:
+        decoder (str): 'codes', 'eccodes' or 'pygrib'
+        cache_size (int): maximal number of decoded messages kept in memory
+        mask (np.array(dtype=bool)): grid points values are cropped to, whole grid if None
+
+    Attributes:
+        indices (list): GribIndex of each added file
+        short_names, base_times, validity_times, types (np.array): header keys of all messages
+        lats, lons (np.array(dtype=float)): grid shared by all messages (cropped to the mask)
+    """
+
+    def __init__(self, decoder, cache_size=_FIELD_CACHE_SIZE, mask=None):
+        self.decoder = decoder
+        self.mask = mask
+        self.cache = FieldCache(cache_size)
+        self.indices = []
+        self.lats, self.lons = None, None
+        self._file = np.zeros(0, dtype=np.int64)
+        self._position = np.zeros(0, dtype=np.int64)
+        self.short_names = np.zeros(0, dtype=str)
+        self.base_times = np.zeros(0, dtype='datetime64[s]')
+        self.validity_times = np.zeros(0, dtype='datetime64[s]')
+        self.types = np.zeros(0, dtype=str)
+
+    def __len__(self):
+        return len(self._file)
+
+    def add(self, index, keep=None):
+        """
+        Add messages of an indexed GRIB file. New messages replace loaded messages with the same
+        base datetime, validity datetime and parameter.
+
+        Args:
+            index (GribIndex): index of the file
+            keep (np.array(dtype=bool)): messages of the file to add, all if None
+
+        Returns:
+            int: number of added messages, they follow the kept loaded messages
+        """
+        positions = np.arange(len(index)) if keep is None else np.nonzero(keep)[0]
+        if len(positions) == 0:
+            return 0
+
+        lats, lons = index.lats, index.lons
+        if self.mask is not None:
+            lats, lons = lats[self.mask], lons[self.mask]
+        if self.lats is None:
+            self.lats, self.lons = lats, lons
+        elif not (np.array_equal(self.lats, lats) and np.array_equal(self.lons, lons)):
+            raise ValueError("GRIB file %s has a different grid than already loaded files" % index.filepath)
+
+        if len(self) > 0:
+            new_keys = pd.MultiIndex.from_arrays([index.base_times[positions], index.validity_times[positions],
+                                                  index.short_names[positions]])
+            replaced = pd.MultiIndex.from_arrays([self.base_times, self.validity_times, self.short_names]).isin(new_keys)
+            if replaced.any():
+                self._drop(replaced)
+
+        self.indices.append(index)
+        self._file = np.concatenate([self._file, np.full(len(positions), len(self.indices) - 1, dtype=np.int64)])
+        self._position = np.concatenate([self._position, positions])
+        self.short_names = np.concatenate([self.short_names, index.short_names[positions]])
+        self.base_times = np.concatenate([self.base_times, index.base_times[positions]])
+        self.validity_times = np.concatenate([self.validity_times, index.validity_times[positions]])
+        self.types = np.concatenate([self.types, index.types[positions]])
+        return len(positions)
+
+    def _drop(self, drop):
+        """ Drop messages (and their cached values) given by a mask. """
+        dropped = set(zip(self._file[drop], self._position[drop]))
+        self.cache.discard(lambda key: key in dropped)
+        keep = ~drop
+        self._file, self._position = self._file[keep], self._position[keep]
+        self.short_names, self.types = self.short_names[keep], self.types[keep]
+        self.base_times, self.validity_times = self.base_times[keep], self.validity_times[keep]
+
+    def values(self, rows):
+        """ Values of the given messages, decoding the ones that are not cached. """
+        values = [self.cache.get((self._file[row], self._position[row])) for row in rows]
+        missing = np.array([i for i, v in enumerate(values) if v is None], dtype=np.int64)
+        for file_idx in np.unique(self._file[rows[missing]]):
+            missing_in_file = missing[self._file[rows[missing]] == file_idx]
+            positions = self._position[rows[missing_in_file]]
+            decoded = self.indices[file_idx].read_values(positions, self.decoder)
+            for i, position, msg_values in zip(missing_in_file, positions, decoded):
+                if self.mask is not None:
+                    msg_values = msg_values[self.mask]
+                self.cache.put((file_idx, position), msg_values)
+                values[i] = msg_values
+        return values
+
+    def select(self, base_range, validity_range=None, same_day=False):
+        """
+        Select messages as a frame of weather messages, see WeatherCube.select for arguments.
+
+        Returns:
+            pandas.DataFrame: selected messages ordered by base datetime, validity datetime and parameter
+        """
+        base_range = np.asarray(base_range, dtype='datetime64[s]')
+        keep = (self.base_times >= base_range[0]) & (self.base_times < base_range[1])
+        if validity_range is not None:
+            v_start, v_stop = np.asarray(validity_range, dtype='datetime64[s]')
+            keep &= (self.validity_times >= v_start) & (self.validity_times < v_stop)
+        if same_day:
+            keep &= self.validity_times.astype('datetime64[D]') == self.base_times.astype('datetime64[D]')
+        return self.to_frame(np.nonzero(keep)[0])
+
+    def to_frame(self, rows=None):
+        """ Messages as a frame of weather messages, all messages if no rows are given. """
+        if rows is None:
+            rows = np.arange(len(self))
+        rows = rows[np.lexsort((self.short_names[rows], self.validity_times[rows], self.base_times[rows]))]
+
+        n = len(rows)
+        return pd.DataFrame({
+            'shortName': self.short_names[rows].astype(object),
+            'values': object_array(self.values(rows)),
+            'validDateTime': pd.to_datetime(self.base_times[rows]),
+            'validityDateTime': pd.to_datetime(self.validity_times[rows]),
+            'lats': object_array([self.lats] * n),
+            'lons': object_array([self.lons] * n),
+            'type': self.types[rows].astype(object)
+        }, columns=FRAME_COLUMNS)
@@ -69,10 +69,13 @@ class EcmwfServer():
             print(infile.read())
             print("====================")
 
-    def retrieve(self, request):
+    def retrieve(self, request, index=True):
         """
             Check and execute the request.
             Result of the request is stored to file 'target' in GRIB format.
+
+            If index is set, a sidecar index of the messages (see grib.GribIndex) is stored
+            next to the target file, so the file can be opened lazily by WeatherExtractor.
         """
         request.check()
 
@@ -86,6 +89,10 @@ class EcmwfServer():
         # execute the request
         self.service.execute(req_str, target)
 
+        if index:
+            from .grib import GribIndex, default_decoder
+            GribIndex.build(target, default_decoder()).save()
+
 
 # the set of allowed steps in the request
 ALLOWED_STEPS = set(list(range(0, 90)) + list(range(90, 144, 3)) + list(range(144, 246, 6)))
@@ -0,0 +1,168 @@
+"""
+Materialized daily and weekly rollups of weather messages.
+
+A rollup layer holds one row per base day, validity period and parameter with the mean,
+minimum, maximum and number of hourly values in the period for every grid point. Queries
+aggregated by day or week are answered from the rollups instead of the hourly messages;
+weekly queries combine whole weeks of the weekly layer with the days of partial weeks.
+
+Rollups are stored in the 'rollups' directory of an archive, as one archive (or partitioned
+archive) per level and statistic, e.g. rollups/day-mean.
+
+Example:
+    $ rollups.save('ecmwf', partitioned=True)
+    $ rollups = Rollups.load('ecmwf')
+    $ rows = rollups.select('week', (np.datetime64('2017-11-01'), np.datetime64('2017-11-02')))
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from .archive import (PartitionedArchive, is_partitioned_archive, read_archive, write_archive,
+                      write_partitioned_archive)
+from .cube import FRAME_COLUMNS, to_datetime64
+
+ROLLUPS_DIR = 'rollups'
+ROLLUP_LEVELS = ['day', 'week']
+ROLLUP_STATS = ['mean', 'min', 'max', 'count']
+ROLLUP_COLUMNS = ['validDateTime', 'validityDateTime', 'shortName', 'lats', 'lons']
+
+
+def week_ends(days):
+    """ Sunday ending the Monday to Sunday week of each day (np.array(dtype='datetime64[D]')). """
+    return days + (6 - (days.astype(np.int64) + 3) % 7)
+
+
+def has_rollups(path):
+    """ Check if an archive directory holds stored rollups. """
+    return os.path.isdir(os.path.join(path, ROLLUPS_DIR))
+
+
+def _sorted(layer):
+    """ Rollup rows ordered by base day, validity period and parameter. """
+    order = np.lexsort((np.asarray(layer['shortName'], dtype=str), to_datetime64(layer['validityDateTime']),
+                        to_datetime64(layer['validDateTime'])))
+    return layer.iloc[order].reset_index(drop=True)
+
+
+class Rollups:
+    """
+    Daily and weekly rollup layers of weather messages.
+
+    Args:
+        layers (dict): frame of each level ('day', 'week') with one row per base day (validDateTime),
+            validity period (validityDateTime, the day or the Sunday ending the week) and parameter,
+            ordered by them, holding lats, lons and a value array of each statistic (ROLLUP_STATS)
+
+    Attributes:
+        params (set): short names of parameters with rollups
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.params = set(layers['day']['shortName'])
+        # base and validity datetimes of each layer for selections
+        self._times = {level: (to_datetime64(layer['validDateTime']), to_datetime64(layer['validityDateTime']))
+                       for level, layer in layers.items()}
+
+    def merge(self, other):
+        """ Rollups with the base days of other rollups replaced by them. """
+        layers = {}
+        for level in ROLLUP_LEVELS:
+            layer, new = self.layers[level], other.layers[level]
+            keep = ~np.isin(self._times[level][0], other._times[level][0])
+            layers[level] = _sorted(pd.concat([layer[keep], new], ignore_index=True))
+        return Rollups(layers)
+
+    def _select(self, level, base_range, validity_range=None, same_day=False, params=None):
+        """ Rows of a layer with periods inside the validity range. """
+        layer = self.layers[level]
+        base, validity = self._times[level]
+        period_stop = validity + np.timedelta64(1, 'D')
+        period_start = period_stop - np.timedelta64(7 if level == 'week' else 1, 'D')
+
+        start, stop = np.asarray(base_range, dtype='datetime64[s]')
+        keep = (base >= start) & (base < stop)
+        if validity_range is not None:
+            v_start, v_stop = np.asarray(validity_range, dtype='datetime64[s]')
+            keep &= (period_start >= v_start) & (period_stop <= v_stop)
+        if same_day:
+            keep &= period_start == base
+        if params is not None:
+            keep &= layer['shortName'].isin(params).values
+        return layer[keep]
+
+    def select(self, aggtime, base_range, validity_range=None, same_day=False, params=None):
+        """
+        Select rollup rows needed by a query aggregated by day or week, see WeatherCube.select for
+        the time arguments. Whole weeks inside the validity range are taken from the weekly layer and
+        the days of partial weeks from the daily layer.
+
+        Args:
+            aggtime (str): 'day' or 'week'
+            params (list): short names of the selected parameters, all if None
+
+        Returns:
+            pandas.DataFrame: selected rollup rows
+        """
+        assert aggtime in ROLLUP_LEVELS
+        rows = self._select('day', base_range, validity_range=validity_range, same_day=same_day, params=params)
+        if aggtime == 'day' or validity_range is None:
+            return rows
+
+        weeks = self._select('week', base_range, validity_range=validity_range, params=params)
+        week_stop = week_ends(rows['validityDateTime'].values.astype('datetime64[D]')) + 1
+        v_start, v_stop = np.asarray(validity_range, dtype='datetime64[D]')
+        partial = (week_stop - 7 < v_start) | (week_stop > v_stop)
+        return pd.concat([weeks, rows[partial]], ignore_index=True)
+
+    def save(self, path, partitioned=False, freq='M'):
+        """
+        Store rollups to the rollups directory of an archive.
+
+        Args:
+            path (str): archive directory
+            partitioned (bool): store partitioned archives, replacing stored rollups of the same base days
+            freq (str): period of base dates in one partition, see archive.write_partitioned_archive
+        """
+        for level in ROLLUP_LEVELS:
+            layer = self.layers[level]
+            for stat in ROLLUP_STATS:
+                grib_msgs = layer[ROLLUP_COLUMNS].copy()
+                grib_msgs['values'] = layer[stat].values
+                grib_msgs['type'] = stat
+                layer_path = os.path.join(path, ROLLUPS_DIR, '%s-%s' % (level, stat))
+                if partitioned:
+                    write_partitioned_archive(layer_path, grib_msgs[FRAME_COLUMNS], freq=freq)
+                else:
+                    write_archive(layer_path, grib_msgs[FRAME_COLUMNS])
+
+    @classmethod
+    def load(cls, path, msg_filter=None):
+        """
+        Load rollups stored with an archive.
+
+        Args:
+            path (str): archive directory
+            msg_filter (grib.MessageFilter): selection of parameters, base dates and area, without steps
+
+        Returns:
+            Rollups: loaded rollups with memory-mapped values
+        """
+        layers = {}
+        for level in ROLLUP_LEVELS:
+            layer = None
+            for stat in ROLLUP_STATS:
+                layer_path = os.path.join(path, ROLLUPS_DIR, '%s-%s' % (level, stat))
+                if is_partitioned_archive(layer_path):
+                    grib_msgs = PartitionedArchive(layer_path, msg_filter=msg_filter).to_frame()
+                else:
+                    grib_msgs = read_archive(layer_path)
+                    if msg_filter is not None:
+                        grib_msgs = msg_filter.filter_frame(grib_msgs)
+                if layer is None:
+                    layer = grib_msgs[ROLLUP_COLUMNS].reset_index(drop=True)
+                layer[stat] = grib_msgs['values'].values
+            layers[level] = layer
+        return cls(layers)
@@ -0,0 +1,406 @@
+"""
+Spatial lookups on weather grids.
+
+GridIndex answers nearest point queries against a fixed set of points (usually the grid
+of the loaded weather messages). Distances are euclidean in degrees, as in
+WeatherExtractor._calc_closest, and ties are resolved in favour of the first point.
+
+Example:
+    $ index = grid_index(grid_lats, grid_lons)
+    $ closest = index.nearest(target_lats, target_lons)
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# number of distances computed at once by the brute force search
+_CHUNK_SIZE = 2 ** 20
+
+# number of neighbours checked for ties when using a KD-tree
+_TREE_NEIGHBOURS = 4
+
+# smallest index size for which building a KD-tree pays off
+_TREE_MIN_POINTS = 256
+
+# number of indexes kept by grid_index()
+_CACHE_SIZE = 16
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def grid_fingerprint(lats, lons):
+    """ Hash identifying a set of points by their coordinates. """
+    h = hashlib.sha1()
+    for arr in [lats, lons]:
+        arr = np.ascontiguousarray(arr, dtype=np.float64)
+        h.update(str(arr.shape).encode('ascii'))
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def grid_index(lats, lons):
+    """ Get a GridIndex for the given points, reusing a previously built one if possible. """
+    key = grid_fingerprint(lats, lons)
+    with _cache_lock:
+        index = _cache.pop(key, None)
+    if index is None:
+        index = GridIndex(lats, lons, fingerprint=key)
+    with _cache_lock:
+        _cache[key] = index
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
+
+
+def _regular_axis(values):
+    """ Return (start, step) if values are equally spaced, None otherwise. """
+    if len(values) == 1:
+        return values[0], 1.0
+    diffs = np.diff(values)
+    step = (values[-1] - values[0]) / (len(values) - 1)
+    if step == 0 or not np.allclose(diffs, step, rtol=1e-6, atol=0):
+        return None
+    return values[0], step
+
+
+class GridIndex:
+    """
+    Nearest point index over a fixed set of points.
+
+    Lookups use index arithmetic if the points form a regular lat/lon grid stored row by row
+    (the layout of GRIB messages requested with WeatherApi.get(grid=...)), a KD-tree for
+    other large point sets when scipy is available and a vectorized brute force search otherwise.
+    All strategies return the same indices as a full search.
+
+    Attributes:
+        lats, lons (np.array(dtype=float)): coordinates of the indexed points
+        fingerprint (str): hash of the point coordinates
+    """
+
+    def __init__(self, lats, lons, fingerprint=None):
+        self.lats = np.asarray(lats, dtype=np.float64).ravel()
+        self.lons = np.asarray(lons, dtype=np.float64).ravel()
+        assert self.lats.shape == self.lons.shape and len(self.lats) > 0
+        self.fingerprint = fingerprint if fingerprint is not None else grid_fingerprint(self.lats, self.lons)
+
+        self._regular = self._detect_regular()
+        self._tree = None
+        if self._regular is None and len(self.lats) >= _TREE_MIN_POINTS:
+            try:
+                from scipy.spatial import cKDTree
+                self._tree = cKDTree(np.column_stack([self.lats, self.lons]))
+            except ImportError:
+                pass
+
+    def __len__(self):
+        return len(self.lats)
+
+    @property
+    def is_regular(self):
+        """ True if points form a regular lat/lon grid. """
+        return self._regular is not None
+
+    def _detect_regular(self):
+        """ Detect a regular grid with latitude rows and longtitude columns. """
+        n = len(self.lats)
+        n_lon = np.argmax(self.lats != self.lats[0]) if (self.lats != self.lats[0]).any() else n
+        if n % n_lon != 0:
+            return None
+        n_lat = n // n_lon
+
+        row_lats, col_lons = self.lats[::n_lon], self.lons[:n_lon]
+        if not (np.array_equal(self.lats, np.repeat(row_lats, n_lon)) and
+                np.array_equal(self.lons, np.tile(col_lons, n_lat))):
+            return None
+
+        lat_axis, lon_axis = _regular_axis(row_lats), _regular_axis(col_lons)
+        if lat_axis is None or lon_axis is None:
+            return None
+        return (n_lat, n_lon) + lat_axis + lon_axis
+
+    def _distances(self, candidates, lats, lons):
+        """ Squared distances between each query point and its candidate points. """
+        return (self.lats[candidates] - lats[:, None])**2 + (self.lons[candidates] - lons[:, None])**2
+
+    def _first_nearest(self, candidates, lats, lons):
+        """ Pick the first candidate with the minimal distance (candidates sorted by index). """
+        dist = self._distances(candidates, lats, lons)
+        return candidates[np.arange(len(lats)), np.argmin(dist, axis=1)]
+
+    def _nearest_regular(self, lats, lons):
+        """ Nearest points on a regular grid found by index arithmetic. """
+        n_lat, n_lon, lat0, dlat, lon0, dlon = self._regular
+
+        def axis_candidates(values, start, step, size):
+            pos = np.floor((values - start) / step).astype(np.int64)
+            # check a few neighbouring rows/columns to be robust to rounding
+            return np.clip(pos[:, None] + np.arange(-1, 3)[None, :], 0, size - 1)
+
+        rows = axis_candidates(lats, lat0, dlat, n_lat)
+        cols = axis_candidates(lons, lon0, dlon, n_lon)
+        # rows and columns are sorted, so flattened candidates are sorted by point index
+        candidates = (rows[:, :, None] * n_lon + cols[:, None, :]).reshape(len(lats), -1)
+        return self._first_nearest(candidates, lats, lons)
+
+    def _nearest_brute(self, lats, lons):
+        """ Nearest points found by comparing against every indexed point. """
+        res = np.empty(len(lats), dtype=np.int64)
+        chunk = max(1, _CHUNK_SIZE // len(self.lats))
+        for start in range(0, len(lats), chunk):
+            stop = start + chunk
+            dist = (self.lats[None, :] - lats[start:stop, None])**2 + \
+                (self.lons[None, :] - lons[start:stop, None])**2
+            res[start:stop] = np.argmin(dist, axis=1)
+        return res
+
+    def _nearest_tree(self, lats, lons):
+        """ Nearest points found with a KD-tree, ties resolved with exact distances. """
+        k = min(_TREE_NEIGHBOURS, len(self.lats))
+        tree_dist, candidates = self._tree.query(np.column_stack([lats, lons]), k=k)
+        tree_dist, candidates = tree_dist.reshape(len(lats), k), candidates.reshape(len(lats), k)
+        res = self._first_nearest(np.sort(candidates, axis=1), lats, lons)
+
+        # all checked neighbours are (nearly) tied: fall back to the full search
+        unsure = tree_dist[:, -1] <= tree_dist[:, 0] * (1 + 1e-9) + 1e-12
+        if unsure.any() and k < len(self.lats):
+            res[unsure] = self._nearest_brute(lats[unsure], lons[unsure])
+        return res
+
+    def nearest(self, lats, lons):
+        """
+        For each query point find the closest indexed point. In case of a tie take
+        the indexed point with the lowest index.
+
+        Args:
+            lats, lons (np.array(dtype=float)): latitudes and longtitudes of query points
+
+        Returns:
+            np.array(dtype=int): array where value at index i represents the index of the closest point
+        """
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        if len(lats) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if self._regular is not None:
+            return self._nearest_regular(lats, lons)
+        elif self._tree is not None:
+            return self._nearest_tree(lats, lons)
+        return self._nearest_brute(lats, lons)
+
+
+# center of Slovenia used for aggloc='country'
+COUNTRY_CENTER = (46.1512, 14.9955)
+
+# number of plans kept by QueryPlanCache
+_PLAN_CACHE_SIZE = 256
+
+
+def bbox_borders(bounding_box):
+    """ Normalize [[lat1,lon1], [lat2,lon2]] corner points to (min_lat, max_lat, min_lon, max_lon). """
+    assert len(bounding_box) == 2 and len(bounding_box[0]) == 2 and len(bounding_box[1]) == 2, \
+        "Wrong bounding box input structure"
+    return (float(min(bounding_box[0][0], bounding_box[1][0])), float(max(bounding_box[0][0], bounding_box[1][0])),
+            float(min(bounding_box[0][1], bounding_box[1][1])), float(max(bounding_box[0][1], bounding_box[1][1])))
+
+
+class QueryPlan:
+    """
+    Precompiled spatial aggregation of grid values onto target points.
+
+    A plan holds everything WeatherExtractor needs to aggregate messages defined on one grid
+    for one target specification (point list, bounding box or country): the bounding box mask,
+    the nearest point indices and the segments averaged by aggtype='mean'. Plans can be passed
+    to WeatherExtractor.get_actual/get_forecast, saved to disk and loaded in other processes.
+
+    Example:
+        $ plan = we.query_plan('points', interp_points=[{'lat': 46.05, 'lon': 14.51}])
+        $ plan.save('ljubljana.npz')
+        $ we.get_forecast(base_date, from_date, to_date, plan=QueryPlan.load('ljubljana.npz'))
+
+    Attributes:
+        fingerprint (str): fingerprint of the grid the plan was built for
+        aggloc (str): location aggregation level; 'points', 'country' or 'bbox'
+        aggtype (str): aggregation type; 'one' or 'mean'
+        target_lats, target_lons (np.array(dtype=float)): coordinates of the target points
+        mask (np.array(dtype=bool)): grid points used by the plan
+        index (np.array(dtype=int)): grid points gathered for aggregation
+        counts (np.array(dtype=int)): number of gathered grid points averaged into each target if aggtype='mean'
+    """
+
+    def __init__(self, fingerprint, aggloc, aggtype, target_lats, target_lons, mask, index, counts=None):
+        self.fingerprint = str(fingerprint)
+        self.aggloc = str(aggloc)
+        self.aggtype = str(aggtype)
+        self.target_lats = np.asarray(target_lats, dtype=np.float64)
+        self.target_lons = np.asarray(target_lons, dtype=np.float64)
+        self.mask = np.asarray(mask, dtype=bool)
+        self.index = np.asarray(index, dtype=np.int64)
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def build(cls, lats, lons, aggloc, aggtype=None, interp_points=None, bounding_box=None, fingerprint=None):
+        """
+        Build a plan for the grid given by lats and lons.
+
+        Args:
+            lats, lons (np.array(dtype=float)): latitudes and longtitudes of the grid points
+            aggloc (str): location aggregation level; 'points', 'country' or 'bbox'
+            aggtype (str): 'one' keeps the closest grid point of each target, 'mean' averages all grid points
+                closest to a target; defaults to 'mean' for aggloc='bbox' and 'one' otherwise
+            interp_points (tuple): latitudes and longtitudes of target points if aggloc='points'
+            bounding_box ([[lat1,lon1], [lat2,lon2]]): corner points of the bounding box if aggloc='bbox'
+            fingerprint (str): grid fingerprint if already known
+
+        Returns:
+            QueryPlan: plan for the given grid and targets
+        """
+        assert aggloc in ['points', 'country', 'bbox']
+        if aggtype is None:
+            aggtype = 'mean' if aggloc == 'bbox' else 'one'
+        assert aggtype in ['one', 'mean']
+
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        mask = np.ones(len(lats), dtype=bool)
+
+        if aggloc == 'points':
+            assert interp_points is not None
+            target_lats = np.asarray(interp_points[0], dtype=np.float64)
+            target_lons = np.asarray(interp_points[1], dtype=np.float64)
+        elif aggloc == 'country':
+            target_lats, target_lons = np.array([COUNTRY_CENTER[0]]), np.array([COUNTRY_CENTER[1]])
+        elif aggloc == 'bbox':
+            assert bounding_box is not None, "bounding box not given"
+            bb_min_lat, bb_max_lat, bb_min_lon, bb_max_lon = bbox_borders(bounding_box)
+            # check if bounding box is within data
+            min_lat, max_lat = lats.min(), lats.max()
+            min_lon, max_lon = lons.min(), lons.max()
+            assert min_lat <= bb_min_lat <= max_lat, "bounding box must be within data area"
+            assert min_lat <= bb_max_lat <= max_lat, "bounding box must be within data area"
+            assert min_lon <= bb_min_lon <= max_lon, "bounding box must be within data area"
+            assert min_lon <= bb_max_lon <= max_lon, "bounding box must be within data area"
+            # filter out bounding box points
+            mask = (bb_min_lat <= lats) & (lats <= bb_max_lat) & (bb_min_lon <= lons) & (lons <= bb_max_lon)
+            assert mask.any(), "bounding box contains no points"
+            # aggregate to the mid point of the bounding box
+            target_lats = np.array([0.5 * (bb_min_lat + bb_max_lat)])
+            target_lons = np.array([0.5 * (bb_min_lon + bb_max_lon)])
+
+        if fingerprint is None:
+            fingerprint = grid_fingerprint(lats, lons)
+        grid_points = np.flatnonzero(mask)
+
+        if aggtype == 'one':
+            # each target point has only one closest grid point
+            closest = grid_index(lats[mask], lons[mask]).nearest(target_lats, target_lons)
+            return cls(fingerprint, aggloc, aggtype, target_lats, target_lons, mask, grid_points[closest])
+
+        # each grid point has only one closest target point, group grid points by their target
+        closest = grid_index(target_lats, target_lons).nearest(lats[mask], lons[mask])
+        order = np.argsort(closest, kind='stable')
+        counts = np.bincount(closest, minlength=len(target_lats))
+        return cls(fingerprint, aggloc, aggtype, target_lats, target_lons, mask, grid_points[order], counts)
+
+    @property
+    def num_targets(self):
+        return len(self.target_lats)
+
+    def apply(self, values):
+        """
+        Aggregate values of one or more messages onto the target points.
+
+        Args:
+            values (np.array(dtype=float)): grid values, one message per row
+
+        Returns:
+            np.array(dtype=float): aggregated values, one column per target point
+        """
+        values = np.asarray(values)
+        if self.aggtype == 'one':
+            return values[..., self.index].astype(np.float64)
+
+        result = np.zeros(values.shape[:-1] + (self.num_targets,))
+        starts = np.cumsum(self.counts) - self.counts
+        nonempty = self.counts > 0
+        result[..., nonempty] = np.add.reduceat(values[..., self.index], starts[nonempty], axis=-1, dtype=np.float64)
+        return result / np.maximum(self.counts, 1)
+
+    def save(self, filepath):
+        """ Store the plan to a .npz file. """
+        arrays = {
+            'fingerprint': np.array(self.fingerprint),
+            'aggloc': np.array(self.aggloc),
+            'aggtype': np.array(self.aggtype),
+            'target_lats': self.target_lats,
+            'target_lons': self.target_lons,
+            'mask': self.mask,
+            'index': self.index
+        }
+        if self.counts is not None:
+            arrays['counts'] = self.counts
+        with open(filepath, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        """ Load a plan stored with QueryPlan.save. """
+        with np.load(filepath, allow_pickle=False) as data:
+            return cls(data['fingerprint'][()], data['aggloc'][()], data['aggtype'][()],
+                       data['target_lats'], data['target_lons'], data['mask'], data['index'],
+                       data['counts'] if 'counts' in data.files else None)
+
+
+class QueryPlanCache:
+    """
+    Memoizing cache of query plans keyed by grid fingerprint and target specification.
+    The least recently used plans are dropped when the cache is full. The cache can be shared
+    by threads, plans missing in the cache are built outside of the lock.
+    """
+
+    def __init__(self, max_size=_PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        # fingerprint of the last seen grid arrays, grids are shared by all messages
+        self._last_grid = (None, None, None)
+
+    def fingerprint(self, lats, lons):
+        """ Fingerprint of the grid, not recomputed for the same grid arrays. """
+        last_lats, last_lons, last_fingerprint = self._last_grid
+        if lats is last_lats and lons is last_lons:
+            return last_fingerprint
+        fingerprint = grid_fingerprint(lats, lons)
+        self._last_grid = (lats, lons, fingerprint)
+        return fingerprint
+
+    def get(self, lats, lons, aggloc, aggtype=None, interp_points=None, bounding_box=None):
+        """ Get the plan for a grid and targets, see QueryPlan.build for arguments. """
+        fingerprint = self.fingerprint(lats, lons)
+        if aggtype is None:
+            aggtype = 'mean' if aggloc == 'bbox' else 'one'
+        if aggloc == 'points':
+            spec = (np.asarray(interp_points[0], dtype=np.float64).tobytes(),
+                    np.asarray(interp_points[1], dtype=np.float64).tobytes())
+        elif aggloc == 'bbox':
+            spec = bbox_borders(bounding_box)
+        else:
+            spec = None
+        key = (fingerprint, aggloc, aggtype, spec)
+
+        with self._lock:
+            plan = self._plans.pop(key, None)
+        if plan is None:
+            plan = QueryPlan.build(lats, lons, aggloc, aggtype=aggtype, interp_points=interp_points,
+                                   bounding_box=bounding_box, fingerprint=fingerprint)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self._last_grid = (None, None, None)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+"""
+Weather archive format tests.
+"""
+
+from ..archive import (PartitionedArchive, is_archive, is_partitioned_archive, read_archive, write_archive,
+                       write_partitioned_archive)
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import os
+import tempfile
+import numpy as np
+
+
+class TestArchive(unittest.TestCase):
+    """Unit tests for writing and reading (partitioned) weather archives."""
+
+    def test_write_read(self):
+        """Test if an archive restores the stored messages with memory-mapped values."""
+        msgs = make_messages([datetime.date(2017, 11, 2), datetime.date(2017, 11, 1)], [0, 6], ['tp', '2t'])
+        path = os.path.join(tempfile.mkdtemp(), 'archive')
+        write_archive(path, msgs)
+        self.assertTrue(is_archive(path))
+        self.assertFalse(is_archive(os.path.dirname(path)))
+
+        res = read_archive(path)
+        self.assertEqual(list(res.columns), list(msgs.columns))
+        self.assertEqual(len(res), len(msgs))
+        self.assertIsInstance(res['values'].iloc[0], np.memmap)
+        self.assertTrue(res['validDateTime'].is_monotonic_increasing)
+
+        ref = msgs.set_index(['validDateTime', 'validityDateTime', 'shortName'])
+        for _, row in res.iterrows():
+            values = ref.loc[(row['validDateTime'], row['validityDateTime'], row['shortName']), 'values']
+            np.testing.assert_allclose(row['values'], values, rtol=1e-6)
+            self.assertEqual(row['type'], 'fc')
+        np.testing.assert_array_equal(res['lats'].iloc[0], msgs['lats'].iloc[0])
+
+
+    def test_rewrite(self):
+        """Test if rewriting an archive replaces its files, keeping values mapped before unchanged."""
+        base_dates = [datetime.date(2017, 11, 1)]
+        msgs = make_messages(base_dates, [0, 6], ['2t'])
+        path = os.path.join(tempfile.mkdtemp(), 'archive')
+        write_archive(path, msgs)
+        old = read_archive(path)
+        expected = np.vstack(old['values']).copy()
+
+        write_archive(path, make_messages(base_dates, [0, 6], ['2t'], seed=1))
+        np.testing.assert_array_equal(np.vstack(old['values']), expected)
+        self.assertFalse(np.allclose(np.vstack(read_archive(path)['values']), expected))
+        self.assertFalse([name for name in os.listdir(path) if name.startswith('.tmp-')])
+
+        write_partitioned_archive(os.path.join(path, 'partitioned'), msgs)
+        self.assertEqual(sorted(os.listdir(os.path.join(path, 'partitioned'))), ['2017-11', 'manifest.json'])
+
+
+    def test_partitioned(self):
+        """Test if messages are partitioned by month and queries open only overlapping partitions."""
+        base_dates = [datetime.date(2017, 11, 29), datetime.date(2017, 11, 30), datetime.date(2017, 12, 1)]
+        msgs = make_messages(base_dates, [0, 6, 30], ['2t', 'tp'])
+        path = os.path.join(tempfile.mkdtemp(), 'partitioned')
+        write_partitioned_archive(path, msgs[:6])
+        write_partitioned_archive(path, msgs)
+        self.assertTrue(is_partitioned_archive(path))
+        self.assertFalse(is_archive(path))
+
+        archive = PartitionedArchive(path)
+        self.assertEqual(archive.partition_names(), ['2017-11', '2017-12'])
+        self.assertEqual(len(archive), len(msgs))
+
+        day = np.timedelta64(1, 'D')
+        start = np.datetime64('2017-11-30', 's')
+        self.assertEqual(archive.partition_names((start, start + day)), ['2017-11'])
+        res = archive.select((start, start + day), validity_range=(start, start + day))
+        self.assertEqual(list(archive._opened), ['2017-11'])
+        self.assertEqual(len(res), 2 * 2)
+        self.assertEqual(len(archive.select((start, start + 2 * day), same_day=True)), 2 * 2 * 2)
+
+
+    def test_partitioned_freshest(self):
+        """Test if the freshest forecasts of a lazy partitioned archive are found from partition metadata."""
+        base_dates = [datetime.date(2017, 11, 29), datetime.date(2017, 11, 30), datetime.date(2017, 12, 1)]
+        path = os.path.join(tempfile.mkdtemp(), 'partitioned')
+        write_partitioned_archive(path, make_messages(base_dates, [0, 6, 30], ['2t', 'tp']))
+        base, validity, short_names, partitions, rows = PartitionedArchive(path).headers()
+        self.assertEqual(len(base), 3 * 3 * 2)
+        self.assertEqual(list(np.unique(partitions)), ['2017-11', '2017-12'])
+
+        frame, lazy = WeatherExtractor(), WeatherExtractor(storage='lazy')
+        frame.load(path, params=['2t'])
+        lazy.load(path, params=['2t'])
+        day = datetime.date(2017, 11, 30)
+        res = lazy.get_best_available(day, day)
+        self.assertEqual(list(lazy.lazy_msgs._opened), ['2017-11'])
+        ref = frame.get_best_available(day, day)
+        # hours 00 and 06 of the day, both from the run of the day
+        self.assertEqual(len(res), 2)
+        self.assertEqual(set(res['shortName']), {'2t'})
+        np.testing.assert_array_equal(res['validDateTime'].values, ref['validDateTime'].values)
+        np.testing.assert_array_equal(res['validityDateTime'].values, ref['validityDateTime'].values)
+        np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']))
+
+
+    def test_append_loaded(self):
+        """Test if appending to the archive that was loaded keeps the loaded values of untouched base days."""
+        path = os.path.join(tempfile.mkdtemp(), 'partitioned')
+        write_partitioned_archive(path, make_messages([datetime.date(2017, 11, 1), datetime.date(2017, 11, 3)],
+                                                      [0, 6, 30], ['2t', 'tp']))
+        new_path = os.path.join(os.path.dirname(path), 'new')
+        write_archive(new_path, make_messages([datetime.date(2017, 11, 2)], [0, 6, 30], ['2t', 'tp'], seed=1))
+
+        # rows of the untouched day follow the new run in the rewritten partition
+        day = datetime.date(2017, 11, 3)
+        for storage in ['frame', 'cube']:
+            we = WeatherExtractor(storage=storage)
+            we.load(path)
+            expected = np.vstack(we.get_forecast(day, day, day + datetime.timedelta(days=1))['values']).copy()
+            we.append(new_path, format='archive', archive=path)
+
+            res = we.get_forecast(day, day, day + datetime.timedelta(days=1))
+            np.testing.assert_array_equal(np.vstack(res['values']), expected)
+            self.assertEqual(len(PartitionedArchive(path)), 3 * 3 * 2)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestArchive)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+"""
+Query result cache tests.
+"""
+
+from ..cache import ResultCache, query_key, result_nbytes
+from ..cube import WeatherCube
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import os
+import pickle
+import tempfile
+import numpy as np
+
+
+class TestResultCache(unittest.TestCase):
+    """Unit tests for the ResultCache class and cached queries."""
+
+    def test_eviction(self):
+        """Test if the least recently used results are dropped when the budget is exceeded."""
+        msgs = make_messages([datetime.date(2017, 11, 1)], [0, 6], ['2t'])
+        cache = ResultCache(int(2.5 * result_nbytes(msgs)))
+        for key in ['a', 'b', 'c']:
+            cache.put(key, msgs)
+            if key == 'b':
+                cache.get('a')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+
+    def test_cached_queries(self):
+        """Test if cached results are read-only, shared by equal queries and dropped on load."""
+        we = WeatherExtractor(storage='cube', result_cache_bytes=2**20)
+        we.cube = WeatherCube.from_frame(make_messages([datetime.date(2017, 11, 1)], [0, 6, 30], ['2t', 'tp']))
+        day = datetime.date(2017, 11, 1)
+
+        res = we.get_forecast(day, day, day, aggloc='points', interp_points=[{'lat': 46, 'lon': 14}])
+        self.assertEqual(query_key([{'lat': 46, 'lon': 14}]), query_key([{'lon': 14.0, 'lat': 46.0}]))
+        same = we.get_forecast(day, day, day, aggloc='points', interp_points=[{'lon': 14.0, 'lat': 46.0}])
+        self.assertEqual(we.result_cache.stats()['hits'], 1)
+        with self.assertRaises(ValueError):
+            same['values'].iloc[0][0] = 0
+        same['values'] = None
+        np.testing.assert_array_equal(np.vstack(we.get_forecast(day, day, day, aggloc='points', interp_points=[
+            {'lat': 46, 'lon': 14}])['values']), np.vstack(res['values']))
+
+        filepath = os.path.join(tempfile.mkdtemp(), 'next.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(make_messages([datetime.date(2017, 11, 2)], [0], ['2t', 'tp']), f)
+        we.load(filepath)
+        self.assertEqual(len(we.result_cache), 0)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestResultCache)
+    unittest.TextTestRunner(verbosity=3).run(suite)
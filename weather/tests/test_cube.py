@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+"""
+Dense weather cube storage tests.
+"""
+
+from ..cube import WeatherCube
+import unittest
+
+import datetime
+import numpy as np
+import pandas as pd
+
+
+def make_messages(base_dates, steps, params, n_lats=3, n_lons=4, seed=0):
+    """Build a frame of synthetic weather messages on a regular grid."""
+    rng = np.random.RandomState(seed)
+    lats, lons = np.meshgrid(46.5 - 0.25 * np.arange(n_lats), 13.25 + 0.25 * np.arange(n_lons), indexing='ij')
+    lats, lons = lats.flatten(), lons.flatten()
+
+    msgs = []
+    for base_date in base_dates:
+        base = datetime.datetime.combine(base_date, datetime.time(0))
+        for step in steps:
+            for param in params:
+                msgs.append({
+                    'shortName': param,
+                    'values': rng.rand(len(lats)),
+                    'validDateTime': base,
+                    'validityDateTime': base + datetime.timedelta(hours=step),
+                    'lats': lats,
+                    'lons': lons,
+                    'type': 'fc'
+                })
+    return pd.DataFrame.from_dict(msgs)
+
+
+class TestWeatherCube(unittest.TestCase):
+    """Unit tests for the WeatherCube class."""
+    @classmethod
+    def setUpClass(self):
+        self.base_dates = [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)]
+        self.msgs = make_messages(self.base_dates, [0, 6, 12, 24, 30], ['2t', 'tp'])
+        self.cube = WeatherCube.from_frame(self.msgs)
+
+
+    def test_from_frame(self):
+        """Test if messages are packed on the right axes."""
+        self.assertEqual(self.cube.values.shape, (2, 5, 2, 12))
+        self.assertEqual(self.cube.values.dtype, np.float32)
+        self.assertEqual(len(self.cube), len(self.msgs))
+        self.assertEqual(list(self.cube.params), ['2t', 'tp'])
+
+        row = self.msgs.iloc[7]
+        b = np.searchsorted(self.cube.base_times, np.datetime64(row['validDateTime'], 's'))
+        s = np.searchsorted(self.cube.steps, np.timedelta64(row['validityDateTime'] - row['validDateTime'], 's'))
+        p = list(self.cube.params).index(row['shortName'])
+        np.testing.assert_allclose(self.cube.values[b, s, p], row['values'], rtol=1e-6)
+
+
+    def test_select(self):
+        """Test if selection by base and validity window returns the matching messages."""
+        day = np.timedelta64(1, 'D')
+        start = np.datetime64(self.base_dates[0])
+
+        res = self.cube.select((start, start + day), validity_range=(start + day, start + 2 * day))
+        self.assertEqual(len(res), 2 * 2)
+        self.assertTrue((res['validityDateTime'].dt.date == self.base_dates[1]).all())
+
+        res = self.cube.select((start, start + 2 * day), same_day=True)
+        self.assertEqual(len(res), 2 * 3 * 2)
+        self.assertTrue((res['validDateTime'].dt.date == res['validityDateTime'].dt.date).all())
+
+        res = self.cube.select((start - 2 * day, start))
+        self.assertEqual(len(res), 0)
+
+
+    def test_to_frame(self):
+        """Test if unpacking restores the original messages."""
+        res = self.cube.to_frame().set_index(['validDateTime', 'validityDateTime', 'shortName']).sort_index()
+        ref = self.msgs.set_index(['validDateTime', 'validityDateTime', 'shortName']).sort_index()
+        self.assertEqual(len(res), len(ref))
+        for res_values, ref_values in zip(res['values'], ref['values']):
+            np.testing.assert_allclose(res_values, ref_values, rtol=1e-6)
+
+
+    def test_merge(self):
+        """Test if merging cubes takes the union of axes."""
+        other = WeatherCube.from_frame(make_messages([datetime.date(2017, 11, 3)], [0, 48], ['2t', 'ws'], seed=1))
+        merged = self.cube.merge(other)
+        self.assertEqual(merged.values.shape, (3, 6, 3, 12))
+        self.assertEqual(len(merged), len(self.cube) + len(other))
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestWeatherCube)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+"""
+Derived weather parameter tests.
+"""
+
+from ..cube import WeatherCube
+from ..derived import derive, required_inputs
+from ..lazy import FieldCache
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import numpy as np
+
+
+class TestDerived(unittest.TestCase):
+    """Unit tests for the derived parameter registry."""
+    @classmethod
+    def setUpClass(self):
+        self.msgs = make_messages([datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)], [0, 6],
+                                  ['10u', '10v', '2t', '2d'])
+        # physically plausible values: temperatures of 270-310 K, dew points of 250-270 K and winds of -10-10 m/s
+        scale = {'2t': (270., 40.), '2d': (250., 20.), '10u': (-10., 20.), '10v': (-10., 20.)}
+        self.msgs['values'] = [scale[name][0] + scale[name][1] * values
+                               for name, values in zip(self.msgs['shortName'], self.msgs['values'])]
+        self.ref = self.msgs.set_index(['validDateTime', 'validityDateTime', 'shortName'])['values']
+
+
+    def test_derive(self):
+        """Test if wind speed and relative humidity are derived for each base and validity datetime."""
+        res = derive(self.msgs, ['ws', 'rh'])
+        self.assertEqual(len(res), len(self.msgs) + 2 * 2 * 2)
+        self.assertEqual(list(res.columns), list(self.msgs.columns))
+
+        for _, row in res[res['shortName'].isin(['ws', 'rh'])].iterrows():
+            key = (row['validDateTime'], row['validityDateTime'])
+            if row['shortName'] == 'ws':
+                expected = np.hypot(self.ref[key + ('10u',)], self.ref[key + ('10v',)])
+            else:
+                T_surface, T_dew = self.ref[key + ('2t',)] - 273.15, self.ref[key + ('2d',)] - 273.15
+                expected = 100 * np.exp(17.625 * T_dew / (243.04 + T_dew)) / np.exp(17.625 * T_surface / (243.04 + T_surface))
+            np.testing.assert_allclose(row['values'], expected)
+
+
+    def test_nested(self):
+        """Test if parameters derived from derived parameters add only the requested ones."""
+        self.assertEqual(required_inputs(['at', '2t']), {'2t', '2d', '10u', '10v'})
+        res = derive(self.msgs, ['at', 'wdir'])
+        self.assertEqual(set(res['shortName']), {'10u', '10v', '2t', '2d', 'at', 'wdir'})
+        # missing inputs and unknown parameters are skipped
+        self.assertEqual(len(derive(self.msgs[self.msgs['shortName'] != '2d'], ['rh', 'unknown'])), len(self.msgs) - 4)
+
+        # wind from the west
+        west = self.msgs.copy()
+        west['values'] = [np.ones(12) if name == '10u' else np.zeros(12) for name in west['shortName']]
+        res = derive(west, ['wdir'])
+        np.testing.assert_allclose(np.vstack(res[res['shortName'] == 'wdir']['values']), 270.)
+
+
+    def test_cache(self):
+        """Test if derived values are cached per time slice."""
+        cache = FieldCache()
+        res = derive(self.msgs, ['ws'], cache=cache)
+        self.assertEqual((len(cache), cache.misses), (4, 4))
+        again = derive(self.msgs, ['ws'], cache=cache)
+        self.assertEqual(cache.hits, 4)
+        for values, cached in zip(res['values'], again['values']):
+            self.assertIs(values, cached)
+
+
+    def test_query_params(self):
+        """Test if queries return only the requested (derived) parameters."""
+        we = WeatherExtractor(storage='cube')
+        we.cube = WeatherCube.from_frame(self.msgs)
+        day = datetime.date(2017, 11, 1)
+        res = we.get_forecast(day, day, day, aggloc='country', params=['dpd', '2t'])
+        self.assertEqual(set(res['shortName']), {'dpd', '2t'})
+        res = we.get_forecast(day, day, day, aggloc='country')
+        self.assertEqual(set(res['shortName']), {'10u', '10v', '2t', '2d', 'ws', 'rh'})
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDerived)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+"""
+Chunked export tests.
+"""
+
+from ..archive import write_partitioned_archive
+from ..export import db_chunk, day_chunks
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class TestExport(unittest.TestCase):
+    """Unit tests for exports split into chunks."""
+
+    def test_day_chunks(self):
+        """Test if chunks cover the range of days in order."""
+        chunks = day_chunks(np.datetime64('2017-11-01'), np.datetime64('2017-11-08'), 3)
+        self.assertEqual([(str(start), str(stop)) for start, stop in chunks], [
+            ('2017-11-01', '2017-11-04'), ('2017-11-04', '2017-11-07'), ('2017-11-07', '2017-11-08')])
+        self.assertEqual(len(day_chunks(np.datetime64('2017-11-01'), np.datetime64('2017-11-08'), None)), 1)
+
+
+    def test_db_blocks(self):
+        """Test if database rows are streamed in one block per base and validity datetime in order."""
+        msgs = make_messages([datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)], [0, 6, 12], ['2t', 'tp'])
+        blocks = list(db_chunk(msgs.sample(frac=1, random_state=0), ['2t', 'sf', 'tp']))
+        self.assertEqual(len(blocks), 6)
+        self.assertEqual([(str(block['date'].iloc[0]), block['offset'].iloc[0]) for block in blocks[:4]], [
+            ('2017-11-01 00:00:00', 0), ('2017-11-01 00:00:00', 6), ('2017-11-01 00:00:00', 12),
+            ('2017-11-02 00:00:00', 0)])
+        block = blocks[1]
+        self.assertEqual(list(block.columns), ['date', 'offset', 'latitude', 'longitude', '2t', 'sf', 'tp'])
+        msg = msgs[(msgs['shortName'] == 'tp') & (msgs['validityDateTime'] == pd.Timestamp('2017-11-01 06:00'))]
+        np.testing.assert_array_equal(block['tp'], msg['values'].iloc[0])
+        np.testing.assert_array_equal(block['latitude'], msg['lats'].iloc[0])
+        self.assertTrue(block['sf'].isnull().all())
+
+    def test_chunked_exports(self):
+        """Test if exports of chunks in worker processes equal exports at once."""
+        tmp = tempfile.mkdtemp()
+        base_dates = [datetime.date(2017, 11, 1) + datetime.timedelta(days=i) for i in range(5)]
+        filepath = os.path.join(tmp, 'msgs.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(make_messages(base_dates, list(range(0, 48, 6)), ['2t', 'tp', '10u', '10v']), f)
+        we = WeatherExtractor()
+        we.load(filepath)
+        points = [{'lat': 46.0, 'lon': 13.5}, {'lat': 46.5, 'lon': 14.0}]
+
+        for name, export in [
+                ('features', lambda path, **kwargs: we.export(path, points, forecast_offsets=[-1, 0], **kwargs)),
+                ('qminer', lambda path, **kwargs: we.export_qminer(path, points, **kwargs)),
+                ('db', lambda path, **kwargs: we.export_db(path, from_date=base_dates[1], **kwargs))]:
+            export(os.path.join(tmp, name + '.tsv'), chunk_days=None)
+            export(os.path.join(tmp, name + '-chunked.tsv'), chunk_days=2, processes=2)
+            with open(os.path.join(tmp, name + '.tsv')) as f:
+                expected = f.read()
+            with open(os.path.join(tmp, name + '-chunked.tsv')) as f:
+                self.assertEqual(f.read(), expected)
+            self.assertGreater(len(expected.splitlines()), 10)
+
+    def test_partitioned_exports(self):
+        """Test if chunks of a lazy partitioned archive are selected from the archive chunk by chunk."""
+        tmp = tempfile.mkdtemp()
+        base_dates = [datetime.date(2017, 11, 1) + datetime.timedelta(days=i) for i in range(6)]
+        path = os.path.join(tmp, 'partitioned')
+        write_partitioned_archive(path, make_messages(base_dates, list(range(0, 48, 6)), ['2t', 'tp', '10u', '10v']),
+                                  freq='D')
+        frame, lazy = WeatherExtractor(), WeatherExtractor(storage='lazy')
+        frame.load(path)
+        lazy.load(path)
+
+        archive, selected = lazy.lazy_msgs, []
+        select = archive.select
+        archive.select = lambda base_range, **kwargs: selected.append(base_range) or select(base_range, **kwargs)
+        archive.to_frame = None
+        points = [{'lat': 46.0, 'lon': 13.5}, {'lat': 46.5, 'lon': 14.0}]
+        for name, export in [
+                ('features', lambda we, path: we.export(path, points, forecast_offsets=[-1, 0], chunk_days=2)),
+                ('qminer', lambda we, path: we.export_qminer(path, points, chunk_days=2)),
+                ('db', lambda we, path: we.export_db(path, chunk_days=2))]:
+            export(frame, os.path.join(tmp, name + '.tsv'))
+            export(lazy, os.path.join(tmp, name + '-lazy.tsv'))
+            with open(os.path.join(tmp, name + '.tsv')) as f:
+                expected = f.read()
+            with open(os.path.join(tmp, name + '-lazy.tsv')) as f:
+                self.assertEqual(f.read(), expected)
+        # chunks of 2 days with the previous day of features or up to 2 days of forecasts valid in a chunk
+        self.assertGreater(len(selected), 6)
+        for start, stop in selected:
+            self.assertLessEqual(stop - start, np.timedelta64(4, 'D'))
+
+    def test_parquet_exports(self):
+        """Test if parquet exports have the rows of tsv exports with one row group per date."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        tmp = tempfile.mkdtemp()
+        base_dates = [datetime.date(2017, 11, 1) + datetime.timedelta(days=i) for i in range(4)]
+        filepath = os.path.join(tmp, 'msgs.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(make_messages(base_dates, list(range(0, 48, 6)), ['2t', 'tp', '10u', '10v']), f)
+        we = WeatherExtractor()
+        we.load(filepath)
+        points = [{'lat': 46.0, 'lon': 13.5}, {'lat': 46.5, 'lon': 14.0}]
+
+        for name, date_column, export in [
+                ('features', 'validDate', lambda path, **kwargs: we.export(path, points, forecast_offsets=[-1, 0],
+                                                                           **kwargs)),
+                ('qminer', 'timestamp', lambda path, **kwargs: we.export_qminer(path, points, **kwargs)),
+                ('db', 'date', lambda path, **kwargs: we.export_db(path, **kwargs)),
+                # the first chunk has no forecasts of the day before
+                ('features_empty', 'validDate', lambda path, chunk_days, **kwargs: we.export(
+                    path, points, forecast_offsets=[-1], chunk_days=1, **kwargs))]:
+            export(os.path.join(tmp, name + '.tsv'), chunk_days=2)
+            export(os.path.join(tmp, name + '.parquet'), chunk_days=2, format='parquet')
+            expected = pd.read_csv(os.path.join(tmp, name + '.tsv'), sep='\t')
+            table = pq.read_table(os.path.join(tmp, name + '.parquet'))
+            self.assertEqual(table.column_names, list(expected.columns))
+            result = table.to_pandas()
+            for column in expected.columns:
+                if expected[column].dtype.kind == 'f':
+                    np.testing.assert_allclose(result[column].astype(float), expected[column], rtol=1e-6)
+                else:
+                    self.assertEqual(list(result[column].astype(str)), list(expected[column].astype(str)))
+
+            # row groups of single dates, all dates of the file
+            metadata = pq.ParquetFile(os.path.join(tmp, name + '.parquet')).metadata
+            days = pd.to_datetime(expected[date_column]).dt.normalize()
+            self.assertEqual(metadata.num_row_groups, days.nunique())
+            for i in range(metadata.num_row_groups):
+                stats = metadata.row_group(i).column(table.column_names.index(date_column)).statistics
+                self.assertEqual(pd.Timestamp(stats.min).normalize(), pd.Timestamp(stats.max).normalize())
+
+        features = pq.read_table(os.path.join(tmp, 'features.parquet'),
+                                 filters=[('validDate', '=', base_dates[1]), ('shortName', '=', '2t')])
+        self.assertTrue(pa.types.is_dictionary(features.schema.field('featureName').type))
+        self.assertGreater(features.num_rows, 0)
+        self.assertEqual(set(features.column('shortName').to_pylist()), {'2t'})
+        self.assertEqual(set(features.column('validDate').to_pylist()), {base_dates[1]})
+
+    def test_tensor_export(self):
+        """Test if the feature tensor has the features of the long export at their axis labels."""
+        tmp = tempfile.mkdtemp()
+        base_dates = [datetime.date(2017, 11, 1) + datetime.timedelta(days=i) for i in range(4)]
+        filepath = os.path.join(tmp, 'msgs.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(make_messages(base_dates, list(range(0, 48, 6)), ['2t', 'tp', '10u', '10v']), f)
+        we = WeatherExtractor()
+        we.load(filepath)
+        points = [{'lat': 46.0, 'lon': 13.5}, {'lat': 46.5, 'lon': 14.0}]
+        kwargs = {'weather_params': ['tp', '2t', 'ws'], 'forecast_offsets': [0, -1], 'regions': [1, 0]}
+
+        we.export(os.path.join(tmp, 'features.tsv'), points, **kwargs)
+        axes_path = we.export_tensor(os.path.join(tmp, 'features.npy'), points, chunk_days=3, dtype=np.float64,
+                                     **kwargs)
+        tensor = np.load(os.path.join(tmp, 'features.npy'), mmap_mode='r')
+        axes = np.load(axes_path)
+        self.assertEqual(tensor.shape, (4, 2, 7, 2, 4))
+        self.assertEqual(list(axes['date']), list(np.array(base_dates, dtype='datetime64[D]')))
+        self.assertEqual(list(axes['shortName']), ['tp', '2t', '2t', '2t', 'ws', 'ws', 'ws'])
+        self.assertEqual(list(axes['aggFunc']), ['cum', 'min', 'mean', 'max', 'min', 'mean', 'max'])
+
+        features = pd.read_csv(os.path.join(tmp, 'features.tsv'), sep='\t')
+        dates = [str(date) for date in axes['date']]
+        params = list(zip(axes['shortName'], axes['aggFunc']))
+        windows = [tuple(window) for window in axes['window']]
+        values = [tensor[dates.index(row.validDate), list(axes['dayOffset']).index(row.dayOffset),
+                         params.index((row.shortName, row.aggFunc)), list(axes['region']).index(row.region),
+                         windows.index((row.fromHour, row.toHour))] for row in features.itertuples()]
+        np.testing.assert_allclose(values, features['value'])
+        self.assertEqual(np.isfinite(tensor).sum(), features['value'].notnull().sum())
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestExport)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+Weather data extraction tests on synthetic messages.
+"""
+
+from ..cube import WeatherCube
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import threading
+import numpy as np
+
+
+class TestAggregation(unittest.TestCase):
+    """Unit tests for point and time aggregation of WeatherExtractor."""
+    @classmethod
+    def setUpClass(self):
+        self.we = WeatherExtractor()
+        self.msgs = make_messages([datetime.date(2017, 11, 1)], [0, 6, 12], ['2t', 'tp'], n_lats=6, n_lons=14)
+        self.lats, self.lons = self.msgs['lats'].iloc[0], self.msgs['lons'].iloc[0]
+
+
+    def test_aggregate_points_one(self):
+        """Test if each target point gets the value of its closest grid point."""
+        points = self.we._latslons_from_dict([{'lat': 46.0, 'lon': 14.5}, {'lat': 45.3, 'lon': 16.0}])
+        res = self.we._aggregate_points(self.msgs, 'points', interp_points=points)
+
+        self.assertEqual(list(res.columns), list(self.msgs.columns))
+        self.assertEqual(len(res), len(self.msgs))
+        closest = [np.argmin((self.lats - lat)**2 + (self.lons - lon)**2) for lat, lon in zip(*points)]
+        for res_values, values in zip(res['values'], self.msgs['values']):
+            np.testing.assert_array_equal(res_values, values[closest])
+
+
+    def test_aggregate_points_bbox(self):
+        """Test if bounding box aggregation averages the grid points inside the box."""
+        res = self.we._aggregate_points(self.msgs, 'bbox', aggtype='mean', bounding_box=[[45.5, 13.6], [46.3, 15.1]])
+
+        mask = (self.lats >= 45.5) & (self.lats <= 46.3) & (self.lons >= 13.6) & (self.lons <= 15.1)
+        np.testing.assert_allclose(res['lats'].iloc[0], [45.9])
+        np.testing.assert_allclose(res['lons'].iloc[0], [14.35])
+        for res_values, values in zip(res['values'], self.msgs['values']):
+            np.testing.assert_allclose(res_values, [values[mask].mean()])
+
+
+    def test_aggregate_values(self):
+        """Test daily and weekly reductions, including de-accumulation of accumulated parameters."""
+        msgs = make_messages([datetime.date(2017, 11, 1)], [0, 6, 12, 30, 126], ['2t', 'tp'])
+        values = dict(((row.shortName, row.validityDateTime.hour + 24 * (row.validityDateTime.day - 1)), row.values)
+                      for row in msgs.itertuples())
+
+        res = self.we._aggregate_values(msgs.drop('type', axis=1), 'day')
+        self.assertEqual(list(res.columns),
+                         ['validDateTime', 'validityDateTime', 'shortName', 'values', 'lats', 'lons'])
+        self.assertEqual(len(res), 3 * 2)
+        np.testing.assert_allclose(res['values'].iloc[0], (values['2t', 0] + values['2t', 6] + values['2t', 12]) / 3)
+
+        res = self.we._aggregate_values(msgs.drop('type', axis=1), 'week', aggfunc={'tp': 'cum', '2t': 'max'})
+        # 2017-11-01 is a Wednesday, 126 hours later is the next Monday
+        weeks = [datetime.date(2017, 11, 5)] * 2 + [datetime.date(2017, 11, 12)] * 2
+        self.assertEqual(list(res['validityDateTime'].dt.date), weeks)
+        self.assertEqual(list(res['shortName']), ['2t', 'tp'] * 2)
+        np.testing.assert_allclose(res['values'].iloc[0], np.maximum.reduce([values['2t', h] for h in [0, 6, 12, 30]]))
+        np.testing.assert_allclose(res['values'].iloc[1], values['tp', 30])
+        np.testing.assert_allclose(res['values'].iloc[3], values['tp', 126] - values['tp', 30])
+
+
+    def test_concurrent_queries(self):
+        """Test if queries from many threads leave the messages unchanged and return the sequential results."""
+        we = WeatherExtractor(storage='cube')
+        we.cube = WeatherCube.from_frame(self.msgs)
+        msgs = self.msgs.copy()
+        day = datetime.date(2017, 11, 1)
+        queries = [dict(aggtime=aggtime, aggloc=aggloc, interp_points=[{'lat': 46.0, 'lon': 14.5}],
+                        bounding_box=[[45.5, 13.6], [46.3, 15.1]])
+                   for aggtime in ['hour', 'day'] for aggloc in ['grid', 'points', 'bbox']]
+        expected = [we.get_forecast(day, day, day, **query) for query in queries]
+
+        results = [[] for _ in range(8)]
+        def run(thread_results):
+            for query in queries:
+                thread_results.append(we.get_forecast(day, day, day, **query))
+        threads = [threading.Thread(target=run, args=(thread_results,)) for thread_results in results]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for thread_results in results:
+            for res, ref in zip(thread_results, expected):
+                np.testing.assert_array_equal(np.vstack(res['values']), np.vstack(ref['values']))
+        self.we._aggregate_values(self.we._aggregate_points(self.msgs, 'bbox', aggtype='mean', bounding_box=[
+            [45.5, 13.6], [46.3, 15.1]]), 'day')
+        self.assertTrue(self.msgs.drop('values', axis=1).equals(msgs.drop('values', axis=1)))
+
+
+    def test_batch_queries(self):
+        """Test if a batch of windows and target sets returns the results of single queries."""
+        we = WeatherExtractor(storage='cube')
+        base_dates = [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)]
+        we.cube = WeatherCube.from_frame(make_messages(base_dates, [0, 6, 30, 54], ['2t', 'tp'], n_lats=6, n_lons=14))
+        day = datetime.timedelta(days=1)
+        windows = [(base_dates[0], base_dates[0], base_dates[1]),
+                   (base_dates[1], base_dates[1] + day, base_dates[1] + day),
+                   (base_dates[0], base_dates[1], base_dates[1] + day)]
+        targets = [[{'lat': 46.0, 'lon': 14.5}, {'lat': 45.3, 'lon': 16.0}], [[45.5, 13.6], [46.3, 15.1]]]
+
+        res = we.get_forecasts(windows, targets, aggtime='day')
+        self.assertEqual(list(res.columns)[:3], ['query', 'window', 'target'])
+        for window_id, window in enumerate(windows):
+            for target_id, kwargs in enumerate([{'aggloc': 'points', 'interp_points': targets[0]},
+                                                {'aggloc': 'bbox', 'bounding_box': targets[1]}]):
+                ref = we.get_forecast(*window, aggtime='day', **kwargs)
+                query = res[res['query'] == window_id * len(targets) + target_id]
+                self.assertTrue((query['window'] == window_id).all() and (query['target'] == target_id).all())
+                self.assertEqual(list(query['validityDateTime']), list(ref['validityDateTime']))
+                self.assertEqual(list(query['shortName']), list(ref['shortName']))
+                np.testing.assert_allclose(np.vstack(query['values']), np.vstack(ref['values']))
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAggregation)
+    unittest.TextTestRunner(verbosity=3).run(suite)
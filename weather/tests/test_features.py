@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+"""
+Export feature engine tests.
+"""
+
+from ..features import FEATURE_COLUMNS, FEATURE_WINDOWS, feature_table, feature_tensor, tensor_features
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import numpy as np
+import pandas as pd
+
+
+class TestFeatures(unittest.TestCase):
+    """Unit tests for the feature_table and feature_tensor functions."""
+
+    def test_feature_table(self):
+        """Test if accumulated and instant features are calculated for each run, window and region."""
+        day = datetime.date(2017, 11, 2)
+        msgs = make_messages([day - datetime.timedelta(days=1), day], [0, 6, 12, 18, 24, 30], ['tp', '2t', '10u'])
+        closest = np.array([5, 0, 11])
+        res = feature_table(msgs, closest, [0, 2], np.array([day], dtype='datetime64[D]'), ['tp', '2t', '10u'],
+                            [-1, 0])
+        self.assertEqual(list(res.columns), FEATURE_COLUMNS)
+        self.assertEqual(set(res['dayOffset']), {-1, 0})
+        self.assertEqual(set(res['shortName']), {'tp', '2t'})
+        # 3 statistics in 4 windows of 2t in both runs, 4 windows of tp in the last run and the
+        # first window only in the previous run (valid until 06:00), for both regions
+        self.assertEqual(len(res), 2 * (2 * 3 * 4 + 4 + 1))
+        self.assertTrue(np.isnan(res[res['featureName'] == 'WEATHERFC-0012t000MEAN12-18']['value'].iloc[0]))
+        self.assertEqual(list(res['featureName'][:3]),
+                         ['WEATHERFC-0012t000MIN00-06', 'WEATHERFC-0012t002MIN00-06', 'WEATHERFC-0012t000MIN06-12'])
+
+        def values(param, base_day, hours):
+            base = pd.Timestamp(base_day)
+            rows = msgs[(msgs['shortName'] == param) & (msgs['validDateTime'] == base)]
+            at = [rows[rows['validityDateTime'] == pd.Timestamp(day) + pd.Timedelta(hours=h)]['values'].iloc[0]
+                  for h in hours]
+            return np.array(at)[:, closest[2]]
+
+        feature = res.set_index('featureName')['value']
+        tp = values('tp', day, [6, 12])
+        self.assertAlmostEqual(feature['WEATHERFC+000tp002CUM06-12'], tp[1] - tp[0])
+        self.assertAlmostEqual(feature['WEATHERFC+0002t002MEAN06-18'], values('2t', day, [6, 12, 18]).mean())
+        self.assertAlmostEqual(feature['WEATHERFC-0012t002MAX00-06'], values('2t', day - datetime.timedelta(days=1),
+                                                                          [0, 6]).max())
+
+
+    def test_feature_tensor_latest_run(self):
+        """Test if the feature tensor has the features of the latest of the runs made on the same day."""
+        day = datetime.date(2017, 11, 2)
+        params = ['tp', '2t']
+        midnight = make_messages([day], [0, 6, 12, 18, 24, 30], params)
+        noon = make_messages([day], [0, 6, 12, 18, 24, 30], params, seed=1)
+        noon['validDateTime'] += pd.Timedelta(hours=12)
+        noon['validityDateTime'] += pd.Timedelta(hours=12)
+        closest = np.array([5, 0, 11])
+        dates = np.array([day], dtype='datetime64[D]')
+
+        res = feature_tensor(pd.concat([noon, midnight], ignore_index=True), closest, [0, 2], dates, params, [0])
+        np.testing.assert_array_equal(res, feature_tensor(noon, closest, [0, 2], dates, params, [0]))
+        # the noon run is valid from 12:00, windows before are missing even though the midnight run has them
+        first = FEATURE_WINDOWS.index((0, 6))
+        mean_2t = tensor_features(params).index(('2t', 'mean'))
+        self.assertTrue(np.isnan(res[0, 0, mean_2t, :, first]).all())
+        self.assertTrue(np.isfinite(feature_tensor(midnight, closest, [0, 2], dates, params, [0])[0, 0, mean_2t, :,
+                                                                                               first]).all())
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFeatures)
+    unittest.TextTestRunner(verbosity=3).run(suite)
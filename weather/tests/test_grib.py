@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+GRIB message selection tests.
+"""
+
+from ..grib import MessageFilter, decode_file, decode_files
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import importlib.util
+import multiprocessing
+import os
+import tempfile
+import warnings
+import numpy as np
+
+
+def make_grib(filepath, base_dates, steps, params, n_lats=3, n_lons=4, seed=0):
+    """Write synthetic forecast messages on a regular grid to a GRIB file with ecCodes."""
+    import eccodes
+
+    rng = np.random.RandomState(seed)
+    with open(filepath, 'wb') as f:
+        for base_date in base_dates:
+            for step in steps:
+                for param in params:
+                    gid = eccodes.codes_grib_new_from_samples('regular_ll_sfc_grib1')
+                    try:
+                        eccodes.codes_set_long(gid, 'Ni', n_lons)
+                        eccodes.codes_set_long(gid, 'Nj', n_lats)
+                        eccodes.codes_set(gid, 'latitudeOfFirstGridPointInDegrees', 46.5)
+                        eccodes.codes_set(gid, 'latitudeOfLastGridPointInDegrees', 46.5 - 0.25 * (n_lats - 1))
+                        eccodes.codes_set(gid, 'longitudeOfFirstGridPointInDegrees', 13.25)
+                        eccodes.codes_set(gid, 'longitudeOfLastGridPointInDegrees', 13.25 + 0.25 * (n_lons - 1))
+                        eccodes.codes_set(gid, 'iDirectionIncrementInDegrees', 0.25)
+                        eccodes.codes_set(gid, 'jDirectionIncrementInDegrees', 0.25)
+                        eccodes.codes_set(gid, 'shortName', param)
+                        eccodes.codes_set_long(gid, 'dataDate', int(base_date.strftime('%Y%m%d')))
+                        eccodes.codes_set_long(gid, 'dataTime', 0)
+                        if param in ['tp', 'sf', 'sund']:
+                            eccodes.codes_set(gid, 'stepType', 'accum')
+                        eccodes.codes_set_long(gid, 'endStep', step)
+                        eccodes.codes_set(gid, 'marsType', 'fc')
+                        eccodes.codes_set_values(gid, 270 + 30 * rng.rand(n_lats * n_lons))
+                        eccodes.codes_write(gid, f)
+                    finally:
+                        eccodes.codes_release(gid)
+
+
+class TestMessageFilter(unittest.TestCase):
+    """Unit tests for the MessageFilter class."""
+    @classmethod
+    def setUpClass(self):
+        self.base_dates = [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2), datetime.date(2017, 11, 3)]
+        self.msgs = make_messages(self.base_dates, [0, 6, 12], ['2t', 'tp', 'ws'], n_lats=6, n_lons=14)
+
+
+    def test_keep(self):
+        """Test if messages are selected from their header keys."""
+        msg_filter = MessageFilter(params=['2t'], base_dates=self.base_dates[1:], steps=[6])
+        base = datetime.datetime(2017, 11, 2)
+        self.assertTrue(msg_filter.keep('2t', base, base + datetime.timedelta(hours=6)))
+        self.assertFalse(msg_filter.keep('tp', base, base + datetime.timedelta(hours=6)))
+        self.assertFalse(msg_filter.keep('2t', base, base + datetime.timedelta(hours=12)))
+        self.assertFalse(msg_filter.keep('2t', base - datetime.timedelta(days=1), base + datetime.timedelta(hours=6)))
+        self.assertTrue(MessageFilter().keep('tp', base, base))
+
+
+    def test_filter_frame(self):
+        """Test if decoded messages are selected and cropped to the bounding box."""
+        msg_filter = MessageFilter(params=['2t', 'ws'], base_dates=self.base_dates[:2], steps=[0, 12],
+                                   bbox=[[46.3, 15.1], [45.5, 13.6]])
+        res = msg_filter.filter_frame(self.msgs)
+        self.assertEqual(len(res), 2 * 2 * 2)
+        self.assertEqual(set(res['shortName']), {'2t', 'ws'})
+
+        lats, lons = self.msgs['lats'].iloc[0], self.msgs['lons'].iloc[0]
+        mask = (lats >= 45.5) & (lats <= 46.3) & (lons >= 13.6) & (lons <= 15.1)
+        np.testing.assert_array_equal(res['lats'].iloc[0], lats[mask])
+        ref = self.msgs.set_index(['validDateTime', 'validityDateTime', 'shortName'])
+        for _, row in res.iterrows():
+            values = ref.loc[(row['validDateTime'], row['validityDateTime'], row['shortName']), 'values']
+            np.testing.assert_array_equal(row['values'], values[mask])
+
+        self.assertIs(MessageFilter().filter_frame(self.msgs), self.msgs)
+
+
+class TestDecode(unittest.TestCase):
+    """Unit tests for decoding GRIB files."""
+    @classmethod
+    def setUpClass(self):
+        try:
+            import eccodes
+        except ImportError:
+            raise unittest.SkipTest('ecCodes is not installed')
+        self.tmp = tempfile.mkdtemp()
+        self.filepaths = [os.path.join(self.tmp, 'msgs%d.grib' % i) for i in range(3)]
+        for i, filepath in enumerate(self.filepaths):
+            make_grib(filepath, [datetime.date(2017, 11, 1 + i)], [0, 6, 12], ['2t', 'tp'], seed=i)
+
+
+    def test_decode_processes(self):
+        """Test if files decoded in worker processes equal files decoded at once without leaked shared memory."""
+        shm_dir = '/dev/shm'
+        before = set(os.listdir(shm_dir)) if os.path.isdir(shm_dir) else set()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            blocks = decode_files(self.filepaths, 'codes', processes=2)
+        self.assertEqual([str(w.message) for w in caught if 'shared_memory' in str(w.message)], [])
+        if os.path.isdir(shm_dir):
+            self.assertEqual(set(os.listdir(shm_dir)) - before, set())
+
+        expected = decode_files(self.filepaths, 'codes')
+        self.assertEqual(len(blocks), 3)
+        for block, ref in zip(blocks, expected):
+            self.assertEqual(len(block), 6)
+            np.testing.assert_array_equal(block.short_names, ref.short_names)
+            np.testing.assert_array_equal(block.base_times, ref.base_times)
+            np.testing.assert_array_equal(block.validity_times, ref.validity_times)
+            np.testing.assert_array_equal(block.values, ref.values)
+            np.testing.assert_array_equal(block.lats, ref.lats)
+
+    def test_decoders(self):
+        """Test if both ecCodes decoders decode messages like pygrib."""
+        if importlib.util.find_spec('pygrib') is None:
+            self.skipTest('pygrib is not installed')
+        from concurrent.futures import ProcessPoolExecutor
+
+        msg_filter = MessageFilter(params=['2t'], steps=[0, 12])
+        # pygrib and ecCodes may bundle different ecCodes libraries, pygrib is not imported into this process
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            expected = executor.submit(decode_file, self.filepaths[0], 'pygrib').result()
+            filtered = executor.submit(decode_file, self.filepaths[0], 'pygrib', msg_filter).result()
+
+        for decoder in ['codes', 'eccodes']:
+            for block, ref in [(decode_file(self.filepaths[0], decoder), expected),
+                               (decode_file(self.filepaths[0], decoder, msg_filter), filtered)]:
+                self.assertEqual(len(block), len(ref))
+                self.assertEqual(list(block.short_names), list(ref.short_names))
+                np.testing.assert_array_equal(block.base_times, ref.base_times)
+                np.testing.assert_array_equal(block.validity_times, ref.validity_times)
+                self.assertEqual(list(block.types), list(ref.types))
+                np.testing.assert_allclose(block.values, ref.values, rtol=1e-6)
+                np.testing.assert_allclose(block.lats, ref.lats)
+                np.testing.assert_allclose(block.lons, ref.lons)
+        self.assertEqual(len(filtered), 2)
+        block = decode_file(self.filepaths[0], 'codes', msg_filter)
+        self.assertEqual(block.values.shape, (2, 12))
+        self.assertIsNone(block.values.base)
+
+    def test_different_grids(self):
+        """Test if messages on different grids of the same size are not decoded into one block."""
+        filepath = os.path.join(self.tmp, 'grids.grib')
+        make_grib(os.path.join(self.tmp, 'wide.grib'), [datetime.date(2017, 11, 1)], [0], ['2t'], n_lats=3, n_lons=4)
+        make_grib(os.path.join(self.tmp, 'tall.grib'), [datetime.date(2017, 11, 1)], [6], ['2t'], n_lats=4, n_lons=3)
+        with open(filepath, 'wb') as f:
+            for name in ['wide.grib', 'tall.grib']:
+                with open(os.path.join(self.tmp, name), 'rb') as part:
+                    f.write(part.read())
+        with self.assertRaises(ValueError):
+            decode_file(filepath, 'codes')
+        self.assertEqual(len(decode_file(filepath, 'codes', MessageFilter(steps=[6]))), 1)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMessageFilter)
+    unittest.TextTestRunner(verbosity=3).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestDecode)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""
+Lazy message storage tests.
+"""
+
+from ..grib import GribIndex, decode_file
+from ..lazy import FieldCache, LazyMessages
+from ..weather import WeatherExtractor
+from .test_grib import make_grib
+import unittest
+
+import datetime
+import os
+import tempfile
+import numpy as np
+
+
+class TestLazy(unittest.TestCase):
+    """Unit tests for the GribIndex and FieldCache classes."""
+
+    def test_field_cache(self):
+        """Test if the least recently used fields are dropped."""
+        cache = FieldCache(max_size=2)
+        cache.put((0, 1), np.zeros(3))
+        cache.put((0, 2), np.ones(3))
+        self.assertIsNotNone(cache.get((0, 1)))
+        cache.put((0, 3), np.ones(3))
+        self.assertIsNone(cache.get((0, 2)))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+    def test_index_save_load(self):
+        """Test if a stored index restores offsets and header keys."""
+        base = np.datetime64('2017-11-01T00:00:00')
+        index = GribIndex('data.grib', 300, [0, 100, 200], [100, 100, 100], ['2t', 'tp', '2t'],
+                          [base] * 3, base + np.array([0, 6, 6]) * np.timedelta64(1, 'h'), ['fc'] * 3,
+                          np.array([46.5, 46.25]), np.array([13.25, 13.25]))
+        filepath = os.path.join(tempfile.mkdtemp(), 'index.npz')
+        index.save(filepath)
+        loaded = GribIndex.load('data.grib', filepath)
+
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.file_size, 300)
+        np.testing.assert_array_equal(loaded.offsets, index.offsets)
+        np.testing.assert_array_equal(loaded.short_names, index.short_names)
+        np.testing.assert_array_equal(loaded.validity_times, index.validity_times)
+        np.testing.assert_array_equal(loaded.lats, index.lats)
+
+
+class TestLazyGrib(unittest.TestCase):
+    """Unit tests for lazy storage of GRIB files."""
+    @classmethod
+    def setUpClass(self):
+        try:
+            import eccodes
+        except ImportError:
+            raise unittest.SkipTest('ecCodes is not installed')
+        tmp = tempfile.mkdtemp()
+        self.filepaths = [os.path.join(tmp, 'nov1.grib'), os.path.join(tmp, 'nov3.grib')]
+        make_grib(self.filepaths[0], [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)], [0, 6, 12, 24],
+                  ['2t', 'tp', '10u', '10v'])
+        make_grib(self.filepaths[1], [datetime.date(2017, 11, 3)], [0, 6, 12, 24], ['2t', 'tp', '10u', '10v'],
+                  seed=1)
+
+
+    def test_index_build(self):
+        """Test if an index built from message headers reads the decoded values of messages."""
+        block = decode_file(self.filepaths[0], 'codes')
+        index = GribIndex.open(self.filepaths[0], 'codes')
+        self.assertTrue(os.path.exists(GribIndex.index_path(self.filepaths[0])))
+        self.assertEqual(len(index), len(block))
+        np.testing.assert_array_equal(index.short_names, block.short_names.astype(str))
+        np.testing.assert_array_equal(index.base_times, block.base_times)
+        np.testing.assert_array_equal(index.validity_times, block.validity_times)
+        np.testing.assert_array_equal(index.types, block.types.astype(str))
+        np.testing.assert_array_equal(index.lats, block.lats)
+
+        rows = np.array([5, 0, 31])
+        for values, expected in zip(index.read_values(rows, 'codes'), block.values[rows]):
+            np.testing.assert_array_equal(values, expected)
+
+
+    def test_stale_index(self):
+        """Test if the index of a file rewritten with the same size is rebuilt."""
+        filepath = os.path.join(tempfile.mkdtemp(), 'run.grib')
+        make_grib(filepath, [datetime.date(2017, 11, 1)], [0, 6], ['2t'])
+        index = GribIndex.open(filepath, 'codes')
+        size = os.path.getsize(filepath)
+
+        make_grib(filepath, [datetime.date(2017, 11, 2)], [0, 6], ['2t'], seed=1)
+        os.utime(filepath, ns=(index.file_mtime + 10 ** 9, index.file_mtime + 10 ** 9))
+        self.assertEqual(os.path.getsize(filepath), size)
+        self.assertFalse(GribIndex.load(filepath).is_current())
+        index = GribIndex.open(filepath, 'codes')
+        self.assertEqual(str(index.base_times[0]), '2017-11-02T00:00:00')
+        self.assertTrue(GribIndex.load(filepath).is_current())
+
+    def test_lazy_messages(self):
+        """Test if selected messages are decoded on demand and cached."""
+        lazy_msgs = LazyMessages('codes', cache_size=8)
+        for filepath in self.filepaths:
+            lazy_msgs.add(GribIndex.open(filepath, 'codes'))
+        self.assertEqual(len(lazy_msgs), 48)
+
+        start = np.datetime64('2017-11-02T00:00:00')
+        selected = lazy_msgs.select((start, start + np.timedelta64(1, 'D')), same_day=True)
+        self.assertEqual(len(selected), 3 * 4)
+        self.assertEqual(lazy_msgs.cache.misses, 12)
+        self.assertEqual(len(lazy_msgs.cache), 8)
+
+        block = decode_file(self.filepaths[0], 'codes')
+        ref = block.to_frame().set_index(['validDateTime', 'validityDateTime', 'shortName'])['values']
+        for _, row in selected.iterrows():
+            np.testing.assert_array_equal(row['values'],
+                                          ref[(row['validDateTime'], row['validityDateTime'], row['shortName'])])
+        self.assertEqual(len(lazy_msgs.to_frame()), 48)
+
+
+    def test_lazy_queries(self):
+        """Test if lazy storage answers queries like frame storage."""
+        frame, lazy = WeatherExtractor(), WeatherExtractor(storage='lazy')
+        frame.load(self.filepaths)
+        lazy.load(self.filepaths)
+
+        day = datetime.date(2017, 11, 2)
+        for we_query in [lambda we: we.get_forecast(day, day, day + datetime.timedelta(days=1), params=['ws']),
+                         lambda we: we.get_actual(day - datetime.timedelta(days=1), day, aggtime='day'),
+                         lambda we: we.get_actual(day, day, params=['2t', 'tp'], freshest=True)]:
+            res, ref = we_query(lazy), we_query(frame)
+            self.assertGreater(len(res), 0)
+            self.assertEqual(len(res), len(ref))
+            self.assertEqual(list(res['shortName']), list(ref['shortName']))
+            np.testing.assert_array_equal(res['validityDateTime'].values, ref['validityDateTime'].values)
+            np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']), rtol=1e-6)
+
+
+    def test_lazy_append(self):
+        """Test if appended messages replace loaded ones in lazy storage like in frame storage."""
+        frame, lazy = WeatherExtractor(), WeatherExtractor(storage='lazy')
+        for we in [frame, lazy]:
+            we.load(self.filepaths[0])
+            we.append(self.filepaths[0])
+        self.assertEqual(len(lazy.lazy_msgs), 32)
+
+        day = datetime.date(2017, 11, 2)
+        for we_query in [lambda we: we.get_forecast(day, day, day + datetime.timedelta(days=1)),
+                         lambda we: we.get_actual(day, day, aggtime='day', aggfunc='sum'),
+                         lambda we: we.get_best_available(day, day, params=['2t'])]:
+            res, ref = we_query(lazy), we_query(frame)
+            self.assertGreater(len(res), 0)
+            self.assertEqual(len(res), len(ref))
+            self.assertEqual(list(res['shortName']), list(ref['shortName']))
+            np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']), rtol=1e-6)
+
+        lazy.append(self.filepaths[1])
+        self.assertEqual(len(lazy.lazy_msgs), 48)
+        self.assertEqual(len(lazy.get_forecast(day, day, day + datetime.timedelta(days=1))),
+                         len(frame.get_forecast(day, day, day + datetime.timedelta(days=1))))
+
+    def test_crop_mismatch(self):
+        """Test if files cropped to a different area cannot be added to lazy storage."""
+        lazy = WeatherExtractor(storage='lazy')
+        lazy.load(self.filepaths[0], bbox=[[46.6, 13.2], [46.2, 13.6]])
+        self.assertEqual(len(lazy._grid()[0]), 4)
+        with self.assertRaises(ValueError):
+            lazy.load(self.filepaths[1])
+        lazy.append(self.filepaths[1])
+        self.assertEqual(len(lazy.lazy_msgs), 48)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLazy)
+    unittest.TextTestRunner(verbosity=3).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLazyGrib)
+    unittest.TextTestRunner(verbosity=3).run(suite)
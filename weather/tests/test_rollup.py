@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+"""
+Daily and weekly rollup tests.
+"""
+
+from ..cube import WeatherCube
+from ..rollup import Rollups, has_rollups, week_ends
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import os
+import tempfile
+import numpy as np
+
+
+class TestRollups(unittest.TestCase):
+    """Unit tests for answering queries from rollups."""
+    @classmethod
+    def setUpClass(self):
+        base_dates = [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)]
+        self.msgs = make_messages(base_dates, [0, 6, 12, 30, 54, 126, 222], ['2t', 'tp'])
+        self.we = WeatherExtractor(storage='cube')
+        self.we.cube = WeatherCube.from_frame(self.msgs)
+        self.we._update_rollups()
+
+
+    def compare(self, query, *args, **kwargs):
+        """Compare a query answered from rollups with the same query on hourly messages."""
+        rollups = self.we.rollups
+        res = query(*args, **kwargs)
+        self.we.rollups = None
+        ref = query(*args, **kwargs)
+        self.we.rollups = rollups
+
+        self.assertEqual(list(res.columns), list(ref.columns))
+        for column in ['validDateTime', 'validityDateTime', 'shortName']:
+            self.assertEqual(list(res[column]), list(ref[column]))
+        np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']), rtol=1e-5)
+
+
+    def test_week_ends(self):
+        """Test if days are labeled by the Sunday ending their week."""
+        days = np.array(['2017-11-05', '2017-11-06', '2017-11-12'], dtype='datetime64[D]')
+        np.testing.assert_array_equal(week_ends(days), np.array(['2017-11-05', '2017-11-12', '2017-11-12'],
+                                                                dtype='datetime64[D]'))
+
+
+    def test_queries(self):
+        """Test if rollups answer daily and weekly queries as hourly messages do."""
+        day = datetime.timedelta(days=1)
+        base = datetime.date(2017, 11, 1)
+        points = [{'lat': 46.0, 'lon': 14.5}, {'lat': 46.1, 'lon': 13.3}]
+        self.compare(self.we.get_actual, base, base + day, aggtime='day')
+        self.compare(self.we.get_actual, base, base + day, aggtime='week', aggloc='points', interp_points=points)
+        # partial weeks at both ends of the window and one whole week
+        self.compare(self.we.get_forecast, base, base, base + 12 * day, aggtime='week',
+                     aggfunc={'2t': 'max', 'tp': 'sum'})
+        self.compare(self.we.get_forecast, base, base, base + 4 * day, aggtime='day', aggloc='bbox',
+                     bounding_box=[[46.0, 13.25], [46.3, 13.8]])
+
+
+    def test_save_load(self):
+        """Test if stored rollups are updated for appended base days."""
+        path = os.path.join(tempfile.mkdtemp(), 'partitioned')
+        for base_date in [datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)]:
+            we = WeatherExtractor(storage='cube')
+            we.cube = WeatherCube.from_frame(self.msgs[self.msgs['validDateTime'].dt.date == base_date])
+            we.store(path, format='partitioned', rollups=True)
+        self.assertTrue(has_rollups(path))
+
+        rollups = Rollups.load(path)
+        for level in ['day', 'week']:
+            layer, ref = rollups.layers[level], self.we.rollups.layers[level]
+            self.assertEqual(len(layer), len(ref))
+            for stat in ['mean', 'min', 'max', 'count']:
+                np.testing.assert_allclose(np.vstack(layer[stat]), np.vstack(ref[stat]), rtol=1e-6)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRollups)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+"""
+Nearest grid point lookup tests.
+"""
+
+from ..spatial import GridIndex, QueryPlan, QueryPlanCache
+import unittest
+
+import os
+import tempfile
+import numpy as np
+
+
+def closest_reference(lats, lons, target_lats, target_lons):
+    """Full search with the first minimum winning ties."""
+    dist = (lats[:, None] - target_lats[None, :])**2 + (lons[:, None] - target_lons[None, :])**2
+    return np.argmin(dist, axis=1)
+
+
+class TestGridIndex(unittest.TestCase):
+    """Unit tests for the GridIndex class."""
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.RandomState(0)
+        lats, lons = np.meshgrid(46.5 - 0.25 * np.arange(6), 13.25 + 0.25 * np.arange(14), indexing='ij')
+        self.lats, self.lons = lats.flatten(), lons.flatten()
+
+        # random points, points halfway between grid points and points outside of the grid
+        self.query_lats = np.concatenate([rng.uniform(44, 48, 200), 46.5 - 0.125 * np.arange(12), [50., 40.]])
+        self.query_lons = np.concatenate([rng.uniform(12, 18, 200), 13.25 + 0.125 * np.arange(12), [10., 20.]])
+
+
+    def test_regular(self):
+        """Test if lookups on a regular grid match the full search."""
+        for lats in [self.lats, self.lats[::-1].copy()]:
+            index = GridIndex(lats, self.lons)
+            self.assertTrue(index.is_regular)
+            np.testing.assert_array_equal(index.nearest(self.query_lats, self.query_lons),
+                                          closest_reference(self.query_lats, self.query_lons, lats, self.lons))
+
+
+    def test_irregular(self):
+        """Test if lookups on scattered points match the full search."""
+        rng = np.random.RandomState(1)
+        for n_points in [5, 1000]:
+            lats, lons = rng.uniform(45, 47, n_points), rng.uniform(13, 17, n_points)
+            # duplicated points produce ties
+            lats, lons = np.concatenate([lats, lats[:3]]), np.concatenate([lons, lons[:3]])
+            index = GridIndex(lats, lons)
+            self.assertFalse(index.is_regular)
+            np.testing.assert_array_equal(index.nearest(self.query_lats, self.query_lons),
+                                          closest_reference(self.query_lats, self.query_lons, lats, lons))
+
+
+class TestQueryPlan(unittest.TestCase):
+    """Unit tests for the QueryPlan and QueryPlanCache classes."""
+    @classmethod
+    def setUpClass(self):
+        lats, lons = np.meshgrid(46.5 - 0.25 * np.arange(6), 13.25 + 0.25 * np.arange(14), indexing='ij')
+        self.lats, self.lons = lats.flatten(), lons.flatten()
+        self.values = np.random.RandomState(0).rand(5, len(self.lats))
+
+
+    def test_apply(self):
+        """Test if plans gather closest points and average bounding boxes."""
+        points = (np.array([46.0, 45.3]), np.array([14.5, 16.0]))
+        plan = QueryPlan.build(self.lats, self.lons, 'points', interp_points=points)
+        closest = closest_reference(points[0], points[1], self.lats, self.lons)
+        np.testing.assert_array_equal(plan.apply(self.values), self.values[:, closest])
+
+        plan = QueryPlan.build(self.lats, self.lons, 'bbox', bounding_box=[[46.3, 15.1], [45.5, 13.6]])
+        mask = (self.lats >= 45.5) & (self.lats <= 46.3) & (self.lons >= 13.6) & (self.lons <= 15.1)
+        np.testing.assert_allclose(plan.apply(self.values), self.values[:, mask].mean(axis=1)[:, None])
+
+
+    def test_save_load(self):
+        """Test if a stored plan gives the same results."""
+        plan = QueryPlan.build(self.lats, self.lons, 'bbox', bounding_box=[[45.5, 13.6], [46.3, 15.1]])
+        filepath = os.path.join(tempfile.mkdtemp(), 'plan.npz')
+        plan.save(filepath)
+        loaded = QueryPlan.load(filepath)
+
+        self.assertEqual(loaded.fingerprint, plan.fingerprint)
+        self.assertEqual((loaded.aggloc, loaded.aggtype), ('bbox', 'mean'))
+        np.testing.assert_array_equal(loaded.apply(self.values), plan.apply(self.values))
+
+
+    def test_cache(self):
+        """Test if the same targets reuse the cached plan."""
+        cache = QueryPlanCache(max_size=2)
+        plan = cache.get(self.lats, self.lons, 'country')
+        self.assertIs(cache.get(self.lats, self.lons, 'country'), plan)
+        self.assertIsNot(cache.get(self.lats, self.lons + 1.0, 'country'), plan)
+
+        box = [[45.5, 13.6], [46.3, 15.1]]
+        plan = cache.get(self.lats, self.lons, 'bbox', bounding_box=box)
+        self.assertIs(cache.get(self.lats, self.lons, 'bbox', bounding_box=box[::-1]), plan)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestGridIndex)
+    unittest.TextTestRunner(verbosity=3).run(suite)
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestQueryPlan)
+    unittest.TextTestRunner(verbosity=3).run(suite)
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+"""
+Sorted time index tests.
+"""
+
+from ..archive import PartitionedArchive
+from ..timeindex import FreshestIndex, TimeIndex
+from ..weather import WeatherExtractor
+from .test_cube import make_messages
+import unittest
+
+import datetime
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class TestTimeIndex(unittest.TestCase):
+    """Unit tests for the TimeIndex class and frame storage selections."""
+    @classmethod
+    def setUpClass(self):
+        self.base_dates = [datetime.date(2017, 11, 3), datetime.date(2017, 11, 1), datetime.date(2017, 11, 2)]
+        self.msgs = make_messages(self.base_dates, [30, 0, 6, 12, 24], ['tp', '2t', '10u', '10v'])
+
+
+    def test_rows(self):
+        """Test if binary search selects the same messages as masks over all messages."""
+        msgs = self.msgs.iloc[TimeIndex.order(self.msgs)]
+        index = TimeIndex.from_frame(msgs)
+        self.assertEqual(len(index), len(msgs))
+        self.assertEqual(list(index.params), ['10u', '10v', '2t', 'tp'])
+        base = msgs['validDateTime'].values.astype('datetime64[s]')
+        validity = msgs['validityDateTime'].values.astype('datetime64[s]')
+        self.assertTrue(np.all(np.diff(base.astype(np.int64)) >= 0))
+
+        day = np.timedelta64(1, 'D')
+        start = np.datetime64('2017-11-02', 's')
+        for base_range, validity_range, same_day, params in [
+                ((start, start + day), None, False, None),
+                ((start - day, start + day), (start, start + day), False, None),
+                ((start - day, start + 2 * day), None, True, ['2t', 'tp']),
+                ((start + 5 * day, start + 6 * day), None, False, None)]:
+            keep = (base >= base_range[0]) & (base < base_range[1])
+            if validity_range is not None:
+                keep &= (validity >= validity_range[0]) & (validity < validity_range[1])
+            if same_day:
+                keep &= validity.astype('datetime64[D]') == base.astype('datetime64[D]')
+            if params is not None:
+                keep &= msgs['shortName'].isin(params).values
+            rows = index.rows(base_range, validity_range, same_day, params=params)
+            np.testing.assert_array_equal(rows, np.flatnonzero(keep))
+
+
+    def test_frame_queries(self):
+        """Test if frame storage answers queries like cube storage."""
+        filepath = os.path.join(tempfile.mkdtemp(), 'msgs.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(self.msgs, f)
+        frame, cube = WeatherExtractor(), WeatherExtractor(storage='cube')
+        frame.load(filepath)
+        cube.load(filepath)
+        self.assertTrue(frame.grib_msgs['validDateTime'].is_monotonic_increasing)
+
+        day = datetime.date(2017, 11, 2)
+        for we_query in [lambda we: we.get_forecast(day, day, day + datetime.timedelta(days=1), params=['ws']),
+                         lambda we: we.get_actual(day - datetime.timedelta(days=1), day, aggtime='day'),
+                         lambda we: we.get_actual(day, day, params=['2t', 'tp'])]:
+            res, ref = we_query(frame), we_query(cube)
+            self.assertGreater(len(res), 0)
+            self.assertEqual(len(res), len(ref))
+            self.assertEqual(list(res['shortName']), list(ref['shortName']))
+            np.testing.assert_array_equal(res['validityDateTime'].values, ref['validityDateTime'].values)
+            np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']), rtol=1e-6)
+
+
+    def test_freshest(self):
+        """Test if the freshest forecast of midnight and noon runs is found for each hour and parameter."""
+        noon = make_messages(self.base_dates, [0, 6, 12, 24], ['tp', '2t', '10u', '10v'], seed=1)
+        for column in ['validDateTime', 'validityDateTime']:
+            noon[column] += pd.Timedelta(hours=12)
+        msgs = pd.concat([self.msgs, noon], ignore_index=True)
+        base = msgs['validDateTime'].values.astype('datetime64[s]')
+        validity = msgs['validityDateTime'].values.astype('datetime64[s]')
+
+        start = np.datetime64('2017-11-01', 's')
+        for min_lead in [0, 12]:
+            index = FreshestIndex(base, validity, msgs['shortName'], min_lead=np.timedelta64(min_lead, 'h'))
+            rows = index.rows((start, start + np.timedelta64(4, 'D')), params=['2t', 'tp'])
+            self.assertTrue(np.all(np.diff(validity[rows].astype(np.int64)) >= 0))
+            for (valid, name), group in msgs[(validity - base >= np.timedelta64(min_lead, 'h')) &
+                                             msgs['shortName'].isin(['2t', 'tp']).values].groupby(
+                                                 ['validityDateTime', 'shortName']):
+                row = rows[(validity[rows] == np.datetime64(valid, 's')) & (msgs['shortName'].values[rows] == name)]
+                self.assertEqual(len(row), 1)
+                self.assertEqual(base[row[0]], group['validDateTime'].values.astype('datetime64[s]').max())
+
+        filepath = os.path.join(tempfile.mkdtemp(), 'msgs.pkl')
+        with open(filepath, 'wb') as f:
+            pickle.dump(msgs, f)
+        frame, cube = WeatherExtractor(), WeatherExtractor(storage='cube')
+        frame.load(filepath)
+        cube.load(filepath)
+        day = datetime.date(2017, 11, 2)
+        res = frame.get_best_available(day, day + datetime.timedelta(days=1), params=['ws'], min_lead=6)
+        ref = cube.get_best_available(day, day + datetime.timedelta(days=1), params=['ws'], min_lead=6)
+        self.assertEqual(len(res), len(np.unique(res['validityDateTime'])))
+        np.testing.assert_array_equal(res['validDateTime'].values, ref['validDateTime'].values)
+        np.testing.assert_allclose(np.vstack(res['values']), np.vstack(ref['values']), rtol=1e-6)
+
+        actual = frame.get_actual(day, day, aggtime='day', params=['2t'], freshest=True)
+        self.assertEqual(len(actual), 1)
+        np.testing.assert_allclose(actual['values'].iloc[0], np.mean(np.vstack(
+            frame.get_best_available(day, day, params=['2t'])['values']), axis=0))
+
+
+    def test_append(self):
+        """Test if appended messages are merged into the index and stored like a full reload."""
+        tmp = tempfile.mkdtemp()
+        new = make_messages([datetime.date(2017, 11, 2), datetime.date(2017, 11, 5)], [0, 6], ['2t', '10u', '10v'],
+                            seed=2)
+        # new messages replace loaded ones
+        merged = pd.concat([self.msgs, new]).drop_duplicates(['validDateTime', 'validityDateTime', 'shortName'],
+                                                             keep='last')
+        files = []
+        for i, msgs in enumerate([self.msgs, new, merged]):
+            files.append(os.path.join(tmp, '%d.pkl' % i))
+            with open(files[-1], 'wb') as f:
+                pickle.dump(msgs, f)
+        archive = os.path.join(tmp, 'archive')
+
+        we, ref = WeatherExtractor(), WeatherExtractor()
+        we.load(files[0], rollups=True)
+        we.store(archive, format='partitioned', rollups=True)
+        day = datetime.date(2017, 11, 2)
+        we.get_actual(day, day, params=['ws'])
+        we.append(files[1], archive=archive)
+        ref.load(files[2], rollups=True)
+
+        self.assertEqual(len(we.grib_msgs), len(ref.grib_msgs))
+        np.testing.assert_array_equal(we.time_index.base_times, ref.time_index.base_times)
+        np.testing.assert_array_equal(we.time_index.validity_times, ref.time_index.validity_times)
+        np.testing.assert_array_equal(we.time_index.params[we.time_index.param_codes],
+                                      ref.time_index.params[ref.time_index.param_codes])
+        for res, expected in [(we.get_actual(day, day, params=['ws']), ref.get_actual(day, day, params=['ws'])),
+                              (we.get_actual(day, day, aggtime='day'), ref.get_actual(day, day, aggtime='day'))]:
+            self.assertEqual(list(res['shortName']), list(expected['shortName']))
+            np.testing.assert_allclose(np.vstack(res['values']), np.vstack(expected['values']), rtol=1e-6)
+
+        stored = WeatherExtractor(storage='lazy')
+        stored.load(archive, rollups=True)
+        self.assertEqual(len(PartitionedArchive(archive)), len(ref.grib_msgs))
+        res = stored.get_actual(day, day, aggtime='day')
+        expected = ref.get_actual(day, day, aggtime='day')
+        np.testing.assert_allclose(np.vstack(res['values']), np.vstack(expected['values']), rtol=1e-6)
+
+
+if __name__=="__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTimeIndex)
+    unittest.TextTestRunner(verbosity=3).run(suite)
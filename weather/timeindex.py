@@ -0,0 +1,210 @@
+"""
+Sorted time index of weather messages.
+
+Message metadata is kept as datetime64[s] arrays of base and validity datetimes ordered by
+(base, validity, parameter), with parameters and mars types as categorical codes. Time
+windows are found by binary search on the sorted arrays, so selections cost time
+proportional to the number of selected messages instead of the number of loaded ones.
+Indices of new messages are merged in without sorting the loaded ones again.
+
+FreshestIndex maps each validity datetime and parameter to the freshest forecast message,
+so continuous series of the best available forecasts are gathered in one lookup.
+
+Example:
+    $ order = TimeIndex.order(grib_msgs)
+    $ grib_msgs = grib_msgs.iloc[order]
+    $ index = TimeIndex.from_frame(grib_msgs)
+    $ selected = grib_msgs.iloc[index.rows((np.datetime64('2017-11-01'), np.datetime64('2017-11-02')))]
+    $ freshest = FreshestIndex(index.base_times, index.validity_times, index.params[index.param_codes])
+    $ best = grib_msgs.iloc[freshest.rows((np.datetime64('2017-01-01'), np.datetime64('2018-01-01')))]
+"""
+import numpy as np
+import pandas as pd
+
+from .cube import to_datetime64
+
+
+class TimeIndex:
+    """
+    Index of messages ordered by base datetime, validity datetime and parameter.
+
+    Args:
+        base_times, validity_times (np.array): datetimes of the ordered messages
+        short_names, types (np.array(dtype=str)): parameters and mars types of the ordered messages
+
+    Attributes:
+        params, types (np.array(dtype=str)): categories of parameters and mars types
+        param_codes, type_codes (np.array(dtype=int)): category of each message
+    """
+
+    def __init__(self, base_times, validity_times, short_names, types):
+        params, param_codes = np.unique(np.asarray(short_names, dtype=str), return_inverse=True)
+        types, type_codes = np.unique(np.asarray(types, dtype=str), return_inverse=True)
+        self._index(base_times, validity_times, params, param_codes, types, type_codes)
+
+    def _index(self, base_times, validity_times, params, param_codes, types, type_codes):
+        """ Set ordered metadata with categorical codes and find the rows of each base datetime. """
+        self.base_times = np.asarray(base_times, dtype='datetime64[s]')
+        self.validity_times = np.asarray(validity_times, dtype='datetime64[s]')
+        self.params, self.types = params, types
+        self.param_codes = param_codes.astype(np.int16)
+        self.type_codes = type_codes.astype(np.int8)
+
+        # rows of each distinct base datetime, base datetimes are ordered
+        changes = np.ones(len(self.base_times), dtype=bool)
+        changes[1:] = self.base_times[1:] != self.base_times[:-1]
+        self._base_starts = np.flatnonzero(changes)
+        self._bases = self.base_times[self._base_starts]
+        self._base_stops = np.append(self._base_starts[1:], len(self.base_times))
+
+    def __len__(self):
+        return len(self.base_times)
+
+    @staticmethod
+    def order(grib_msgs):
+        """ Positions ordering a frame of weather messages by base datetime, validity datetime and parameter. """
+        return np.lexsort((np.asarray(grib_msgs['shortName'], dtype=str), to_datetime64(grib_msgs['validityDateTime']),
+                           to_datetime64(grib_msgs['validDateTime'])))
+
+    @classmethod
+    def from_frame(cls, grib_msgs):
+        """ Index of an ordered frame of weather messages. """
+        return cls(to_datetime64(grib_msgs['validDateTime']), to_datetime64(grib_msgs['validityDateTime']),
+                   grib_msgs['shortName'], grib_msgs['type'])
+
+    def merge(self, other):
+        """
+        Merge the index of new ordered messages. New messages replace indexed messages with the same
+        base datetime, validity datetime and parameter; only rows of base datetimes present in both
+        indices are compared and reordered, the others are merged without sorting.
+
+        Args:
+            other (TimeIndex): index of the new messages
+
+        Returns:
+            tuple: merged TimeIndex and positions of its messages in the indexed messages followed by
+                the new messages
+        """
+        n = len(self)
+        params = np.union1d(self.params, other.params)
+        types = np.union1d(self.types, other.types)
+        param_codes = np.concatenate([np.searchsorted(params, self.params)[self.param_codes],
+                                      np.searchsorted(params, other.params)[other.param_codes]])
+        type_codes = np.concatenate([np.searchsorted(types, self.types)[self.type_codes],
+                                     np.searchsorted(types, other.types)[other.type_codes]])
+        base = np.concatenate([self.base_times, other.base_times])
+        validity = np.concatenate([self.validity_times, other.validity_times])
+
+        # drop indexed messages replaced by new ones
+        common = np.isin(self._bases, other._bases)
+        overlap = np.concatenate([np.arange(lo, hi, dtype=np.int64) for lo, hi in
+                                  zip(self._base_starts[common], self._base_stops[common])] + [np.zeros(0, np.int64)])
+        keep = np.ones(n, dtype=bool)
+        if len(overlap) > 0:
+            keys = pd.MultiIndex.from_arrays([base[overlap], validity[overlap], param_codes[overlap]])
+            new_keys = pd.MultiIndex.from_arrays([other.base_times, other.validity_times, param_codes[n:]])
+            keep[overlap[keys.isin(new_keys)]] = False
+        kept = np.flatnonzero(keep)
+
+        # insert new messages after indexed messages of the same or earlier base datetimes
+        at = np.searchsorted(self.base_times[kept], other.base_times, side='right')
+        order = np.insert(kept, at, n + np.arange(len(other)))
+
+        # reorder rows of base datetimes present in both indices by validity datetime and parameter
+        merged_base = base[order]
+        for common_base in self._bases[common]:
+            lo, hi = np.searchsorted(merged_base, [common_base, common_base + np.timedelta64(1, 's')])
+            block = order[lo:hi]
+            order[lo:hi] = block[np.lexsort((param_codes[block], validity[block]))]
+
+        merged = TimeIndex.__new__(TimeIndex)
+        merged._index(base[order], validity[order], params, param_codes[order], types, type_codes[order])
+        return merged, order
+
+    def rows(self, base_range, validity_range=None, same_day=False, params=None):
+        """
+        Find messages in a time window, see WeatherCube.select for arguments.
+
+        Args:
+            params (list): short names of the selected parameters, all if None
+
+        Returns:
+            np.array(dtype=int): ordered positions of the selected messages
+        """
+        start, stop = np.asarray(base_range, dtype='datetime64[s]')
+        first, last = np.searchsorted(self._bases, [start, stop])
+        v_start, v_stop = None, None
+        if validity_range is not None:
+            v_start, v_stop = np.asarray(validity_range, dtype='datetime64[s]')
+
+        segments = []
+        for base, lo, hi in zip(self._bases[first:last], self._base_starts[first:last], self._base_stops[first:last]):
+            seg_start, seg_stop = v_start, v_stop
+            if same_day:
+                day = base.astype('datetime64[D]').astype('datetime64[s]')
+                next_day = day + np.timedelta64(1, 'D')
+                seg_start = day if seg_start is None else max(seg_start, day)
+                seg_stop = next_day if seg_stop is None else min(seg_stop, next_day)
+            if seg_start is not None:
+                # messages of one base datetime are ordered by validity
+                lo, hi = lo + np.searchsorted(self.validity_times[lo:hi], [seg_start, seg_stop])
+            segments.append(np.arange(lo, max(lo, hi)))
+        rows = np.concatenate(segments) if len(segments) > 0 else np.zeros(0, dtype=np.int64)
+
+        if params is not None:
+            rows = rows[np.isin(self.param_codes[rows], np.flatnonzero(np.isin(self.params, list(params))))]
+        return rows
+
+
+class FreshestIndex:
+    """
+    Index of the freshest forecast of each validity datetime and parameter, i.e. the message of the
+    latest base run (of any hour, e.g. midnight and noon runs) made at least min_lead before.
+
+    Args:
+        base_times, validity_times (np.array): datetimes of messages in any order
+        short_names (np.array(dtype=str)): parameters of messages
+        min_lead (np.timedelta64): minimal lead time (validity - base datetime) of used messages
+
+    Attributes:
+        validity_times (np.array(dtype='datetime64[s]')): ordered validity datetimes of index entries
+        params (np.array(dtype=str)): categories of parameters
+        param_codes (np.array(dtype=int)): parameter category of each entry
+        positions (np.array(dtype=int)): position of the freshest message of each entry in the given arrays
+    """
+
+    def __init__(self, base_times, validity_times, short_names, min_lead=np.timedelta64(0, 's')):
+        base = np.asarray(base_times, dtype='datetime64[s]')
+        validity = np.asarray(validity_times, dtype='datetime64[s]')
+        self.params, codes = np.unique(np.asarray(short_names, dtype=str), return_inverse=True)
+        self.min_lead = min_lead
+
+        # order by validity, parameter and base datetime, the freshest message is the last of each group
+        candidates = np.flatnonzero(validity - base >= min_lead)
+        order = candidates[np.lexsort((base[candidates], codes[candidates], validity[candidates]))]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (validity[order][1:] != validity[order][:-1]) | (codes[order][1:] != codes[order][:-1])
+
+        self.positions = order[last]
+        self.validity_times = validity[self.positions]
+        self.param_codes = codes[self.positions].astype(np.int16)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def rows(self, validity_range, params=None):
+        """
+        Find the freshest messages in a validity window.
+
+        Args:
+            validity_range (tuple): half-open interval [start, stop) of validity datetimes (np.datetime64)
+            params (list): short names of the selected parameters, all if None
+
+        Returns:
+            np.array(dtype=int): positions of the messages ordered by validity datetime and parameter
+        """
+        lo, hi = np.searchsorted(self.validity_times, np.asarray(validity_range, dtype='datetime64[s]'))
+        positions = self.positions[lo:hi]
+        if params is not None:
+            positions = positions[np.isin(self.param_codes[lo:hi], np.flatnonzero(np.isin(self.params, list(params))))]
+        return positions
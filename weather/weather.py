@@ -14,14 +14,28 @@ Todo:
 """
 from __future__ import print_function
 import datetime
-import math
 import json
+import os
 import pickle
 from collections import defaultdict
 
 import numpy as np
 import pandas as pd
 
+from .archive import (PartitionedArchive, is_archive, is_partitioned_archive, read_archive, write_archive,
+                      write_partitioned_archive)
+from .cache import ResultCache, plan_key, query_key
+from .cube import FRAME_COLUMNS, WeatherCube, object_array, to_datetime64
+from .derived import default_params, derive, required_inputs
+from .export import (at_points, day_chunks, db_chunk, features_chunk, map_chunks, qminer_chunk, tensor_chunk,
+                     write_chunks)
+from .features import CUM_PARAMS, FEATURE_WINDOWS, INSTANT_PARAMS, tensor_features
+from .grib import GribIndex, MessageFilter, decode_files, default_decoder
+from .lazy import FieldCache, LazyMessages
+from .rollup import ROLLUP_LEVELS, ROLLUP_STATS, Rollups, has_rollups, week_ends
+from .spatial import QueryPlanCache, QueryPlan, grid_index
+from .timeindex import FreshestIndex, TimeIndex
+
 """
     Best estimation for actual weather is forecast with a base date on the current day.
 
@@ -67,6 +81,25 @@ class WeatherExtractor:
     It supports actual weather queries ( via .get_actual(...) ) and forecasted weather
     queries ( via .get_forecast(...) )
 
+    Loaded messages are kept in one of the following storage modes:
+        storage='frame': pandas.DataFrame with one row per message (self.grib_msgs)
+        storage='cube': dense float32 WeatherCube indexed by base datetime, validity step,
+            parameter and grid point (self.cube), which is several times smaller and
+            answers queries by array slicing
+        storage='lazy': only the sidecar indices of GRIB files are loaded (self.lazy_msgs),
+            message values are decoded when a query first touches them and kept in a
+            bounded LRU cache of lazy_cache_size messages
+
+    Queries aggregated by day or week are answered from daily and weekly rollups (self.rollups)
+    when they are loaded or built with .load(..., rollups=True), see rollup.Rollups.
+
+    With result_cache_bytes set, query results are kept in an LRU cache (self.result_cache) within
+    the given memory budget until the next load; cached results are read-only and hit/miss
+    statistics are given by self.result_cache.stats().
+
+    Queries do not change loaded data and shared caches are locked, so one extractor can serve
+    queries from many threads; loading must not run concurrently with queries.
+
     Examples
         $ we = WeatherExtractor()
         $ we.load('example_data.grib')
@@ -93,63 +126,40 @@ class WeatherExtractor:
                     aggtime='day': aggregation by day
                     aggtime='week': aggregation by week
 
+        Continuous series of the freshest forecasts available for each hour (made at least min_lead
+        hours before) are queried in the following format:
+
+            $ wa.get_best_available(from_date, to_date, aggtime, min_lead=0)
+
     """
 
-    def __init__(self):
+    def __init__(self, storage='frame', lazy_cache_size=4096, result_cache_bytes=None):
+        assert storage in ['frame', 'cube', 'lazy']
+        self.storage = storage
         self.grib_msgs = None
-
-    def _load_from_grib(self, filepath, grib_reader):
-        """ Load measurements from GRIB file. """
-        # load grib messages
-        grib_messages = []
-        lats, lons = None, None
-
-        if grib_reader[1] == 'eccodes':
-            grbs = grib_reader[0](filepath)
-            for i in range(len(grbs)):
-                grib_msg = grbs.next()
-
-                if lats is None:
-                    lats = grib_msg['latitudes'].flatten()
-                    lons = grib_msg['longitudes'].flatten()
-
-                grib_messages.append({
-                    'shortName': grib_msg['shortName'],
-                    'values': grib_msg['values'].flatten(),
-                    'validDateTime': WeatherExtractor._str_to_datetime(
-                        str(grib_msg['date']) + str(grib_msg['time'])),
-                    'validityDateTime': WeatherExtractor._str_to_datetime(
-                        str(grib_msg['validityDate']) + str(grib_msg['validityTime'])),
-                    'lats': lats,
-                    'lons': lons,
-                    'type': grib_msg['marsType']  # forecast or actual
-                })
-            grbs.close()
-        else:
-            grbs = grib_reader[0](filepath)
-        
-            lats, lons = grbs.message(1).latlons()
-            lats, lons = lats.flatten(), lons.flatten()
-            
-            grbs.rewind()
-            for grib_msg in grbs:
-                grib_messages.append({
-                    'shortName': grib_msg.shortName,
-                    'values': grib_msg.values.flatten(),
-                    'validDateTime': grib_msg.validDate,
-                    'validityDateTime': WeatherExtractor._str_to_datetime(
-                        str(grib_msg.validityDate) + str(grib_msg.validityTime)),
-                    'lats': lats,
-                    'lons': lons,
-                    'type': grib_msg.marsType  # forecast or actual
-                })
-            grbs.close()
-        return pd.DataFrame.from_dict(grib_messages)
+        # sorted index of base and validity datetimes of grib_msgs
+        self.time_index = None
+        self.cube = None
+        self.lazy_msgs = None
+        self.lazy_cache_size = lazy_cache_size
+        self.query_plans = QueryPlanCache()
+        self.derived_cache = FieldCache()
+        # freshest forecast indices by minimal lead time, built on first use
+        self.freshest_indices = {}
+        # selection of the last load applied to appended messages
+        self.append_filter = MessageFilter()
+        self.rollups = None
+        # version of loaded data, changed by every load
+        self.data_version = 0
+        self.result_cache = None if result_cache_bytes is None else ResultCache(result_cache_bytes)
 
     def _load_from_pkl(self, filepath):
-        """ Load already processed pandas.DataFrame. """
+        """ Load already processed pandas.DataFrame or WeatherCube. """
         with open(filepath, 'rb') as f:
-            return pickle.load(f)
+            data = pickle.load(f)
+        if isinstance(data, WeatherCube):
+            data = data.to_frame()
+        return data
 
     def _load_from_owmjson(self, filepath):
         """ Load measurements from OpenWeatherMap json response. """
@@ -193,7 +203,8 @@ class WeatherExtractor:
             
         return pd.DataFrame.from_dict(grib_messages)
 
-    def load(self, filepaths, format=None):
+    def load(self, filepaths, format=None, processes=None, params=None, base_dates=None, steps=None, bbox=None,
+             rollups=False):
         """
         Load weather data from grib file obtained via API request or from
         the pickled pandas.DataFrame.
@@ -204,9 +215,25 @@ class WeatherExtractor:
                 'grib': files are stored in grib format
                 'pkl': files are stored in binary form (pickled)
                 'owm': files are stored in OpenWeatherMap json format
+                'archive': directories written by .store(..., format='archive'), values are memory-mapped
+                'partitioned': directory written by .store(..., format='partitioned'), only partitions
+                    overlapping base_dates are opened; in lazy storage each query opens only the
+                    partitions overlapping its time window
 
                 if format is not specified it is automatically inferred from file prefix
-                (.grib, .pkl or .json)
+                (.grib, .pkl or .json) or from the archive directory layout
+            processes (int): number of worker processes decoding GRIB files in parallel,
+                by default files are decoded one after another
+            params (list): parameter short names to load, all if None; for derived parameters
+                (see derived.DERIVED_PARAMS) their inputs are loaded and they are calculated by queries
+            base_dates (tuple): (from_date, to_date) window of base dates to load (both inclusive), all if None
+            steps (list): forecast steps in hours (validity - base datetime) to load, all if None
+            bbox ([[lat1,lon1], [lat2,lon2]]): corner points of the area to load, whole grid if None
+
+            GRIB messages outside of the selection are skipped before their values are decoded.
+            rollups (bool): keep daily and weekly rollups answering queries with aggtime='day' or 'week';
+                rollups stored with archives are loaded (unless steps are given), otherwise they are
+                built for the base days of the loaded messages; loading without rollups drops them
         
         Warning:
             after 2015-5-13 number of parameters increases from 11 to 15 and
@@ -216,117 +243,367 @@ class WeatherExtractor:
         if not isinstance(filepaths, list):
             filepaths = [filepaths]  # wrap in list
         
-        grib_reader = None
         if format is None:
-            if all(f.endswith('.grib') for f in filepaths):
-                format = 'grib'
-
-                try:
-                    import eccodes
-                    grib_reader = (eccodes.GribFile, 'eccodes')
-                except ImportError:
-                    import pygrib
-                    grib_reader = (pygrib.open, 'pygrib')
-                print('Using ', grib_reader[1], ' as GRIB decoder.')
-
-            elif all(f.endswith('.pkl') for f in filepaths):
-                format = 'pkl'
-            elif all(f.endswith('.json') for f in filepaths):
-                format = 'owm'
-            else:
-                raise ValueError("Could not infer the file format.")
-
-        for filepath in filepaths:
-            curr_msgs = None
-
-            if format == 'grib':
-                curr_msgs = self._load_from_grib(filepath, grib_reader)
-            elif format == 'pkl':
-                curr_msgs = self._load_from_pkl(filepath)
-            elif format == 'owm':
-                curr_msgs = self._load_from_owmjson(filepath)
-            else:
-                raise ValueError("Format %s not recognized" % format)
+            format = self._infer_format(filepaths)
+
+        # derived parameters are calculated from their inputs by queries
+        if params is not None:
+            params = set(params) | required_inputs(params)
+        msg_filter = MessageFilter(params=params, base_dates=base_dates, steps=steps, bbox=bbox)
+        # derived values of previously loaded messages and cached results may change
+        self.derived_cache.clear()
+        self.freshest_indices = {}
+        self.data_version += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+        # rollups can be updated only if they cover all previously loaded messages
+        covered = self.rollups is not None or (self.grib_msgs is None and self.cube is None and
+                                               self.lazy_msgs is None)
+        base_times = self._load_messages(filepaths, format, processes, msg_filter)
+        # the same selection (without base dates) is applied to appended messages
+        self.append_filter = MessageFilter(params=params, steps=steps, bbox=bbox)
+
+        if not rollups:
+            self.rollups = None
+        elif not covered:
+            self._update_rollups()
+        elif steps is None and format in ['archive', 'partitioned'] and all(has_rollups(f) for f in filepaths):
+            rollup_filter = MessageFilter(params=params, base_dates=base_dates, bbox=bbox)
+            for filepath in filepaths:
+                loaded = Rollups.load(filepath, msg_filter=rollup_filter)
+                self.rollups = loaded if self.rollups is None else self.rollups.merge(loaded)
+        else:
+            self._update_rollups(base_times)
 
-            # append messages
-            if self.grib_msgs is None:
-                self.grib_msgs = curr_msgs
-            else:
-                self.grib_msgs = pd.concat([self.grib_msgs, curr_msgs])
+    @staticmethod
+    def _infer_format(filepaths):
+        """ Infer the format of files from their suffix or the archive directory layout. """
+        if all(f.endswith('.grib') for f in filepaths):
+            return 'grib'
+        elif all(f.endswith('.pkl') for f in filepaths):
+            return 'pkl'
+        elif all(f.endswith('.json') for f in filepaths):
+            return 'owm'
+        elif all(is_archive(f) for f in filepaths):
+            return 'archive'
+        elif all(is_partitioned_archive(f) for f in filepaths):
+            return 'partitioned'
+        raise ValueError("Could not infer the file format.")
+
+    def append(self, filepaths, format=None, processes=None, archive=None):
+        """
+        Add new messages (e.g. the daily forecast run) to loaded data without reloading it. Only the
+        new messages are decoded, ordered and merged into the time index; derived values and rollups
+        are calculated only for their base days, and only their partitions of an archive are written.
+        New messages replace loaded messages with the same base datetime, validity datetime and parameter.
 
-            # reset index
-            self.grib_msgs.reset_index(drop=True, inplace=True)
+        The parameters, steps and area selected by the previous .load(...) are applied to new messages.
 
-        # extend the set of parameters if data is from grib files
+        Args:
+            filepaths, format, processes: see .load(...)
+            archive (str): partitioned archive the new messages (and their rollups if kept) are added to,
+                not written if None; in lazy storage of a partitioned archive new messages are always
+                added to the loaded archive
+        """
+        if self.grib_msgs is None and self.cube is None and self.lazy_msgs is None:
+            return self.load(filepaths, format=format, processes=processes)
+        if not isinstance(filepaths, list):
+            filepaths = [filepaths]
+        if format is None:
+            format = self._infer_format(filepaths)
+
+        written = False
+        if self.storage == 'lazy' and isinstance(self.lazy_msgs, PartitionedArchive):
+            # the loaded archive is the store, add new messages on its grid and reopen it with its selection
+            new_msgs = pd.concat(self._read_messages(filepaths, format, processes, MessageFilter()), ignore_index=True)
+            archive = self.lazy_msgs.path
+            write_partitioned_archive(archive, new_msgs[FRAME_COLUMNS])
+            self.lazy_msgs = PartitionedArchive(archive, msg_filter=self.lazy_msgs.msg_filter)
+            base_times, written = to_datetime64(new_msgs['validDateTime']), True
+        elif self.storage == 'frame':
+            new_msgs = pd.concat(self._read_messages(filepaths, format, processes, self.append_filter),
+                                 ignore_index=True)
+            new_msgs = new_msgs.iloc[TimeIndex.order(new_msgs)]
+            new_msgs = new_msgs.set_index('validDateTime', drop=False)
+            self.time_index, order = self.time_index.merge(TimeIndex.from_frame(new_msgs))
+            self.grib_msgs = pd.concat([self.grib_msgs, new_msgs]).iloc[order]
+            base_times = to_datetime64(new_msgs['validDateTime'])
+        else:
+            base_times = self._load_messages(filepaths, format, processes, self.append_filter)
+
+        # derived values of loaded messages stay valid unless their base runs changed
+        new_bases = set(np.unique(np.asarray(base_times, dtype='datetime64[s]')))
+        self.derived_cache.discard(lambda key: np.datetime64(key[1], 's') in new_bases)
+        self.freshest_indices = {}
+        self.data_version += 1
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+        updated = None
+        if self.rollups is not None:
+            updated = self._update_rollups(base_times)
+
+        if archive is not None and len(new_bases) > 0:
+            if not written:
+                self._detach_archive_values(archive, list(new_bases))
+                days = np.unique(np.asarray(base_times, dtype='datetime64[D]'))
+                grib_msgs = self._messages(days[0].astype(datetime.date), days[-1].astype(datetime.date),
+                                           derived=False)
+                grib_msgs = grib_msgs[np.isin(to_datetime64(grib_msgs['validDateTime']), list(new_bases))]
+                write_partitioned_archive(archive, grib_msgs[FRAME_COLUMNS].reset_index(drop=True))
+            if updated is not None:
+                updated.save(archive, partitioned=True, freq=PartitionedArchive(archive).manifest['freq'])
+
+    def _detach_archive_values(self, archive, base_times):
+        """
+        Copy loaded values memory-mapped from the partitions of an archive that are rewritten
+        with messages of the given base times, so they do not depend on the replaced files.
+        """
+        if self.grib_msgs is None or not is_partitioned_archive(archive):
+            return
+        freq = PartitionedArchive(archive).manifest['freq']
+        periods = np.unique(np.asarray(base_times, dtype='datetime64[s]').astype('datetime64[%s]' % freq))
+        rewritten = set(os.path.realpath(os.path.join(archive, str(period))) for period in periods)
+        self.grib_msgs['values'] = object_array(
+            np.array(values) if isinstance(values, np.memmap) and values.filename is not None and
+            os.path.dirname(os.path.realpath(values.filename)) in rewritten else values
+            for values in self.grib_msgs['values'])
+
+    def _read_messages(self, filepaths, format, processes, msg_filter):
+        """ Read messages of files into frames, see .load(...) for arguments. """
         if format == 'grib':
-            self.grib_msgs = WeatherExtractor._extend_parameters(self.grib_msgs)
+            decoder = default_decoder()
+            print('Using ', decoder, ' as GRIB decoder.')
+            return [block.to_frame() for block in decode_files(filepaths, decoder, processes=processes,
+                                                               msg_filter=msg_filter)]
+        elif format == 'pkl':
+            return [msg_filter.filter_frame(self._load_from_pkl(filepath)) for filepath in filepaths]
+        elif format == 'owm':
+            return [msg_filter.filter_frame(self._load_from_owmjson(filepath)) for filepath in filepaths]
+        elif format == 'archive':
+            return [msg_filter.filter_frame(read_archive(filepath)) for filepath in filepaths]
+        elif format == 'partitioned':
+            return [PartitionedArchive(filepath, msg_filter=msg_filter).to_frame() for filepath in filepaths]
+        raise ValueError("Format %s not recognized" % format)
+
+    def _load_messages(self, filepaths, format, processes, msg_filter):
+        """
+        Load messages into the storage, see .load(...) for arguments.
+
+        Returns:
+            np.array(dtype='datetime64[s]'): base datetimes of the loaded messages, None if all loaded
+                messages are new
+        """
+        if self.storage == 'lazy':
+            if format == 'partitioned':
+                if self.lazy_msgs is not None or len(filepaths) != 1:
+                    raise ValueError("Lazy storage supports only one partitioned archive.")
+                self.lazy_msgs = PartitionedArchive(filepaths[0], msg_filter=msg_filter)
+                return None
+            if format != 'grib' or isinstance(self.lazy_msgs, PartitionedArchive):
+                raise ValueError("Lazy storage supports only GRIB files or one partitioned archive.")
+            return self._load_lazy(filepaths, msg_filter)
+
+        curr_msgs = self._read_messages(filepaths, format, processes, msg_filter)
+        base_times = np.concatenate([to_datetime64(msgs['validDateTime']) for msgs in curr_msgs])
+
+        # append messages of all files at once
+        if self.grib_msgs is not None:
+            curr_msgs.insert(0, self.grib_msgs)
+        self.grib_msgs = pd.concat(curr_msgs, ignore_index=True)
+
+        if self.storage == 'cube':
+            # pack loaded messages into the cube and drop the per-message frame
+            cube = WeatherCube.from_frame(self.grib_msgs)
+            self.cube = cube if self.cube is None else self.cube.merge(cube)
+            self.grib_msgs = None
+            return base_times
+
+        # order by base datetime (when the forecast was made), validity datetime and parameter, index by base date
+        self.grib_msgs = self.grib_msgs.iloc[TimeIndex.order(self.grib_msgs)]
+        self.grib_msgs = self.grib_msgs.set_index('validDateTime', drop=False)
+        self.time_index = TimeIndex.from_frame(self.grib_msgs)
+        return base_times
+
+    def _load_lazy(self, filepaths, msg_filter):
+        """
+        Load sidecar indices of GRIB files (building the missing ones) without decoding values.
+        All files are cropped to the area of the first loaded file.
+
+        Returns:
+            np.array(dtype='datetime64[s]'): base datetimes of the added messages
+        """
+        decoder = default_decoder()
+        base_times = [np.zeros(0, dtype='datetime64[s]')]
+        for filepath in filepaths:
+            index = GribIndex.open(filepath, decoder)
+            mask = msg_filter.crop_mask(index.lats, index.lons)
+            if self.lazy_msgs is None:
+                self.lazy_msgs = LazyMessages(decoder, cache_size=self.lazy_cache_size, mask=mask)
+            elif (mask is None) != (self.lazy_msgs.mask is None) or (
+                    mask is not None and not np.array_equal(mask, self.lazy_msgs.mask)):
+                raise ValueError("GRIB file %s is cropped to a different area than already loaded files" % filepath)
+            n_added = self.lazy_msgs.add(index, keep=msg_filter.keep_mask(index.short_names, index.base_times,
+                                                                           index.validity_times))
+            base_times.append(self.lazy_msgs.base_times[len(self.lazy_msgs) - n_added:])
+        return np.concatenate(base_times)
+
+    def _select_lazy(self, base_range=None, validity_range=None, same_day=False):
+        """ Select messages from lazy storage, all if base_range is None. """
+        if base_range is None:
+            return self.lazy_msgs.to_frame()
+        return self.lazy_msgs.select(base_range, validity_range=validity_range, same_day=same_day)
+
+    def store(self, filepath, format='pkl', rollups=False):
+        """
+        Store loaded weather data.
 
-        # index by base date (date when the forecast was made)
-        self.grib_msgs.set_index('validDateTime', drop=False, inplace=True)
-        self.grib_msgs.sort_index(inplace=True)
+        Args:
+            filepath (str): target file, or target directory for format='archive'
+            format (str): one of the following:
+                'pkl': pickled pandas.DataFrame (or WeatherCube in cube storage), '.pkl' is appended if missing
+                'archive': directory of memory-mappable float32 values, shared grid and metadata table
+                'partitioned': directory of archives, one per month of base dates, with a manifest;
+                    messages are added to an existing partitioned archive
+            rollups (bool): store daily and weekly rollups with an archive; rollups of a partitioned
+                archive are updated for the base days of the stored messages
+        """
+        if format == 'archive':
+            print("Saving weather archive to: %s" % filepath)
+            write_archive(filepath, self._messages(derived=False))
+            if rollups:
+                stored = self.rollups if self.rollups is not None else self._build_rollups(self._messages())
+                stored.save(filepath)
+            return
+        elif format == 'partitioned':
+            print("Saving partitioned weather archive to: %s" % filepath)
+            grib_msgs = self._messages(derived=False)
+            write_partitioned_archive(filepath, grib_msgs)
+            if rollups and len(grib_msgs) > 0:
+                # rollups of updated base days are rebuilt from all their stored messages
+                archive = PartitionedArchive(filepath)
+                days = np.unique(to_datetime64(grib_msgs['validDateTime']).astype('datetime64[D]'))
+                stored = archive.select((days[0], days[-1] + 1))
+                stored = stored[np.isin(to_datetime64(stored['validDateTime']).astype('datetime64[D]'), days)]
+                stored = derive(stored, default_params())
+                self._build_rollups(stored).save(filepath, partitioned=True, freq=archive.manifest['freq'])
+            return
+        elif format != 'pkl':
+            raise ValueError("Format %s not recognized" % format)
 
-    def store(self, filepath):
         if not filepath.endswith('.pkl'):
             filepath += '.pkl'
         print("Saving weather data to: %s" % filepath)
         with open(filepath, 'wb') as f:
-            pickle.dump(self.grib_msgs, f)
+            pickle.dump(self.cube if self.storage == 'cube' else self._messages(derived=False), f)
 
-    @staticmethod
-    def _extend_parameters(grib_msgs):
-        """ Extend the set of weather parameters with ones calculated
-        from base parameters.
-        """
-        print("Extending parameters...")
-        curr_params = np.unique(grib_msgs.shortName)
-        # calculate Wind speed [ws] parameter
-        if ('10u' in curr_params) and '10v' in curr_params and not 'ws' in curr_params:
-            # print "Calculating parameter Wind speed (ws)"
-            grp = grib_msgs[(grib_msgs.shortName == '10u') | (grib_msgs.shortName == '10v')].reset_index(drop=True).groupby(['validDateTime', 'validityDateTime'])
-
-            new_msgs = []
-            for group in grp.groups:
-                tf = grp.get_group(group)
-                new_msgs.append({
-                    'shortName': u'ws',
-                    'values': np.sqrt(np.sum(v*v for v in tf['values'])),
-                    'validDateTime': tf['validDateTime'].iloc[0],
-                    'validityDateTime': tf['validityDateTime'].iloc[0],
-                    'lats': tf['lats'].iloc[0],
-                    'lons': tf['lons'].iloc[0],
-                    'type': tf['type'].iloc[0]
-                })
-
-            new_msgs = pd.DataFrame.from_dict(new_msgs)
-            grib_msgs = grib_msgs.append(new_msgs)
-
-        # calculate Relative humidity (rh) parameter
-        if '2t' in curr_params and '2d' in curr_params and not 'rh' in curr_params:
-            T0 = 273.15
-
-            # get dewpoint temperature and surface temperature
-            grp = grib_msgs[(grib_msgs.shortName == '2t') | (grib_msgs.shortName == '2d')].reset_index(drop=True).groupby(['validDateTime', 'validityDateTime'])
-
-            new_msgs = []
-            for group in grp.groups:
-                tf = grp.get_group(group)
-                T_surface = tf[tf.shortName == '2t'].iloc[0]['values'] - T0
-                T_dew = tf[tf.shortName == '2d'].iloc[0]['values'] - T0
-
-                # calculate relative humidity using https://journals.ametsoc.org/doi/pdf/10.1175/BAMS-86-2-225
-                rh = 100*(np.exp((17.625*T_dew)/(243.04+T_dew))/np.exp((17.625*T_surface)/(243.04+T_surface)))
-                new_msgs.append({
-                    'shortName': u'rh',
-                    'values': rh,
-                    'validDateTime': tf['validDateTime'].iloc[0],
-                    'validityDateTime': tf['validityDateTime'].iloc[0],
-                    'lats': tf['lats'].iloc[0],
-                    'lons': tf['lons'].iloc[0],
-                    'type': tf['type'].iloc[0]
-                })
-            new_msgs = pd.DataFrame.from_dict(new_msgs)
-            grib_msgs = grib_msgs.append(new_msgs)
+    def query_plan(self, aggloc, interp_points=None, bounding_box=None, aggtype=None):
+        """
+        Get a precompiled spatial query plan for the loaded grid. Passing the plan to
+        .get_actual(...) or .get_forecast(...) skips all spatial work of the query. Plans are
+        cached, can be stored with plan.save(filepath) and loaded with QueryPlan.load(filepath).
+
+        Args:
+            aggloc (str): location aggregation level; can be 'country', 'points' or 'bbox'
+            interp_points (list of dicts): list of interpolation points with each point represented
+                as dict with fields 'lon' and 'lat' representing longtitude and lattitude if aggloc='points'
+            bounding_box ([[lat1,lon1], [lat2,lon2]]): corner points of the bounding box if aggloc='bbox'
+            aggtype (str): 'one' or 'mean'; defaults to 'mean' for aggloc='bbox' and 'one' otherwise
+
+        Returns:
+            QueryPlan: plan for the loaded grid and given targets
+        """
+        if aggloc == 'points':
+            if interp_points is None:
+                raise ValueError(
+                    "interp_points cannot be None if aggloc is set to 'points'.")
+            interp_points = self._latslons_from_dict(interp_points)
+        lats, lons = self._grid()
+        return self.query_plans.get(lats, lons, aggloc, aggtype=aggtype,
+                                    interp_points=interp_points, bounding_box=bounding_box)
+
+    def _grid(self):
+        """ Get latitudes and longtitudes of the loaded grid. """
+        if self.storage == 'cube':
+            return self.cube.lats, self.cube.lons
+        if self.storage == 'lazy':
+            return self.lazy_msgs.lats, self.lazy_msgs.lons
+        return self.grib_msgs['lats'].iloc[0], self.grib_msgs['lons'].iloc[0]
+
+    def _messages(self, from_date=None, to_date=None, derived=True):
+        """
+        Get loaded messages as pandas.DataFrame indexed by base date.
 
+        Args:
+            from_date, to_date (datetime.date): window of base dates (both inclusive), all messages if None
+            derived (bool): add default derived parameters (ws, rh)
+        """
+        base_range = None
+        if from_date is not None or to_date is not None:
+            base_range = (np.datetime64(from_date or datetime.date.min, 's'),
+                          np.datetime64(to_date or datetime.date.max, 's') + np.timedelta64(1, 'D'))
+
+        if self.storage == 'cube':
+            grib_msgs = self.cube.to_frame() if base_range is None else self.cube.select(base_range)
+        elif self.storage == 'lazy':
+            grib_msgs = self._select_lazy(base_range)
+        elif base_range is None:
+            grib_msgs = self.grib_msgs
+        else:
+            grib_msgs = self.grib_msgs.iloc[self.time_index.rows(base_range)]
+        if derived:
+            grib_msgs = self._derive(grib_msgs)
+        return grib_msgs.set_index('validDateTime', drop=False)
+
+    def _build_rollups(self, grib_msgs):
+        """ Build daily and weekly rollups of weather messages. """
+        layers = {}
+        for level in ROLLUP_LEVELS:
+            layer = None
+            for stat in ROLLUP_STATS:
+                aggregated = self._aggregate_values(grib_msgs, level, aggfunc=stat)
+                if layer is None:
+                    layer = aggregated.drop('values', axis=1)
+                layer[stat] = aggregated['values'].values
+            layers[level] = layer
+        return Rollups(layers)
+
+    def _update_rollups(self, base_times=None):
+        """
+        Rebuild rollups of the base days of given base datetimes from loaded messages, all if None.
+
+        Returns:
+            Rollups: rebuilt rollups of the base days, None if there are none
+        """
+        if base_times is None:
+            self.rollups = self._build_rollups(self._messages())
+            return self.rollups
+        if len(base_times) == 0:
+            return None
+        days = np.unique(np.asarray(base_times, dtype='datetime64[D]'))
+        grib_msgs = self._messages(days[0].astype(datetime.date), days[-1].astype(datetime.date))
+        grib_msgs = grib_msgs[np.isin(to_datetime64(grib_msgs['validDateTime']).astype('datetime64[D]'), days)]
+        updated = self._build_rollups(grib_msgs)
+        self.rollups = updated if self.rollups is None else self.rollups.merge(updated)
+        return updated
+
+    def _derive(self, grib_msgs, params=None):
+        """
+        Add derived parameters (see derived.DERIVED_PARAMS) to selected messages, values are
+        cached per time slice until the next load.
+
+        Args:
+            grib_msgs (pandas.DataFrame): selected weather messages
+            params (list): short names of the parameters to keep, stored parameters and default
+                derived parameters (ws, rh) if None
+
+        Returns:
+            pandas.DataFrame: weather messages of the requested parameters
+        """
+        grib_msgs = derive(grib_msgs, default_params() if params is None else params, cache=self.derived_cache)
+        if params is not None:
+            grib_msgs = grib_msgs[grib_msgs['shortName'].isin(params).values]
         return grib_msgs
 
     def _latslons_from_dict(self, points):
@@ -351,67 +628,10 @@ class WeatherExtractor:
         Returns:
             np.array(dtype=int): array where value at index i represents the index of closest point j
         """
-        num_points = lats.shape[0]
-        num_target = target_lats.shape[0]
-
-        closest = np.zeros(num_points, dtype=np.int)
-        for i in range(num_points):
-            best_dist = (lats[i] - target_lats[0])**2 + \
-                (lons[i] - target_lons[0])**2
-            for j in range(1, num_target):
-                curr_dist = (lats[i] - target_lats[j])**2 + \
-                    (lons[i] - target_lons[j])**2
-                if curr_dist < best_dist:
-                    best_dist = curr_dist
-                    closest[i] = j
-        return closest
+        # the index over target points is built once and reused by later calls
+        return grid_index(target_lats, target_lons).nearest(lats, lons)
 
-    def _interpolate_values(self, values, closest, num_original, num_targets, aggtype):
-        """
-        Do a value interpolation for given target points according to aggregation type.
-
-        Args:
-            values (np.array(dtype=float)): original values
-            closest (np.array(dtype=int)):
-            num_original (int):
-            num_targets (int):
-            aggtype (str):
-
-        Returns:
-            np.array(dtype=float): interpolated values for target points
-        """
-        # get interpolated values
-        result_values = np.zeros(num_targets)
-        if aggtype == 'one':
-            for i in range(num_targets):
-                result_values[i] = values[closest[i]]
-        elif aggtype == 'mean':
-            result_count = np.zeros(num_targets)
-            for i in range(num_original):
-                result_values[closest[i]] += values[i]
-                result_count[closest[i]] += 1.
-            result_count[result_count == 0] = 1.  # avoid dividing by zero
-            result_values /= result_count
-        return result_values
-
-    @staticmethod
-    def _str_to_datetime(val):
-        """ Convert datetime string 'YYYYMMDDHHMM' to datetime object. """
-        tmp_date = datetime.date(int(val[:4]), int(val[4:6]), int(val[6:8]))
-
-        time_str = val[8:]
-        assert len(time_str) in [1, 3, 4]
-        if len(time_str) == 1:
-            # midnight - only one number
-            return datetime.datetime.combine(tmp_date, datetime.time(int(time_str)))
-        elif len(time_str) == 3:
-            # hmm format
-            return datetime.datetime.combine(tmp_date, datetime.time(int(time_str[:1]), int(time_str[1:])))
-        elif len(time_str) == 4:
-            # hhmm format
-            return datetime.datetime.combine(tmp_date, datetime.time(int(time_str[:2]), int(time_str[2:])))
-
-    def _aggregate_points(self, weather_result, aggloc, aggtype='one', interp_points=None, bounding_box=None):
+    def _aggregate_points(self, weather_result, aggloc, aggtype='one', interp_points=None, bounding_box=None, plan=None):
         """
         Do an interpolation of measurement values for target points (given with target_lats and target_lons)
         from weather_result points.
@@ -427,89 +647,47 @@ class WeatherExtractor:
                 TODO:
                     'interpolate' - do a kind of ECMWF interpolation
 
+            plan (QueryPlan): precompiled plan used instead of aggloc, aggtype, interp_points and bounding_box
+
         Returns:
             pandas.DataFrame: resulting object with interpolated points
         """
         assert aggloc in ['grid', 'points', 'country', 'bbox']
         assert aggtype in ['one', 'mean']
-        if aggloc == 'points':
+        if aggloc == 'points' and plan is None:
             assert interp_points is not None
         assert len(weather_result) > 0
 
+        if aggloc == 'grid':  # no aggregation
+            return weather_result
+
+        # spatial work is done once per grid and targets by the query plan
         lats, lons = weather_result['lats'].iloc[0], weather_result['lons'].iloc[0]
+        if plan is None:
+            plan = self.query_plans.get(lats, lons, aggloc, aggtype=aggtype,
+                                        interp_points=interp_points, bounding_box=bounding_box)
+        elif plan.fingerprint != self.query_plans.fingerprint(lats, lons):
+            raise ValueError("Query plan was built for a different grid.")
+
+        # interpolate all messages at once on a stacked value matrix
+        result_values = plan.apply(np.vstack(weather_result['values'].values))
+        target_lats, target_lons = plan.target_lats, plan.target_lons
+
+        # create new weather object, affected columns are 'values', 'lats' and 'lons'
+        tmp_result = weather_result.reset_index(drop=True)
+        tmp_result['values'] = object_array(result_values)
+        tmp_result['lats'] = object_array([target_lats] * len(tmp_result))
+        tmp_result['lons'] = object_array([target_lons] * len(tmp_result))
+
+        return tmp_result
 
-        if aggloc == 'bbox':
-            assert bounding_box is not None, "bounding box not given"
-            assert len(bounding_box) == 2 and len(bounding_box[0]) == 2 and len(bounding_box[1]) == 2, \
-                "Wrong bounding box input structure"
-            # get bounding box borders
-            bb_min_lat = min(bounding_box[0][0], bounding_box[1][0])
-            bb_max_lat = max(bounding_box[0][0], bounding_box[1][0])
-            bb_min_lon = min(bounding_box[0][1], bounding_box[1][1])
-            bb_max_lon = max(bounding_box[0][1], bounding_box[1][1])
-            # get data borders
-            min_lat, max_lat = min(lats), max(lats)
-            min_lon, max_lon = min(lons), max(lons)
-            # check if bounding box is within data
-            assert min_lat <= bb_min_lat <= max_lat, "bounding box must be within data area"
-            assert min_lat <= bb_max_lat <= max_lat, "bounding box must be within data area"
-            assert min_lon <= bb_min_lon <= max_lon, "bounding box must be within data area"
-            assert min_lon <= bb_max_lon <= max_lon, "bounding box must be within data area"
-            # filter out bounding box points
-            tmp_lats, tmp_lons = [], []
-            for lat, lon in zip(lats, lons):
-                if bb_min_lat <= lat <= bb_max_lat and bb_min_lon <= lon <= bb_max_lon:
-                    tmp_lats.append(lat)
-                    tmp_lons.append(lon)
-            assert len(tmp_lats) > 0 and len(tmp_lons) > 0, "bounding box contains no points"
-            lats, lons = np.array(tmp_lats), np.array(tmp_lons)
+    # parameters accumulated from the base datetime
+    ACCUMULATED_PARAMS = ['tp', 'sf', 'sund']
 
-        if aggloc == 'grid':  # no aggregation
-            return weather_result
-        elif aggloc == 'points':
-            target_lats, target_lons = interp_points[0], interp_points[1]
-        elif aggloc == 'country':  # center of slovenia
-            target_lats, target_lons = np.array([46.1512]), np.array([14.9955])
-        elif aggloc == 'bbox': # aggregate over bounding box
-            # compute mid point of bounding box
-            mid_bbox = [0.5 * (bb_min_lat + bb_max_lat), 0.5 * (bb_min_lon + bb_max_lon)]
-            target_lats, target_lons = np.array([mid_bbox[0]]), np.array([mid_bbox[1]])
-
-        if aggtype == 'one':
-            # each target point has only one closest grid point
-            closest = self._calc_closest(target_lats, target_lons, lats, lons)
-        elif aggtype == 'mean':
-            # each grid point has only one closest target point
-            closest = self._calc_closest(lats, lons, target_lats, target_lons)
-
-        num_original = lats.shape[0]
-        num_targets = target_lats.shape[0]
-
-        # create new weather object
-        tmp_result = list()
-
-        columns = weather_result.columns
-        for raw_row in weather_result.itertuples(index=False):
-            row_data = dict()
-            for col_pos, col_str in enumerate(columns):
-                # affected columns are 'values', 'lats' and 'lons'
-                if col_str == 'values':
-                    row_data[col_str] = self._interpolate_values(
-                        raw_row[col_pos], closest, num_original, num_targets, aggtype)
-                elif col_str == 'lats':
-                    row_data[col_str] = target_lats
-                elif col_str == 'lons':
-                    row_data[col_str] = target_lons
-                else:
-                    row_data[col_str] = raw_row[col_pos]
-            tmp_result.append(row_data)
-
-        return pd.DataFrame.from_dict(tmp_result)
-
-    def _aggregate_values(self, weather_result, aggtime):
-        """
-        Aggregate weather values on hourly, daily or weekly level. Calculate the mean
-        value for each measurement point over given time period.
+    def _aggregate_values(self, weather_result, aggtime, aggfunc='mean', by=None):
+        """
+        Aggregate weather values on hourly, daily or weekly level. Reduce the values of each
+        measurement point over given time period.
 
         Serves more as an aggregation example. For more complex aggregations set aggtime='hour'
         and implement own aggregation policy on pandas.DataFrame.
@@ -517,36 +695,171 @@ class WeatherExtractor:
         Args:
             weather_result (pandas.DataFrame): object containing original measurements
             aggtime (str): aggregation level which can be 'hour', 'day' or 'week'
+            aggfunc (str or dict): reducer for all parameters or dict of reducers by parameter short name
+                ('mean' for the missing ones); one of the following:
+                    'mean', 'min', 'max', 'sum': reduction of the values in the period
+                    'cum': de-accumulated sum for accumulated parameters (ACCUMULATED_PARAMS), i.e. the
+                        amount accumulated in the period; the first message of each forecast counts
+                        everything accumulated since its base datetime
+                    'count': number of messages in the period
+            by (str): column of integer keys (e.g. query ids) grouped separately, kept as the first column
 
         Returns:
             pandas.DataFrame: resulting object with aggregated values
         """
         assert aggtime in ['hour', 'day', 'week', 'H', 'D', 'W']
-        aggtime = {'hour': 'H', 'day': 'D', 'week': 'W'}[aggtime]
+        aggtime = {'hour': 'H', 'day': 'D', 'week': 'W', 'H': 'H', 'D': 'D', 'W': 'W'}[aggtime]
 
         if aggtime == 'H':
             return weather_result
 
-        weather_result.set_index(
-            ['validDateTime', 'validityDateTime', 'shortName'], drop=True, inplace=True)
+        columns = ['validDateTime', 'validityDateTime', 'shortName', 'values', 'lats', 'lons']
+        if by is not None:
+            columns.insert(0, by)
+        if len(weather_result) == 0:
+            return pd.DataFrame(columns=columns)
+
+        short_names = np.asarray(weather_result['shortName'], dtype=str)
+        if isinstance(aggfunc, dict):
+            reducers = {name: aggfunc.get(name, 'mean') for name in np.unique(short_names)}
+        else:
+            reducers = {name: aggfunc for name in np.unique(short_names)}
+        assert set(reducers.values()) <= {'mean', 'min', 'max', 'sum', 'cum', 'count'}
+
+        base = weather_result['validDateTime'].values.astype('datetime64[s]')
+        validity = weather_result['validityDateTime'].values.astype('datetime64[s]')
+        values = np.vstack(weather_result['values'].values)
+        keys = np.zeros(len(base), dtype=np.int64) if by is None else weather_result[by].values.astype(np.int64)
+
+        if 'cum' in reducers.values():
+            # increments between consecutive messages of the same forecast and parameter
+            series = np.lexsort((validity, short_names, base, keys))
+            first = np.ones(len(series), dtype=bool)
+            first[1:] = (base[series][1:] != base[series][:-1]) | (short_names[series][1:] != short_names[series][:-1])
+            first[1:] |= keys[series][1:] != keys[series][:-1]
+            increments = values[series]
+            increments[1:] = np.where(first[1:, None], increments[1:], increments[1:] - values[series][:-1])
+            cum_values = np.empty_like(values)
+            cum_values[series] = increments
+
+        # group keys: base day, validity day or week (Monday to Sunday, labeled by Sunday) and parameter
+        base_day = base.astype('datetime64[D]')
+        period = validity.astype('datetime64[D]')
+        if aggtime == 'W':
+            period = week_ends(period)
+
+        order = np.lexsort((short_names, period, base_day, keys))
+        base_day, period, short_names, keys = base_day[order], period[order], short_names[order], keys[order]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = (base_day[1:] != base_day[:-1]) | (period[1:] != period[:-1]) | \
+            (short_names[1:] != short_names[:-1]) | (keys[1:] != keys[:-1])
+        starts = np.flatnonzero(starts)
+        counts = np.diff(np.append(starts, len(order)))
+
+        group_names = short_names[starts]
+        group_reducers = np.array([reducers[name] for name in group_names])
+        aggregated = np.empty((len(starts), values.shape[1]), dtype=values.dtype)
+        for reducer in np.unique(group_reducers):
+            groups = group_reducers == reducer
+            if reducer == 'cum':
+                res = np.add.reduceat(cum_values[order], starts, axis=0)
+            elif reducer == 'min':
+                res = np.minimum.reduceat(values[order], starts, axis=0)
+            elif reducer == 'max':
+                res = np.maximum.reduceat(values[order], starts, axis=0)
+            elif reducer == 'count':
+                res = np.repeat(counts[:, None], values.shape[1], axis=1)
+            else:
+                res = np.add.reduceat(values[order], starts, axis=0)
+                if reducer == 'mean':
+                    res = res / counts[:, None]
+            aggregated[groups] = res[groups]
+
+        first_rows = order[starts]
+        tmp_result = {
+            'validDateTime': pd.to_datetime(base_day[starts]),
+            'validityDateTime': pd.to_datetime(period[starts]),
+            'shortName': weather_result['shortName'].values[first_rows],
+            'values': object_array(aggregated),
+            'lats': weather_result['lats'].values[first_rows],
+            'lons': weather_result['lons'].values[first_rows]
+        }
+        if by is not None:
+            tmp_result[by] = keys[starts]
+        tmp_result = pd.DataFrame(tmp_result, columns=columns)
 
-        groups = weather_result.groupby([pd.Grouper(freq='D', level='validDateTime'), pd.Grouper(
-            freq=aggtime, level='validityDateTime'), pd.Grouper(level='shortName')])
+        return tmp_result
 
-        tmp_result = groups.apply(
-            lambda group:
-            pd.Series(
-                {
-                    'values': group['values'].mean(),
-                    'lats': group['lats'].iloc[0],
-                    'lons': group['lons'].iloc[0]
-                })
-        )
-        tmp_result.reset_index(drop=False, inplace=True)
+    def _rollups_answer(self, aggfunc, aggtype, params):
+        """ Check if rollups hold everything needed for a query aggregated by day or week. """
+        if self.rollups is None:
+            return False
+        reducers = set(aggfunc.values()) | {'mean'} if isinstance(aggfunc, dict) else {aggfunc}
+        if not reducers <= {'mean', 'min', 'max', 'sum'}:
+            return False
+        # minimum and maximum in time do not commute with the mean over points
+        if aggtype == 'mean' and reducers & {'min', 'max'}:
+            return False
+        return params is None or set(params) <= self.rollups.params
+
+    def _aggregate_rollups(self, aggtime, aggfunc, base_range, validity_range=None, same_day=False, params=None,
+                           **point_args):
+        """
+        Answer a query aggregated by day or week from rollups, see .get_forecast(...) for arguments.
+        Statistics of rollup rows are aggregated over points and combined over the period in one pass,
+        with messages keyed by statistic and parameter.
 
+        Returns:
+            pandas.DataFrame: resulting object with aggregated values, as from ._aggregate_values(...)
+        """
+        rows = self.rollups.select(aggtime, base_range, validity_range=validity_range, same_day=same_day,
+                                   params=params)
+        assert len(rows) > 0
+        short_names = np.asarray(rows['shortName'], dtype=str)
+        names = np.unique(short_names)
+        reducers = {name: aggfunc.get(name, 'mean') if isinstance(aggfunc, dict) else aggfunc for name in names}
+
+        # sum and count of values give means and sums, minimum and maximum are kept only if needed
+        counts = np.vstack(rows['count'].values)
+        stats = [('sum', np.vstack(rows['mean'].values) * counts, 'sum'), ('count', counts, 'sum')]
+        stats += [(stat, np.vstack(rows[stat].values), stat) for stat in ['min', 'max'] if stat in reducers.values()]
+        stat_rows = pd.concat([rows[['validDateTime', 'validityDateTime', 'lats', 'lons']].assign(
+            shortName=np.char.add(stat + ':', short_names).astype(object), values=object_array(values))
+            for stat, values, _ in stats], ignore_index=True)
+        stat_rows = self._aggregate_points(stat_rows, **point_args)
+        stat_rows = self._aggregate_values(stat_rows, aggtime, aggfunc={
+            stat + ':' + name: reducer for stat, _, reducer in stats for name in names})
+
+        # aggregated rows of each statistic are ordered the same way
+        stat_names = np.asarray(stat_rows['shortName'], dtype=str)
+        combined = {stat: stat_rows[np.char.startswith(stat_names, stat + ':')].reset_index(drop=True)
+                    for stat, _, _ in stats}
+        tmp_result = combined['sum']
+        tmp_result['shortName'] = object_array(name.split(':', 1)[1] for name in tmp_result['shortName'])
+        values = np.vstack(tmp_result['values'].values)
+        row_reducers = np.array([reducers[name] for name in tmp_result['shortName']])
+        mean = row_reducers == 'mean'
+        values[mean] /= np.vstack(combined['count']['values'].values)[mean]
+        for stat in ['min', 'max']:
+            if stat in combined:
+                values[row_reducers == stat] = np.vstack(combined[stat]['values'].values)[row_reducers == stat]
+        tmp_result['values'] = object_array(values)
         return tmp_result
 
-    def get_actual(self, from_date, to_date, aggtime='hour', aggloc='grid', interp_points=None, bounding_box=None):
+    def _result_key(self, plan, *args):
+        """ Key of a query result in the result cache, None if results are not cached. """
+        if self.result_cache is None:
+            return None
+        return query_key(self.data_version, None if plan is None else plan_key(plan), *args)
+
+    def _cache_result(self, key, result):
+        """ Cache a query result, returning the result as given to callers. """
+        if key is None:
+            return result
+        return self.result_cache.put(key, result)
+
+    def get_actual(self, from_date, to_date, aggtime='hour', aggloc='grid', interp_points=None, bounding_box=None,
+        plan=None, params=None, aggfunc='mean', freshest=False):
         """
         Get the actual weather for each day from a given time window.
         Actual weather is actually a forecast made on given day - this is the best weather estimation
@@ -561,17 +874,38 @@ class WeatherExtractor:
                 as dict with fields 'lon' and 'lat' representing longtitude and lattitude if aggloc='points'
             bounding_box ([[lat1,lon1], [lat2,lon2]]): corner points of the bounding box if aggloc='bounding_box',
                 order of the points is not important
+            plan (QueryPlan): precompiled spatial plan from .query_plan(...) used instead of aggloc,
+                interp_points and bounding_box
+            params (list): short names of the returned parameters, including derived parameters
+                (see derived.DERIVED_PARAMS); stored parameters and ws, rh if None
+            aggfunc (str or dict): reducer used by time aggregation, see _aggregate_values
+            freshest (bool): use only the freshest forecast of each hour (see .get_best_available(...))
+                instead of all forecasts made on the same day
 
         Returns:
             pandas.DataFrame: resulting object with weather measurements
         """
+        if freshest:
+            return self.get_best_available(from_date, to_date, aggtime=aggtime, aggloc=aggloc,
+                                           interp_points=interp_points, bounding_box=bounding_box, plan=plan,
+                                           params=params, aggfunc=aggfunc)
+
         assert type(from_date) == datetime.date
         assert type(to_date) == datetime.date
         assert from_date <= to_date
         assert aggtime in ['hour', 'day', 'week']
+        if plan is not None:
+            aggloc = plan.aggloc
         assert aggloc in ['country', 'points', 'grid', 'bbox']
 
-        if aggloc == 'points':
+        key = self._result_key(plan, 'actual', from_date, to_date, aggtime, aggloc, interp_points, bounding_box,
+                               params, aggfunc)
+        if key is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        if aggloc == 'points' and plan is None:
             if interp_points is None:
                 raise ValueError(
                     "interp_points cannot be None if aggloc is set to 'points'.")
@@ -581,28 +915,146 @@ class WeatherExtractor:
                 raise ValueError(
                     "bounding_box cannot be None if aggloc is set to 'bounding_box'.")
 
-        req_period = self.grib_msgs.loc[from_date:to_date]
-        tmp_result = req_period[req_period['validDateTime'].dt.date ==
-                                req_period['validityDateTime'].dt.date]
+        aggtype = 'mean' if aggloc == 'bbox' else 'one'
+        if plan is not None:
+            aggtype = plan.aggtype
+
+        base_range = (np.datetime64(from_date), np.datetime64(to_date + datetime.timedelta(days=1)))
+        if aggtime != 'hour' and self._rollups_answer(aggfunc, aggtype, params):
+            tmp_result = self._aggregate_rollups(
+                aggtime, aggfunc, base_range, same_day=True, params=params, aggloc=aggloc, aggtype=aggtype,
+                interp_points=interp_points, bounding_box=bounding_box, plan=plan)
+            return self._cache_result(key, tmp_result)
+
+        tmp_result = self._select_messages(base_range, same_day=True, params=self._selected_params(params))
 
-        # drop 'type' column
-        tmp_result.drop('type', axis=1, inplace=True)
+        # calculate derived parameters
+        tmp_result = self._derive(tmp_result, params)
 
-        # reset original index
-        tmp_result.reset_index(drop=True, inplace=True)
+        # drop 'type' column and original index, selected messages are not changed
+        tmp_result = tmp_result.drop('type', axis=1).reset_index(drop=True)
 
         # point aggregation
+        tmp_result = self._aggregate_points(
+            tmp_result, aggloc, aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box, plan=plan)
+
+        # time aggregation
+        tmp_result = self._aggregate_values(tmp_result, aggtime, aggfunc=aggfunc)
+
+        return self._cache_result(key, tmp_result)
+
+    def _loaded_messages(self):
+        """
+        Metadata of all loaded messages with a function gathering messages by their positions.
+
+        Returns:
+            tuple: base datetimes, validity datetimes, short names and the gathering function
+        """
+        if self.storage == 'frame':
+            grib_msgs, index = self.grib_msgs, self.time_index
+            return (index.base_times, index.validity_times, index.params[index.param_codes],
+                    lambda rows: grib_msgs.iloc[rows])
+        if self.storage == 'cube':
+            cube = self.cube
+            b_idx, s_idx, p_idx = np.nonzero(cube.present)
+            base = cube.base_times[b_idx]
+            return (base, base + cube.steps[s_idx], cube.params[p_idx],
+                    lambda rows: cube.to_frame(b_idx[rows], s_idx[rows], p_idx[rows]))
+        if isinstance(self.lazy_msgs, LazyMessages):
+            lazy_msgs = self.lazy_msgs
+            return (lazy_msgs.base_times, lazy_msgs.validity_times, lazy_msgs.short_names,
+                    lambda rows: lazy_msgs.to_frame(rows))
+
+        # partitioned archive, metadata of partitions is read without values, only gathered partitions are opened
+        archive = self.lazy_msgs
+        base, validity, short_names, partitions, positions = archive.headers()
+        return base, validity, short_names, lambda rows: archive.take(partitions[rows], positions[rows])
+
+    def freshest_index(self, min_lead=0):
+        """
+        Index of the freshest forecast of each validity datetime and parameter, built on first use
+        and kept until the next load.
+
+        Args:
+            min_lead (int): minimal lead time in hours of the used forecasts
+
+        Returns:
+            tuple: timeindex.FreshestIndex over loaded messages and the function gathering its messages
+        """
+        entry = self.freshest_indices.get(min_lead)
+        if entry is None:
+            base, validity, short_names, gather = self._loaded_messages()
+            entry = (FreshestIndex(base, validity, short_names, min_lead=np.timedelta64(min_lead, 'h')), gather)
+            self.freshest_indices[min_lead] = entry
+        return entry
+
+    def get_best_available(self, from_date, to_date, aggtime='hour', aggloc='grid', interp_points=None,
+        bounding_box=None, plan=None, params=None, aggfunc='mean', min_lead=0):
+        """
+        Get a continuous series of the best available weather estimation: for each validity hour in
+        a time window the forecast of the latest base run (midnight or noon) made at least min_lead
+        hours before. Messages of the whole window are gathered at once from a precomputed index
+        (see .freshest_index(...)), so series over years cost one lookup.
+
+        Args:
+            from_date, to_date (datetime.date): time window of validity dates (both inclusive)
+            min_lead (int): minimal lead time in hours of the used forecasts
+            aggtime, aggloc, interp_points, bounding_box, plan, params: see .get_actual(...)
+            aggfunc (str or dict): reducer used by time aggregation, see _aggregate_values; with 'cum'
+                the first message of each used forecast counts everything accumulated since its base datetime
+
+        Returns:
+            pandas.DataFrame: resulting object with weather measurements, validDateTime is the base
+                datetime of the used forecast
+        """
+        assert type(from_date) == datetime.date
+        assert type(to_date) == datetime.date
+        assert from_date <= to_date
+        assert aggtime in ['hour', 'day', 'week']
+        assert min_lead >= 0
+        if plan is not None:
+            aggloc = plan.aggloc
+        assert aggloc in ['country', 'points', 'grid', 'bbox']
+
+        key = self._result_key(plan, 'best', from_date, to_date, aggtime, aggloc, interp_points, bounding_box,
+                               params, aggfunc, min_lead)
+        if key is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        if aggloc == 'points' and plan is None:
+            if interp_points is None:
+                raise ValueError(
+                    "interp_points cannot be None if aggloc is set to 'points'.")
+            interp_points = self._latslons_from_dict(interp_points)
+
         aggtype = 'mean' if aggloc == 'bbox' else 'one'
+        if plan is not None:
+            aggtype = plan.aggtype
+
+        # one vectorized gather of the freshest messages of the window
+        index, gather = self.freshest_index(min_lead)
+        validity_range = (np.datetime64(from_date), np.datetime64(to_date + datetime.timedelta(days=1)))
+        tmp_result = gather(index.rows(validity_range, params=self._selected_params(params)))
+
+        # calculate derived parameters
+        tmp_result = self._derive(tmp_result, params)
+
+        # drop 'type' column and original index, selected messages are not changed
+        tmp_result = tmp_result.drop('type', axis=1).reset_index(drop=True)
+
+        # point aggregation
         tmp_result = self._aggregate_points(
-            tmp_result, aggloc, aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box)
+            tmp_result, aggloc, aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box, plan=plan)
 
         # time aggregation
-        tmp_result = self._aggregate_values(tmp_result, aggtime)
+        tmp_result = self._aggregate_values(tmp_result, aggtime, aggfunc=aggfunc)
 
-        return tmp_result
+        return self._cache_result(key, tmp_result)
 
     def get_forecast(self, base_date, from_date, to_date, aggtime='hour', aggloc='grid', interp_points=None,
-        bounding_box=None):
+        bounding_box=None, plan=None, params=None, aggfunc='mean'):
         """
         Get the weather forecast for a given time window from a given date.
 
@@ -616,6 +1068,11 @@ class WeatherExtractor:
                 as dict with fields 'lon' and 'lat' representing longtitude and lattitude if aggloc='points'
             bounding_box ([[lat1,lon1], [lat2,lon2]]): corner points of the bounding box if aggloc='bbox',
                 order of the points is not important
+            plan (QueryPlan): precompiled spatial plan from .query_plan(...) used instead of aggloc,
+                interp_points and bounding_box
+            params (list): short names of the returned parameters, including derived parameters
+                (see derived.DERIVED_PARAMS); stored parameters and ws, rh if None
+            aggfunc (str or dict): reducer used by time aggregation, see _aggregate_values
 
         Returns:
             pandas.DataFrame: resulting object with weather measurements
@@ -625,9 +1082,18 @@ class WeatherExtractor:
         assert type(to_date) == datetime.date
         assert base_date <= from_date <= to_date
         assert aggtime in ['hour', 'day', 'week']
+        if plan is not None:
+            aggloc = plan.aggloc
         assert aggloc in ['country', 'points', 'grid', 'bbox']
 
-        if aggloc == 'points':
+        key = self._result_key(plan, 'forecast', base_date, from_date, to_date, aggtime, aggloc, interp_points,
+                               bounding_box, params, aggfunc)
+        if key is not None:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return cached
+
+        if aggloc == 'points' and plan is None:
             if interp_points is None:
                 raise ValueError(
                     "interp_points cannot be None if aggloc is set to 'points'.")
@@ -637,212 +1103,351 @@ class WeatherExtractor:
                 raise ValueError(
                     "bounding_box cannot be None if aggloc is set to 'bounding_box'.")
 
-        req_period = self.grib_msgs.loc[base_date]
+        aggtype = 'mean' if aggloc == 'bbox' else 'one'
+        if plan is not None:
+            aggtype = plan.aggtype
+
+        base_range = (np.datetime64(base_date), np.datetime64(base_date + datetime.timedelta(days=1)))
+        validity_range = (np.datetime64(from_date), np.datetime64(to_date + datetime.timedelta(days=1)))
+        if aggtime != 'hour' and self._rollups_answer(aggfunc, aggtype, params):
+            tmp_result = self._aggregate_rollups(
+                aggtime, aggfunc, base_range, validity_range=validity_range, params=params, aggloc=aggloc,
+                aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box, plan=plan)
+            return self._cache_result(key, tmp_result)
 
-        # start with default (hourly) aggregation
-        tmp_result = req_period[req_period['validityDateTime'].dt.date >= from_date]
-        tmp_result = tmp_result[tmp_result['validityDateTime'].dt.date <= to_date]
+        tmp_result = self._select_messages(base_range, validity_range=validity_range,
+                                           params=self._selected_params(params))
 
-        # drop 'type' column
-        tmp_result.drop('type', axis=1, inplace=True)
+        # calculate derived parameters
+        tmp_result = self._derive(tmp_result, params)
 
-        # reset original index
-        tmp_result.reset_index(drop=True, inplace=True)
+        # drop 'type' column and original index, selected messages are not changed
+        tmp_result = tmp_result.drop('type', axis=1).reset_index(drop=True)
 
         # point aggregation
-        aggtype = 'mean' if aggloc == 'bbox' else 'one'
         tmp_result = self._aggregate_points(
-            tmp_result, aggloc, aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box)
+            tmp_result, aggloc, aggtype=aggtype, interp_points=interp_points, bounding_box=bounding_box, plan=plan)
 
         # time aggregation
-        tmp_result = self._aggregate_values(tmp_result, aggtime)
+        tmp_result = self._aggregate_values(tmp_result, aggtime, aggfunc=aggfunc)
+
+        return self._cache_result(key, tmp_result)
 
+    @staticmethod
+    def _selected_params(params):
+        """ Stored parameters needed by a query of the given parameters, all if None. """
+        if params is None:
+            return None
+        return set(params) | required_inputs(params)
+
+    def _select_messages(self, base_range, validity_range=None, same_day=False, params=None):
+        """
+        Select loaded messages, see WeatherCube.select for the time arguments.
+
+        Args:
+            params (set): short names of the selected parameters, all if None
+        """
+        if self.storage == 'frame':
+            # binary search in the sorted time index
+            return self.grib_msgs.iloc[self.time_index.rows(base_range, validity_range, same_day, params=params)]
+
+        if self.storage == 'cube':
+            grib_msgs = self.cube.select(base_range, validity_range=validity_range, same_day=same_day)
+        else:
+            grib_msgs = self._select_lazy(base_range, validity_range=validity_range, same_day=same_day)
+        if params is not None:
+            grib_msgs = grib_msgs[grib_msgs['shortName'].isin(params).values]
+        return grib_msgs
+
+    def _target_plan(self, target, lats, lons):
+        """ Query plan of a target set of .get_forecasts(...) on the given grid. """
+        if isinstance(target, QueryPlan):
+            if target.fingerprint != self.query_plans.fingerprint(lats, lons):
+                raise ValueError("Query plan was built for a different grid.")
+            return target
+        if len(target) > 0 and isinstance(target[0], dict):
+            return self.query_plans.get(lats, lons, 'points', interp_points=self._latslons_from_dict(target))
+        return self.query_plans.get(lats, lons, 'bbox', bounding_box=target)
+
+    def get_forecasts(self, windows, targets, aggtime='hour', params=None, aggfunc='mean'):
+        """
+        Get weather forecasts for many time windows and target sets at once. Messages of all windows
+        are selected and derived in one pass, each target set is aggregated over points once for the
+        messages of all windows, and time aggregation is done once per target set for all windows.
+
+        Args:
+            windows (list): (base_date, from_date, to_date) windows of datetime.date, see .get_forecast(...)
+            targets (list): target sets, each one of the following:
+                list of dicts: interpolation points with fields 'lat' and 'lon' (as for aggloc='points')
+                [[lat1,lon1], [lat2,lon2]]: corner points of a bounding box (as for aggloc='bbox')
+                QueryPlan: precompiled spatial plan from .query_plan(...)
+            aggtime (str): time aggregation level; can be 'hour', 'day' or 'week'
+            params (list): short names of the returned parameters, see .get_forecast(...)
+            aggfunc (str or dict): reducer used by time aggregation, see ._aggregate_values(...)
+
+        Returns:
+            pandas.DataFrame: results of all queries in long format; 'query' identifies the (window, target)
+                pair as window * len(targets) + target, 'window' and 'target' are positions in the given
+                lists and the remaining columns are the ones of .get_forecast(...)
+        """
+        assert aggtime in ['hour', 'day', 'week']
+        assert len(windows) > 0 and len(targets) > 0
+        for base_date, from_date, to_date in windows:
+            assert type(base_date) == datetime.date
+            assert type(from_date) == datetime.date
+            assert type(to_date) == datetime.date
+            assert base_date <= from_date <= to_date
+
+        columns = ['query', 'validDateTime', 'validityDateTime', 'shortName', 'values', 'lats', 'lons']
+        base_days = np.array([window[0] for window in windows], dtype='datetime64[D]')
+        v_starts = np.array([window[1] for window in windows], dtype='datetime64[D]')
+        v_stops = np.array([window[2] for window in windows], dtype='datetime64[D]') + 1
+
+        # one selection covering all windows
+        grib_msgs = self._select_messages((base_days.min(), base_days.max() + 1),
+                                          validity_range=(v_starts.min(), v_stops.max()),
+                                          params=self._selected_params(params))
+        grib_msgs = self._derive(grib_msgs, params).reset_index(drop=True)
+
+        # messages of each window, base days are found by binary search
+        base = grib_msgs['validDateTime'].values.astype('datetime64[D]')
+        validity = grib_msgs['validityDateTime'].values.astype('datetime64[s]')
+        by_base = np.argsort(base, kind='stable')
+        lo = np.searchsorted(base[by_base], base_days, side='left')
+        hi = np.searchsorted(base[by_base], base_days + 1, side='left')
+        rows, window_ids = [], []
+        for window in range(len(windows)):
+            window_rows = by_base[lo[window]:hi[window]]
+            window_validity = validity[window_rows]
+            window_rows = window_rows[(window_validity >= v_starts[window]) & (window_validity < v_stops[window])]
+            rows.append(window_rows)
+            window_ids.append(np.full(len(window_rows), window, dtype=np.int64))
+        rows, window_ids = np.concatenate(rows), np.concatenate(window_ids)
+
+        if len(rows) == 0:
+            tmp_result = pd.DataFrame(columns=columns)
+        else:
+            # each message used by any window is aggregated over points once per target set
+            used, positions = np.unique(rows, return_inverse=True)
+            values = np.vstack(grib_msgs['values'].values[used])
+            lats, lons = grib_msgs['lats'].iloc[0], grib_msgs['lons'].iloc[0]
+            results = []
+            for target_id, target in enumerate(targets):
+                plan = self._target_plan(target, lats, lons)
+                target_values = plan.apply(values)
+                tmp_result = pd.DataFrame({
+                    'query': window_ids * len(targets) + target_id,
+                    'validDateTime': grib_msgs['validDateTime'].values[rows],
+                    'validityDateTime': grib_msgs['validityDateTime'].values[rows],
+                    'shortName': grib_msgs['shortName'].values[rows],
+                    'values': object_array(target_values[positions]),
+                    'lats': object_array([plan.target_lats] * len(rows)),
+                    'lons': object_array([plan.target_lons] * len(rows))
+                }, columns=columns)
+                results.append(self._aggregate_values(tmp_result, aggtime, aggfunc=aggfunc, by='query'))
+            tmp_result = pd.concat(results, ignore_index=True)
+            tmp_result = tmp_result.iloc[np.argsort(tmp_result['query'].values, kind='stable')]
+            tmp_result = tmp_result.reset_index(drop=True)
+
+        queries = tmp_result['query'].values.astype(np.int64)
+        tmp_result.insert(1, 'window', queries // len(targets))
+        tmp_result.insert(2, 'target', queries % len(targets))
         return tmp_result
 
-    def export_qminer(self, filename, interp_points):
+    def _export_window(self, from_date=None, to_date=None):
+        """
+        Metadata of loaded messages with base dates in a window (both inclusive, all if None).
+
+        Returns:
+            tuple: base datetimes, validity datetimes and short names of the messages
+        """
+        base, validity, short_names, _ = self._loaded_messages()
+        keep = np.ones(len(base), dtype=bool)
+        if from_date is not None:
+            keep &= base >= np.datetime64(from_date, 's')
+        if to_date is not None:
+            keep &= base < np.datetime64(to_date + datetime.timedelta(days=1), 's')
+        return base[keep], validity[keep], np.asarray(short_names, dtype=str)[keep]
+
+    def export_qminer(self, filename, interp_points, from_date=None, to_date=None, chunk_days=31, processes=None,
+                      format='tsv'):
         """
-        Export weather features for each date from dates to .tsv file.
+        Export weather features for each date from dates to .tsv or .parquet file.
 
         Args:
             filename (str): name of target file
             interp_points (list of dicts): list of interpolation points with each point represented
                 as dict with fields 'lon' and 'lat' representing longtitude and lattitude
-        Returns:
-            pandas.DataFrame: resulting object with weather measurements
+            from_date, to_date (datetime.date): window of exported base dates (both inclusive), all if None
+            chunk_days (int): validity days exported at once, all at once if None
+            processes (int): number of worker processes exporting chunks, chunks are exported in the
+                current process if None or 1
+            format (str): 'tsv' or 'parquet' (requires pyarrow) with one row group per timestamp date and dictionary
+                encoded param, see export.write_chunks
         """
-        # export all dates
-        dates = np.unique(sorted([dt.date() for dt in self.grib_msgs.validDateTime]))
+        base, validity, _ = self._export_window(from_date, to_date)
         # get interpolation points
-        lats, lons = self.grib_msgs.iloc[0]['lats'], self.grib_msgs.iloc[0]['lons']
+        lats, lons = self._grid()
         target_lats, target_lons = self._latslons_from_dict(interp_points)
         # only keep the values from closest point to each target
         closest = self._calc_closest(target_lats, target_lons, lats, lons)
-        # weather features frame
-        tf = self.grib_msgs
-        # index on the predicted date
-        tf = tf.set_index('validityDateTime', drop=False)
-        tf = tf.sort_index()
-        # WARNING: there is something wrong with ptype parameter
-        tf = tf[tf.shortName != 'ptype']
-        # interpolate all values
-        tf['values'] = tf['values'].apply(lambda x: x[closest])
-
-        # generate new dataframe
-        rf = pd.DataFrame()
-        rf['param'] = tf['shortName']
-        rf['timestamp'] = tf['validityDateTime']
-        rf['dayOffset'] = (tf['validityDateTime'] - tf['validDateTime']).apply(lambda x: x.days)
-
-        # generate region values
-        for i in range(len(interp_points)):
-            rf[str(i)] = tf['values'].apply(lambda x: x[i])
-        # transform region values from columns to rows
-        rf = pd.melt(rf, id_vars=['param', 'timestamp', 'dayOffset'], var_name='region', value_name='value')
-        rf['region'] = pd.to_numeric(rf['region'])
-
-        rf.sort_values(by=['timestamp', 'region'], inplace=True)
-        rf.to_csv(filename, sep='\t', index=False)
-
-    def export_db(self, filename):
-        """
-        Export weather features to tsv file in MariaDB format.
+
+        def jobs():
+            if len(base) == 0:
+                return
+            last_base = base.max() + np.timedelta64(1, 's')
+            longest_lead = (validity - base).max()
+            for start, stop in day_chunks(validity.min(), validity.max() + np.timedelta64(1, 'D'), chunk_days):
+                # messages valid in the chunk, made before its end and at most the longest lead time before its start
+                first_base = max(base.min(), start.astype('datetime64[s]') - longest_lead)
+                grib_msgs = self._select_messages((first_base, min(last_base, stop.astype('datetime64[s]'))),
+                                                  validity_range=(start, stop))
+                if len(grib_msgs) > 0:
+                    yield qminer_chunk, (at_points(grib_msgs, closest), np.arange(len(closest)))
+
+        write_chunks(filename, jobs(), processes=processes, format=format, date_column='timestamp',
+                     dictionary_columns=['param'])
+
+    def export_db(self, filename, from_date=None, to_date=None, chunk_days=31, processes=None, format='tsv'):
+        """
+        Export weather features to tsv or parquet file in MariaDB format.
 
         Args:
             filename (str): name of target file
-        Returns:
-            pandas.DataFrame: resulting object with weather measurements
+            from_date, to_date (datetime.date): window of exported base dates (both inclusive), all if None
+            chunk_days (int): base days exported at once, all at once if None
+            processes (int): number of worker processes exporting chunks, chunks are exported in the
+                current process if None or 1
+            format (str): 'tsv' or 'parquet' (requires pyarrow) with one row group per base date and
+                a column per parameter, see export.write_chunks
         """
-        # weather features frame
-        df = self.grib_msgs
-
-        def f(group):
-            item = group.iloc[0]
-            n = len(item.lats)
-
-            offset = math.trunc((item.validityDateTime - item.validDateTime).total_seconds() / 3600.0)
-            new_columns = {
-                'date': [item.validDateTime] * n,
-                'offset': [offset] * n,
-                'latitude': list(item.lats),
-                'longitude': list(item.lons)
-            }
-
-            for param_name, param_group in group.groupby('shortName'):
-                new_columns[param_name] = param_group.iloc[0]['values']
-
-            return pd.DataFrame(new_columns)
-
-        df = df.groupby(['validDateTime', 'validityDateTime'], as_index=False).apply(f)
-        df.sort_values(by=['date', 'offset'], inplace=True)
-        df.to_csv(filename, sep='\t', index=False)
-
-    def export(self, filename, interp_points, weather_params='all', forecast_offsets='all', regions='all'):
+        base, _, short_names = self._export_window(from_date, to_date)
+        # the same parameter columns in all chunks: stored and default derived parameters
+        names = set(np.unique(short_names))
+        params = sorted(names | set(name for name in default_params() if required_inputs([name]) <= names))
+
+        def jobs():
+            if len(base) == 0:
+                return
+            for start, stop in day_chunks(base.min(), base.max() + np.timedelta64(1, 'D'), chunk_days):
+                grib_msgs = self._messages(start.astype(datetime.date), (stop - 1).astype(datetime.date),
+                                           derived=False)
+                if len(grib_msgs) > 0:
+                    yield db_chunk, (grib_msgs, params)
+
+        write_chunks(filename, jobs(), processes=processes, format=format, date_column='date')
+
+    def export(self, filename, interp_points, weather_params='all', forecast_offsets='all', regions='all',
+        from_date=None, to_date=None, chunk_days=31, processes=None, format='tsv'):
         """
-        Export weather features for each date from dates to .tsv file.
+        Export weather features for each date from dates to .tsv or .parquet file.
 
         Args:
             filename (str): name of target file
-            dates (list): list of dates (datetime.date)
             interp_points (list of dicts): list of interpolation points with each point represented
                 as dict with fields 'lon' and 'lat' representing longtitude and lattitude
+            weather_params (list): exported parameters, see features.feature_table
+            forecast_offsets (list): exported offsets of base dates from dates in days, -11 to 0 by default
+            regions (list): exported interpolation points (positions in interp_points)
+            from_date, to_date (datetime.date): window of exported base dates (both inclusive), all if None
+            chunk_days (int): dates exported at once, all at once if None
+            processes (int): number of worker processes exporting chunks, chunks are exported in the
+                current process if None or 1
+            format (str): 'tsv' or 'parquet' (requires pyarrow) with one row group per date and dictionary
+                encoded shortName, featureName and aggFunc, see export.write_chunks
+        """
+        _, _, _, _, chunks = self._feature_chunks(interp_points, weather_params, forecast_offsets, regions,
+                                                  from_date, to_date, chunk_days)
+        write_chunks(filename, ((features_chunk, args) for args in chunks), processes=processes, format=format,
+                     date_column='validDate', dictionary_columns=['shortName', 'featureName', 'aggFunc'])
+
+    def export_tensor(self, filename, interp_points, weather_params='all', forecast_offsets='all', regions='all',
+        from_date=None, to_date=None, chunk_days=31, processes=None, dtype=np.float32):
+        """
+        Export weather features for each date from dates as a dense tensor to .npy file, which can be
+        memory-mapped with np.load(filename, mmap_mode='r').
+
+        The tensor has axes (date, day offset, parameter, region, window) with features of the latest
+        base run of each day offset, nan if missing. Parameters are (shortName, aggFunc) pairs of the
+        exported weather parameters, see features.tensor_features. Labels of the axes are saved to
+        <filename without extension>.axes.npz with arrays 'date', 'dayOffset', 'shortName', 'aggFunc',
+        'region' and 'window' (fromHour, toHour).
+
+        Args:
+            filename (str): name of target .npy file
+            interp_points, weather_params, forecast_offsets, regions, from_date, to_date, chunk_days, processes:
+                see export
+            dtype (np.dtype): type of feature values
 
         Returns:
-            pandas.DataFrame: resulting object with weather measurements
+            str: name of the file with axis labels
+        """
+        weather_params, forecast_offsets, regions, dates, chunks = self._feature_chunks(
+            interp_points, weather_params, forecast_offsets, regions, from_date, to_date, chunk_days)
+        features = tensor_features(weather_params)
+        axes = {
+            'date': dates,
+            'dayOffset': np.asarray(forecast_offsets, dtype=np.int64),
+            'shortName': np.array([name for name, _ in features], dtype=str),
+            'aggFunc': np.array([func for _, func in features], dtype=str),
+            'region': np.asarray(regions, dtype=np.int64),
+            'window': np.asarray(FEATURE_WINDOWS, dtype=np.int64)
+        }
+
+        tensor = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(
+            len(dates), len(forecast_offsets), len(features), len(regions), len(FEATURE_WINDOWS)))
+        tensor[:] = np.nan
+        for start, chunk in map_chunks(((tensor_chunk, args) for args in chunks), processes):
+            at = int((start - dates[0]).astype(np.int64))
+            tensor[at:at + len(chunk)] = chunk
+        tensor.flush()
+        del tensor
+
+        axes_filename = os.path.splitext(filename)[0] + '.axes.npz'
+        np.savez(axes_filename, **axes)
+        return axes_filename
+
+    def _feature_chunks(self, interp_points, weather_params, forecast_offsets, regions, from_date, to_date,
+                        chunk_days):
+        """
+        Arguments of chunks of feature exports, see export for arguments.
+
+        Returns:
+            tuple: exported weather parameters, forecast offsets, regions, dates (np.array(dtype='datetime64[D]'))
+                and generator of chunk arguments of features_chunk and tensor_chunk
         """
-        # export all dates
-        dates = np.unique(sorted([dt.date() for dt in self.grib_msgs.validDateTime]))
+        base, _, _ = self._export_window(from_date, to_date)
         # get interpolation points
-        lats, lons = self.grib_msgs.iloc[0]['lats'], self.grib_msgs.iloc[0]['lons']
+        lats, lons = self._grid()
         target_lats, target_lons = self._latslons_from_dict(interp_points)
         # only keep the values from closest point to each target
         closest = self._calc_closest(target_lats, target_lons, lats, lons)
-        # weather features frame
-        tf = self.grib_msgs
-        # index on the predicted date
-        tf = tf.set_index('validityDateTime', drop=False)
-        tf = tf.sort_index()
-        # feature collection
-        feat_rows = list()
         # used weather parameters
-        if weather_params == 'all': weather_params = np.unique(tf['shortName'])
+        if weather_params == 'all': weather_params = CUM_PARAMS + INSTANT_PARAMS
         # used weather regions
         if regions == 'all': regions = list(range(len(interp_points)))
         # used forecast base_date offsets
         if forecast_offsets == 'all': forecast_offsets = list(range(-11, 1))
-        # interpolate all values
-        tf['values'] = tf['values'].apply(lambda x: x[closest])
-        for curr_date_pos, curr_date in enumerate(dates):
-            # process current date
-            start_day = datetime.datetime.combine(curr_date, datetime.time(0,0))
-            end_day = datetime.datetime.combine(curr_date, datetime.time(23,59))
-            # forecast data regarding current date
-            cf = tf.loc[start_day:end_day]
-            # group by all unique dates on which forecast was made and weather parameters
-            date_params_groups = cf.groupby(['validDateTime', 'shortName'])
-            for group_name in date_params_groups.groups:
-                pdf = date_params_groups.get_group(group_name)
-                # are we interested in the forecast from day_offset days before?
-                base_date = pdf['validDateTime'].iloc[0].date()
-                day_offset = (base_date - curr_date).days
-                if day_offset not in forecast_offsets: continue
-                # forecasted params from base_date for date
-                param_name = pdf.iloc[0]['shortName']
-                # WARNING: there is something wrong with ptype
-                if param_name == 'ptype':
-                    continue
-                # are we interested in this parameter?
-                if param_name not in weather_params: continue
-                # feature prefix
-                feat_prefix = 'WEATHERFC%s%03d%s' % ('+' if day_offset >= 0 else '-', abs(day_offset), param_name)
-                # describe accumulated parameter
-                if param_name in ['sund', 'tp', 'sf']: # sun duration, total percitipation, snow fall
-                    for from_hour, to_hour in [(0, 6), (6, 12), (12, 18), (6, 18)]:
-                        cum_from = pdf.loc[datetime.time(from_hour):datetime.time(from_hour)]
-                        if len(cum_from) == 0:
-                            print("base_date: ", base_date, " curr_date: ", curr_date, " param_name: ", param_name, " at: ", from_hour, " missing!")
-                            continue
-                        else:
-                            cum_from = cum_from.iloc[0]['values']
-
-                        cum_to = pdf.loc[datetime.time(to_hour):datetime.time(to_hour)]
-                        if len(cum_to) == 0:
-                            print("base_date: ", base_date, " curr_date: ", curr_date, " param_name: ", param_name, " at: ", from_hour, " missing!")
-                            continue
-                        else:
-                            cum_to = cum_to.iloc[0]['values']
-
-                        for reg in regions:
-                            feat_rows.append({
-                                'validDate': curr_date,
-                                'dayOffset': day_offset,
-                                'region': reg,
-                                'shortName': param_name,
-                                'fromHour': from_hour,
-                                'toHour': to_hour,
-                                'value': cum_to[reg] - cum_from[reg],
-                                'featureName': '%s%03dCUM%02d-%02d' % (feat_prefix, reg, from_hour, to_hour),
-                                'aggFunc': 'cum'
-                            })
-                # describe instant parameter
-                elif param_name in ['2t', 'ws', 'rh', 'sd', 'tcc'] : # temperature, wind-speed, relative humidity, snow depth
-                    for func_name, func in zip(['min', 'mean', 'max'], [np.min, np.mean, np.max]):
-                        for from_hour, to_hour in [(0, 6), (6, 12), (12, 18), (6, 18)]:
-                            range_values = pdf.loc[datetime.time(from_hour, 0):datetime.time(to_hour, 0)]
-                            for reg in regions:
-                                feat_rows.append({
-                                    'validDate': curr_date,
-                                    'dayOffset': day_offset,
-                                    'region': reg,
-                                    'shortName': param_name,
-                                    'fromHour': from_hour,
-                                    'toHour': to_hour,
-                                    'value': func(range_values['values'].apply(lambda x: x[reg])),
-                                    'featureName': '%s%03d%s%02d-%02d' % (feat_prefix, reg, func_name.upper(), from_hour, to_hour),
-                                    'aggFunc': func_name
-                                })
-
-        feat_df = pd.DataFrame.from_dict(feat_rows)
-        feat_df.to_csv(filename, sep='\t', index=False)
+        # export all base dates
+        if len(base) == 0:
+            dates = np.zeros(0, dtype='datetime64[D]')
+        else:
+            dates = np.arange(base.min().astype('datetime64[D]'), base.max().astype('datetime64[D]') + 1)
+
+        def chunks():
+            if len(dates) == 0:
+                return
+            # each chunk of dates with the forecasts made for them
+            first, last = dates[0], dates[-1]
+            before, after = min(min(forecast_offsets), 0), max(max(forecast_offsets), 0)
+            for start, stop in day_chunks(first, last + 1, chunk_days):
+                grib_msgs = self._messages(max(first, start + before).astype(datetime.date),
+                                           min(last, stop - 1 + after).astype(datetime.date), derived=False)
+                if len(grib_msgs) > 0:
+                    yield (at_points(grib_msgs, closest), np.arange(len(closest)), regions, (start, stop),
+                           weather_params, forecast_offsets)
+
+        return weather_params, forecast_offsets, regions, dates, chunks()
 
 class WeatherApi:
     """